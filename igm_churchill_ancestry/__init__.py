@@ -0,0 +1 @@
+from igm_churchill_ancestry.pipelines.predictor import AncestryPredictor
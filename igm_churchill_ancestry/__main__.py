@@ -1,4 +1,4 @@
-from igm_churchill_ancestry.cli import run_ancestry
+from igm_churchill_ancestry.cli import main
 
 if __name__ == '__main__':
-    run_ancestry()
+    main()
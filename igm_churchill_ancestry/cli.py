@@ -1,14 +1,42 @@
+import gc
 import os
+import sys
+import json
+import time
 import uuid
 import logging
 import tempfile
 import argparse
+import traceback
+import subprocess
+import multiprocessing
 import concurrent.futures
 
 from igm_churchill_ancestry.pipelines.variables import variables
 from igm_churchill_ancestry.utilities.flex import flex_input, flex_output
 from igm_churchill_ancestry.pipelines.ancestry_prediction import run_ancestry_pipeline
-from igm_churchill_ancestry.utilities.utilities import get_extension, filter_extension, is_vcf_multisample, check_resources
+from igm_churchill_ancestry.pipelines.predictor import AncestryPredictor
+from igm_churchill_ancestry.pipelines.resources import ResourceLoader
+from igm_churchill_ancestry.pipelines.chunked import run_chunked_pipeline
+from igm_churchill_ancestry.pipelines.genotypes import run_genotype_pipeline
+from igm_churchill_ancestry.pipelines.server import PredictionBatcher, make_server
+from igm_churchill_ancestry.pipelines.warmup import run_stages, savings, format_savings
+from igm_churchill_ancestry.pipelines.benchmark import run_benchmarks, compare, format_report
+from igm_churchill_ancestry.pipelines.equivalence import CASES, ENGINES, check_engines, run_equivalence, format_equivalence
+from igm_churchill_ancestry.utilities.store import ResultsStore
+from igm_churchill_ancestry.utilities.cache import PredictionCache, file_checksum
+from igm_churchill_ancestry.utilities.resource_cache import ResourceCache
+from igm_churchill_ancestry.utilities.checkpoint import MANIFEST, Checkpoint, input_stamp, publish_file, publish_outputs, record_published
+from igm_churchill_ancestry.utilities.s3 import validate_s3_path, list_s3_objects, download_s3_directory
+from igm_churchill_ancestry.utilities.stream import ResultStream, ArtifactPublisher
+from igm_churchill_ancestry.utilities.run_report import REPORT, span, start_report, write_report, read_spans, summarize
+from igm_churchill_ancestry.utilities.shared_arrays import SharedArrays
+from igm_churchill_ancestry.utilities.metrics import MetricsExporter, start_metrics, save_counters, write_metrics
+from igm_churchill_ancestry.utilities.manifest import read_manifest, parse_shard, shard_rows, part_name, find_parts, merge_results
+from igm_churchill_ancestry.utilities.parsing import parse_genotype_json
+from igm_churchill_ancestry.utilities.plink import PLINK_EXTENSIONS, plink_prefix
+from igm_churchill_ancestry.utilities.writers import FORMATS, output_filename, results_models
+from igm_churchill_ancestry.utilities.utilities import get_extension, filter_extension, is_vcf_multisample, check_resources, parse_size
 
 
 
@@ -30,19 +58,268 @@ def setup_workspace():
     return wrk_dir
 
 
-def run_ancestry():
+def fetch_resources(resource, rsrc_dir, cache_dir=None, cache_size='64G', models=None):
+    """
+    Download (or locate) the resource folder. s3 resources go through the
+    node-level resource cache when cache_dir is given. With models only the
+    directories those models need are downloaded, see variables.resource_dirs.
+    """
+    if not resource.startswith('s3://'):
+        return flex_input(resource, rsrc_dir, directory=True)
+    cache = ResourceCache(cache_dir, parse_size(cache_size)) if cache_dir else None
+    if not models:
+        return cache.fetch(resource) if cache else flex_input(resource, rsrc_dir, directory=True)
+    resource = resource.rstrip('/')
+    # the layout of the resource folder does not depend on its location
+    for rel in variables('/').select_models(models).resource_dirs():
+        dst = os.path.join(rsrc_dir, rel)
+        os.makedirs(os.path.dirname(dst), exist_ok=True)
+        if cache:
+            os.symlink(cache.fetch(f'{resource}/{rel}'), dst)
+        else:
+            flex_input(f'{resource}/{rel}', os.path.dirname(dst), directory=True)
+    return rsrc_dir
+
+
+def fetch_input(path, out_dir=None, prepend_hash=False):
+    """flex_input of an input file, with the .bim and .fam of a PLINK .bed on s3 next to it."""
+    local_path = flex_input(path, out_dir, prepend_hash=prepend_hash)
+    if path.startswith('s3://') and path.endswith(PLINK_EXTENSIONS):
+        for ext in ('.bim', '.fam'):
+            flex_input(plink_prefix(path) + ext, out_dir, prepend_hash=prepend_hash)
+    return local_path
+
+
+def add_model_args(parser):
+    parser.add_argument('--models', dest='models', type=str, nargs='+', default=None, help="<OPTIONAL> Run only these models, e.g. gnomAD_continental gnomAD_eur. Sub continental models also run their continental model, which normalizes them. Only the resources of the selected models are downloaded and loaded")
+
+
+def add_resource_cache_args(parser):
+    parser.add_argument('--resource-cache', dest='resource_cache', type=str, default=os.environ.get('SNVSTORY_RESOURCE_CACHE'), help="<OPTIONAL> Local directory, shared by the jobs of a host, caching s3 resource folders by prefix and object ETags. Defaults to $SNVSTORY_RESOURCE_CACHE")
+    parser.add_argument('--resource-cache-size', dest='resource_cache_size', type=str, default='64G', help="<OPTIONAL> Size bound of the resource cache, e.g. 64G")
+
+
+# per-process state shared by every file a worker runs
+_WORKER = {}
+
+
+def init_worker(var, results_db=None, cache_dir=None, cache_size='1G', stream=None, publish_dir=None,
+                report_path=None, profile_dir=None, max_memory=None, metrics_dir=None, loader=None, workdir=None):
+    """
+    Set up the resources, results store, prediction cache, result stream,
+    artifact publisher, run report and metrics of this process. With a
+    max_memory budget in bytes multi-sample vcfs run in blocks, see
+    run_chunked_pipeline, with temporary files in workdir. Models load on
+    a ResourceLoader unless one is given, e.g. the parent's.
+    """
+    if report_path:
+        start_report(report_path, profile_dir)
+    if metrics_dir:
+        start_metrics(metrics_dir)
+    _WORKER['var'] = var
+    _WORKER['loader'] = loader if loader is not None else ResourceLoader(var, umap=True)
+    _WORKER['store'] = ResultsStore(results_db, var) if results_db else None
+    _WORKER['cache'] = PredictionCache(cache_dir, parse_size(cache_size)) if cache_dir else None
+    _WORKER['stream'] = ResultStream(stream) if stream else None
+    _WORKER['publisher'] = ArtifactPublisher(publish_dir) if publish_dir else None
+    _WORKER['max_memory'] = max_memory
+    _WORKER['workdir'] = workdir
+
+
+def close_worker():
+    if _WORKER.get('store') is not None:
+        _WORKER['store'].close()
+    if _WORKER.get('stream') is not None:
+        _WORKER['stream'].close()
+    if _WORKER.get('publisher') is not None:
+        _WORKER['publisher'].close()
+    save_counters()
+    _WORKER.clear()
+
+
+def run_file(f, sample_position, mode, genome_ver, outdir, ofn=None, output_format='csv'):
+    """Run the ancestry pipeline on one input file, writing its outputs into outdir."""
+    os.makedirs(outdir, exist_ok=True)
+    try:
+        with span('input', input=os.path.basename(f)):
+            return _run_file(f, sample_position, mode, genome_ver, outdir, ofn, output_format)
+    finally:
+        # the counters of worker processes reach the metrics file input by input
+        save_counters()
+
+
+def _run_file(f, sample_position, mode, genome_ver, outdir, ofn=None, output_format='csv'):
+    with span('header_probe'):
+        multi_sample_status, sample_name = is_vcf_multisample(f, True)
+    print(f'Multisample: {multi_sample_status} and sample name: {sample_name}')
+    if ofn is None:
+        ofn = output_filename(f"{os.path.splitext(f)[0].split('/')[-1]}_{sample_name[0]}", output_format)
+    publisher = _WORKER.get('publisher')
+    try:
+        if multi_sample_status and _WORKER.get('max_memory'):
+            if _WORKER.get('resources') is None:
+                # loaded once per process, before the block size is measured against the budget
+                _WORKER['resources'] = _WORKER['loader'].resource_set()
+            run_chunked_pipeline(vcf_path=f, sample_position=sample_position, var=_WORKER['var'],
+                                 resources=_WORKER['resources'], outdir=outdir, genome_ver=genome_ver, mode=mode,
+                                 ofn=ofn, max_memory=_WORKER['max_memory'], output_format=output_format,
+                                 store=_WORKER['store'], cache=_WORKER['cache'],
+                                 stream=_WORKER.get('stream'), publisher=publisher, workdir=_WORKER.get('workdir'))
+        else:
+            run_ancestry_pipeline(vcf_path=f, multi_sample_status=multi_sample_status,
+                                  sample=sample_name, sample_position=sample_position, var=_WORKER['var'],
+                                  outdir=outdir, genome_ver=genome_ver, mode=mode,
+                                  ofn=ofn, output_format=output_format,
+                                  store=_WORKER['store'], cache=_WORKER['cache'],
+                                  stream=_WORKER.get('stream'), publisher=publisher,
+                                  resources=_WORKER['loader'])
+    finally:
+        published = publisher.wait() if publisher is not None else None
+    if published is not None:
+        # plots published while the file ran are not published again, see publish_outputs
+        record_published(outdir, published)
+    if _WORKER.get('stream') is not None:
+        _WORKER['stream'].flush()
+    return outdir
+
+
+def _run_file_isolated(outdir, task):
+    """run_file that returns the traceback of a failure instead of raising it."""
+    try:
+        run_file(outdir=outdir, **task)
+        return None
+    except Exception:
+        return traceback.format_exc()
+
+
+def run_files(tasks, staging_dir, workers=1, initargs=(), on_done=None):
+    """
+    Run every task (dict of run_file arguments without outdir) either in this process
+    or fanned out to a pool of worker processes. Each file writes into its own
+    staging directory and a failing file does not stop the others.
+
+    on_done(i, staging outdir, error) is called for each task in task order as
+    soon as it and every task before it have finished, so that outputs can be
+    published while later files still run without depending on which worker
+    finished first. Worker processes are forked from this one, so whatever it
+    already loaded, e.g. a ResourceLoader in initargs, is inherited rather
+    than loaded again by every worker.
+
+    returns
+    -------
+    list of (staging outdir, error) in task order; error is None on success
+    """
+    outdirs = [os.path.join(staging_dir, f'{i:05d}') for i in range(len(tasks))]
+    errors = [None] * len(tasks)
+    released = 0
+    if workers <= 1:
+        init_worker(*initargs)
+        for i, task in enumerate(tasks):
+            errors[i] = _run_file_isolated(outdirs[i], task)
+            if on_done is not None:
+                on_done(i, outdirs[i], errors[i])
+        close_worker()
+        return list(zip(outdirs, errors))
+    finished = set()
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('fork'),
+                                                initializer=init_worker, initargs=initargs) as pool:
+        futures = {pool.submit(_run_file_isolated, outdirs[i], task): i for i, task in enumerate(tasks)}
+        for future in concurrent.futures.as_completed(futures):
+            i = futures[future]
+            try:
+                errors[i] = future.result()
+            except Exception:
+                # the worker process itself died, e.g. out of memory
+                errors[i] = traceback.format_exc()
+            print(f"Finished {tasks[i]['f']}{' with errors' if errors[i] else ''}")
+            finished.add(i)
+            while released in finished:
+                if on_done is not None:
+                    on_done(released, outdirs[released], errors[released])
+                released += 1
+    return list(zip(outdirs, errors))
+
+
+def run_checkpointed(tasks, names, checkpoint, out_dir, output_dir, staging_dir, workers=1, initargs=(), stamps=None):
+    """
+    Run the tasks that the checkpoint does not list as complete. The outputs of
+    each input are published to output_dir and recorded in the checkpoint as
+    soon as the input is done, so an interrupted run can resume from there.
+    Inputs complete with the same stamp are skipped without reading them, the
+    others are hashed and skipped when complete with the same content.
+
+    args
+    ----
+    names - stable name of each task's input, e.g. its path relative to the input directory
+    stamps - optional checkpoint.input_stamp of each task's input, None where unknown
+
+    returns
+    -------
+    failed - input files that raised an error
+    """
+    stamps = stamps or [None] * len(tasks)
+    digests = [None] * len(tasks)
+    pending = []
+    for i, task in enumerate(tasks):
+        if stamps[i] is not None and checkpoint.is_complete(names[i], stamp=stamps[i]):
+            continue
+        digests[i] = file_checksum(task['f'])
+        if not checkpoint.is_complete(names[i], digests[i]):
+            pending.append(i)
+    if len(pending) < len(tasks):
+        print(f"Resuming: {len(tasks) - len(pending)} of {len(tasks)} inputs already complete")
+        logging.info(f"Resuming: skipped {[names[i] for i in range(len(tasks)) if i not in pending]}")
+    failed = []
+
+    def on_done(j, staging, error):
+        i = pending[j]
+        if error:
+            failed.append(tasks[i]['f'])
+            logging.error(f"Failed to process {tasks[i]['f']}:\n{error}")
+            print(f"Failed to process {tasks[i]['f']}:\n{error}")
+            return
+        outputs = publish_outputs(staging, out_dir, output_dir)
+        checkpoint.mark_complete(names[i], digests[i], outputs, stamps[i])
+
+    run_files([tasks[i] for i in pending], staging_dir, workers, initargs, on_done)
+    return failed
+
+
+def run_ancestry(argv=None):
     """Parse cli args, download from s3, run the normal pipeline, upload to s3."""
     parser = argparse.ArgumentParser(description='Ancestry Prediction v1.0')
-    parser.add_argument('--path', dest="path", required=True, type=str, help="<REQUIRED> specify the vcf/multi-sample-vcf s3 or local file path or the path to directory containing the file(s)")
+    parser.add_argument('--path', dest="path", required=False, type=str, help="<REQUIRED> specify the vcf/multi-sample-vcf, bcf or PLINK .bed (with its .bim and .fam alongside) s3 or local file path or the path to directory containing the file(s)")
+    parser.add_argument('--manifest', dest='manifest', type=str, default=None, help="<OPTIONAL> s3 or local TSV of VCF path, mode, genome version and sample selection, used instead of --path, --mode and --genome-ver")
+    parser.add_argument('--shard', dest='shard', type=str, default='0/1', help="<OPTIONAL> i/N: process the i-th (zero-based) of N contiguous slices of --manifest and write part-files for 'merge'")
     parser.add_argument('--resource', dest="resource", required=True, type=str, help="<REQUIRED> specify the location of the resource folder")
     parser.add_argument('--sample_pos', dest="sp", required=False, nargs='+', default='all', help="if the input is in a multi-sample vcf format specify which sample to select designated by position in the MultiSample vcf e.g. 1,2,3 ect or all.\nAlternatively you can specify the name of the sample e.g. mother, father, proband")
     parser.add_argument('--logging', dest='logging', type=str, help="<OPTIONAL> provide the output path for the logging file")
-    parser.add_argument('-j', '--vcf_json', required=False, nargs='+', default=None, help="<REQUIRED> provide a json format of the data e.g. 2_238272966_TC:1")
+    parser.add_argument('-j', '--vcf_json', required=False, nargs='+', default=None, help="<OPTIONAL> Genotypes at AIM sites scored without reading a vcf: locus_id:genotype pairs e.g. 2_238272966_T_C:1, inline JSON, or s3/local .json files and .ndjson streams ('-' for stdin) of many samples. Used instead of --path")
     parser.add_argument('--output-dir', dest='output_dir', type=str, required=True, help="<REQUIRED> provide the dir path")
-    parser.add_argument('--genome-ver', dest='genome_ver', type=str, required=True, choices=['37', '38'], default='38', help="<REQUIRED> select a human genome version")
-    parser.add_argument('--mode', dest='mode', type=str, required=True, nargs='+', default='WES', help="<REQUIRED> Mode that sequence allocation analyses were run in. Provide a value for each VCF if multiple VCFs are being submitted.")
+    parser.add_argument('--genome-ver', dest='genome_ver', type=str, required=False, choices=['37', '38'], default=None, help="<REQUIRED> select a human genome version")
+    parser.add_argument('--mode', dest='mode', type=str, required=False, nargs='+', default=None, help="<REQUIRED> Mode that sequence allocation analyses were run in. Provide a value for each VCF if multiple VCFs are being submitted.")
     parser.add_argument('--output_filename', dest='output_filename', type=str, default=None, help="<REQUIRED> File name used for the prediction csv")
-    args = parser.parse_args()
+    parser.add_argument('--results-db', dest='results_db', type=str, default=None, help="<OPTIONAL> Local SQLite results store. Samples whose name and AIM genotypes are already stored are not scored again")
+    parser.add_argument('--cache-dir', dest='cache_dir', type=str, default=None, help="<OPTIONAL> Local directory of cached predictions and embeddings keyed by genotype-vector hash and model checksum")
+    parser.add_argument('--cache-size', dest='cache_size', type=str, default='1G', help="<OPTIONAL> Size bound of the prediction cache, e.g. 512M or 2G")
+    parser.add_argument('--workers', dest='workers', type=int, default=1, help="<OPTIONAL> Number of processes used to run the files of an input directory in parallel")
+    parser.add_argument('--resume', dest='resume', action='store_true', help="<OPTIONAL> Skip inputs recorded as complete, with unchanged content, in the checkpoint manifest of --output-dir")
+    parser.add_argument('--output-format', dest='output_format', type=str, default='csv', choices=list(FORMATS), help="<OPTIONAL> Format of the prediction table: csv, or one typed column per model label as parquet or arrow (IPC)")
+    parser.add_argument('--profile', dest='profile', action='store_true', help="<OPTIONAL> Also dump cProfile stats of every stage into <output-dir>/profiles/, see the run report")
+    parser.add_argument('--max-memory', dest='max_memory', type=str, default=None, help="<OPTIONAL> Memory budget of the run, e.g. 8G, shared evenly by the workers. Multi-sample vcfs are streamed in blocks of samples sized to stay under it; the records at AIMs are copied once to the workspace and re-read per block, a BCF is re-read per block")
+    parser.add_argument('--metrics-file', dest='metrics_file', type=str, default=None, help="<OPTIONAL> Local OpenMetrics file written at the end of the run, e.g. into the node_exporter textfile collector directory")
+    parser.add_argument('--metrics-interval', dest='metrics_interval', type=float, default=0, help="<OPTIONAL> Also rewrite --metrics-file every this many seconds while the run is going")
+    parser.add_argument('--stream', dest='stream', type=str, default=None, help="<OPTIONAL> Emit one NDJSON line of normalized probabilities per sample as soon as it is scored, to '-' (stdout, other messages then go to stderr), a local file or an s3 prefix")
+    add_model_args(parser)
+    add_resource_cache_args(parser)
+    args = parser.parse_args(argv)
+    if args.stream == '-':
+        # stdout carries the result lines only
+        sys.stdout = sys.stderr
+    if not (args.path or args.manifest or args.vcf_json):
+        parser.error("one of --path, --manifest or --vcf_json is required")
+    if (args.path or args.vcf_json) and (args.genome_ver is None or args.mode is None):
+        parser.error("--genome-ver and --mode are required with --path and --vcf_json")
     """
     Argument Paths:
     Example command:
@@ -100,86 +377,199 @@ def run_ancestry():
     os.makedirs(RSRC_DIR)
     OUT_DIR = f"/{DATA_DIR}/output/"
     os.makedirs(OUT_DIR)
+    # timing and memory spans of every stage, written as the run report next to the outputs
+    started = time.time()
+    SPANS_FILE = f"{DATA_DIR}/run_spans.ndjson"
+    PROFILE_DIR = f"{DATA_DIR}/profiles/" if args.profile else None
+    start_report(SPANS_FILE, PROFILE_DIR)
+    report_name = REPORT
+    METRICS_DIR = f"{DATA_DIR}/metrics/" if args.metrics_file else None
+    exporter = None
+    if METRICS_DIR:
+        start_metrics(METRICS_DIR)
+        if args.metrics_interval > 0:
+            exporter = MetricsExporter(lambda: write_metrics(args.metrics_file, METRICS_DIR, summarize(read_spans(SPANS_FILE)), started),
+                                       args.metrics_interval)
 
     logging.info("Executing Ancestry Pipeline")
 
+    # Download resource folder e.g. models
+    try:
+        with span('download', input='resources'):
+            RSRC_DIR = fetch_resources(args.resource, RSRC_DIR, args.resource_cache, args.resource_cache_size, args.models)
+    except Exception:
+        logging.debug(f"Resource folder: {args.resource} does not appear to be local or an s3 input")
+        print(f"Resource folder: {args.resource} does not appear to be local or an s3 input")
+        raise RuntimeError
+
+    var = variables(RSRC_DIR)
+    if args.models:
+        var.select_models(args.models)
+    check_resources(var)
+    # the models load in the background while the inputs are downloaded and probed
+    loader = ResourceLoader(var, umap=True)
+
     # determine extension
-    file_extz = get_extension(args.path)
+    file_extz = get_extension(args.path) if args.path else 'manifest'
+    if args.vcf_json:
+        file_extz = 'vcf_json'
+
+    # the checkpoint of a resumed run is read before any input is fetched, so that inputs it lists as complete
+    # with the same stamp (s3 ETag and size, or local size and mtime) are neither downloaded nor hashed
+    checkpoint_name = MANIFEST
+    if args.manifest:
+        shard_i, shard_n = parse_shard(args.shard)
+        checkpoint_name = f'snvstory_checkpoint.part-{shard_i:05d}-of-{shard_n:05d}.json'
+        report_name = f'snvstory_run_report.part-{shard_i:05d}-of-{shard_n:05d}.json'
+    # outputs are published per input into <output-dir>/output/ next to the checkpoint manifest
+    checkpoint = Checkpoint(args.output_dir, DATA_DIR, checkpoint_name)
+    if args.resume:
+        checkpoint.load()
 
     # placeholders
     local_vcf_file = ''
     local_vcf_dir = ''
+    stamps = {}
 
-    if file_extz != 'dir':
-        # Attempt to download single input from s3
-        try:
-            local_vcf_file = flex_input(args.path)
-            logging.debug(f"Input VCF success. File size: {os.path.getsize(local_vcf_file)}")
-            print(f"Input VCF success. File size: {os.path.getsize(local_vcf_file)}")
-        except Exception:
-            logging.debug(f"Input file: {args.path} does not appear to be local or s3 input.")
-            print(f"Input file: {args.path} does not appear to be local or s3 input.")
+    if file_extz in ('manifest', 'vcf_json'):
+        pass
+    elif file_extz != 'dir':
+        stamps[os.path.basename(args.path)] = input_stamp(args.path)
+        if checkpoint.is_complete(os.path.basename(args.path), stamp=stamps[os.path.basename(args.path)]):
+            # skipped by run_checkpointed without being read
+            local_vcf_file = args.path
+        else:
+            # Attempt to download single input from s3
+            try:
+                with span('download', input=os.path.basename(args.path)):
+                    local_vcf_file = fetch_input(args.path)
+                logging.debug(f"Input VCF success. File size: {os.path.getsize(local_vcf_file)}")
+                print(f"Input VCF success. File size: {os.path.getsize(local_vcf_file)}")
+            except Exception:
+                logging.debug(f"Input file: {args.path} does not appear to be local or s3 input.")
+                print(f"Input file: {args.path} does not appear to be local or s3 input.")
     else:
         # Attempt to download directory from s3
         try:
-            local_vcf_dir = flex_input(args.path, INPUT_DIR, directory=True)
-            logging.debug(f"Input VCF directory success. Directory size: {os.path.getsize(INPUT_DIR)}") # this doesn't give the size of the files in directory rn
-            print(f"Input VCF directory success. Directory size: {os.path.getsize(INPUT_DIR)}")
+            with span('download', input=os.path.basename(args.path.rstrip('/'))):
+                if args.path.startswith('s3://'):
+                    bucket, prefix = validate_s3_path(args.path)
+                    prefix = f"{prefix.rstrip('/')}/" if prefix.strip('/') else ''
+                    objects = {x['Key'][len(prefix):]: x for x in list_s3_objects(f's3://{bucket}/{prefix}')}
+                    stamps = {name: input_stamp(f's3://{bucket}/{obj["Key"]}', obj) for name, obj in objects.items() if '/' not in name}
+                    # complete inputs, with the .bim and .fam of complete PLINK filesets, stay on s3
+                    exclude = set()
+                    for name in filter_extension(stamps):
+                        if checkpoint.is_complete(name, stamp=stamps[name]):
+                            exclude.add(name)
+                            if name.endswith(PLINK_EXTENSIONS):
+                                exclude.update(plink_prefix(name) + ext for ext in ('.bim', '.fam'))
+                    local_vcf_dir = os.path.join(INPUT_DIR, os.path.basename(args.path))
+                    download_s3_directory(args.path, local_vcf_dir, exclude)
+                    listing = list(stamps)
+                else:
+                    local_vcf_dir = flex_input(args.path, INPUT_DIR, directory=True)
+                    listing = os.listdir(local_vcf_dir)
+                    stamps = {name: input_stamp(os.path.join(local_vcf_dir, name)) for name in listing}
+            logging.debug(f"Input VCF directory success. Directory size: {os.path.getsize(local_vcf_dir)}") # this doesn't give the size of the files in directory rn
+            print(f"Input VCF directory success. Directory size: {os.path.getsize(local_vcf_dir)}")
         except Exception:
             logging.debug(f"Directory: {args.path} does not appear to be local or an s3 input")
             print(f"Directory: {args.path} does not appear to be local or an s3 input")
             raise RuntimeError
 
-    # Download resource folder e.g. models
-    try:
-        RSRC_DIR = flex_input(args.resource, RSRC_DIR, directory=True)
-    except Exception:
-        logging.debug(f"Resource folder: {args.resource} does not appear to be local or an s3 input")
-        print(f"Resource folder: {args.resource} does not appear to be local or an s3 input")
-        raise RuntimeError
-
-    var = variables(RSRC_DIR)
-    check_resources(var)
+    worker_args = (var, args.results_db, args.cache_dir, args.cache_size, args.stream, os.path.join(args.output_dir, 'output'),
+                   SPANS_FILE, PROFILE_DIR, parse_size(args.max_memory) // max(args.workers, 1) if args.max_memory else None,
+                   METRICS_DIR, loader, DATA_DIR)
 
     # Determine if the file is multi-sampled or single
     if local_vcf_dir:
         print(f'Expected input: {args.path} is a directory')
-        local_vcf_dir = [os.path.join(INPUT_DIR, x) for x in os.listdir(local_vcf_dir)]
-        local_vcf_dir = filter_extension(local_vcf_dir)
-        if len(args.sp) != len(local_vcf_dir):
+        names = sorted(filter_extension(listing))
+        # sorted so that outputs do not depend on directory listing order
+        local_vcf_dir = [os.path.join(local_vcf_dir, x) for x in names]
+        if args.sp == 'all' or len(args.sp) != len(local_vcf_dir):
             if args.sp != 'all':
                 print(f"Length of 'sample_pos' is not equal to the number of relevant input VCFs. Analyzing all samples.")
             sp = ['all'] * len(local_vcf_dir)
         else:
             sp = args.sp
-        for i, f in enumerate(local_vcf_dir):
-            multi_sample_status, sample_name = is_vcf_multisample(f, True)
-            if args.output_filename is None:
-                ofn = f"{os.path.splitext(f)[0].split('/')[-1]}_{sample_name[0]}.csv"
-            else:
-                ofn = args.output_filename
-            print(f'Multisample: {multi_sample_status} and sample name: {sample_name}')
-
-            run_ancestry_pipeline(vcf_path=f, multi_sample_status=multi_sample_status,
-                                  sample=sample_name, sample_position=sp, var=var,
-                                  outdir=OUT_DIR, genome_ver=args.genome_ver, mode=args.mode[i],
-                                  ofn=ofn)
-        flex_output(OUT_DIR, args.output_dir)
+        tasks = [dict(f=f, sample_position=sp[i], mode=args.mode[i], genome_ver=args.genome_ver,
+                      ofn=args.output_filename, output_format=args.output_format)
+                 for i, f in enumerate(local_vcf_dir)]
 
     elif local_vcf_file:
         print(f'Expected input: {local_vcf_file} is a file')
-        multi_sample_status, sample_name = is_vcf_multisample(local_vcf_file, True)
-        print(f'Multisample: {multi_sample_status} and sample name: {sample_name[0]}')
-        if args.output_filename is None:
-            ofn = f"{os.path.splitext(local_vcf_file)[0].split('/')[-1]}_{sample_name[0]}.csv"
-        else:
-            ofn = args.output_filename
+        names = [os.path.basename(local_vcf_file)]
+        tasks = [dict(f=local_vcf_file, sample_position=args.sp, mode=args.mode[0], genome_ver=args.genome_ver,
+                      ofn=args.output_filename, output_format=args.output_format)]
+    elif args.manifest:
+        # each shard downloads and runs only its own slice of the manifest
+        rows = shard_rows(read_manifest(flex_input(args.manifest, DATA_DIR)), shard_i, shard_n)
+        print(f'Manifest shard {shard_i}/{shard_n}: {len(rows)} rows')
+        os.makedirs(INPUT_DIR, exist_ok=True)
+        names, tasks, sources = [], [], []
+        for idx, row in rows:
+            name = f"{idx:06d}_{os.path.basename(row['path'])}"
+            names.append(name)
+            stamps[name] = input_stamp(row['path'])
+            if checkpoint.is_complete(name, stamp=stamps[name]):
+                local_path = row['path']
+            else:
+                with span('download', input=os.path.basename(row['path'])):
+                    local_path = fetch_input(row['path'], INPUT_DIR, prepend_hash=True)
+            tasks.append(dict(f=local_path, sample_position=row['samples'],
+                              mode=row['mode'], genome_ver=row['genome_ver'],
+                              ofn=output_filename(f'row-{idx:06d}', args.output_format), output_format=args.output_format))
+            sources.append(row['path'])
+    else:
+        names, tasks = [], []
+
+    if args.vcf_json:
+        # genotypes given directly go straight to encoding and scoring, without any vcf to read
+        os.makedirs(INPUT_DIR, exist_ok=True)
+        values = [flex_input(x, INPUT_DIR) if x.startswith('s3://') else x for x in args.vcf_json]
+        ofn = args.output_filename or output_filename('vcf_json', args.output_format)
+        init_worker(*worker_args)
+        try:
+            with span('input', input='vcf_json'):
+                n_samples = run_genotype_pipeline(parse_genotype_json(values), var, loader.resource_set(), OUT_DIR,
+                                                  args.genome_ver, args.mode[0], ofn, args.output_format,
+                                                  store=_WORKER['store'], cache=_WORKER['cache'], stream=_WORKER['stream'])
+        finally:
+            close_worker()
+        print(f'Scored {n_samples} samples of --vcf_json')
+        publish_file(os.path.join(OUT_DIR, ofn), os.path.join(args.output_dir, 'output'))
+
+    shared = None
+    if args.workers > 1:
+        # workers forked after loading share the models: large arrays in shared memory, the rest frozen copy-on-write
+        shared = SharedArrays()
+        with span('resources'):
+            moved = loader.share(shared)
+        print(f'Sharing {moved >> 20} MiB of model arrays with {args.workers} workers')
+        gc.freeze()
+    try:
+        failed = run_checkpointed(tasks, names, checkpoint, OUT_DIR, os.path.join(args.output_dir, 'output'),
+                                  f"{DATA_DIR}/staging/", workers=args.workers, initargs=worker_args,
+                                  stamps=[stamps.get(name) for name in names])
+    finally:
+        if shared is not None:
+            gc.unfreeze()
+            shared.unlink()
 
-        run_ancestry_pipeline(vcf_path=local_vcf_file, multi_sample_status=multi_sample_status,
-                              sample=sample_name, sample_position=args.sp, var=var,
-                              outdir=OUT_DIR, genome_ver=args.genome_ver, mode=args.mode[0],
-                              ofn=ofn)
-        flex_output(OUT_DIR, args.output_dir)
+    if args.manifest and not failed:
+        # combine the tables of this shard's rows into its part-file
+        tables = []
+        for task in tasks:
+            table = os.path.join(OUT_DIR, task['ofn'])
+            if not os.path.exists(table):
+                # completed by an earlier run that was resumed
+                table = flex_input(os.path.join(args.output_dir, 'output', task['ofn']), INPUT_DIR)
+            tables.append(table)
+        part = merge_results(tables, os.path.join(DATA_DIR, part_name(shard_i, shard_n, args.output_format)), var,
+                             args.output_format, sources)
+        publish_file(part, os.path.join(args.output_dir, 'parts'))
 
     logging.debug(f"Completed")
     try:
@@ -188,4 +578,222 @@ def run_ancestry():
     except Exception:
         pass
 
+    report = write_report(SPANS_FILE, os.path.join(DATA_DIR, report_name), started, inputs=len(tasks), failed=failed)
+    if METRICS_DIR:
+        if exporter is not None:
+            exporter.stop()
+        write_metrics(args.metrics_file, METRICS_DIR, summarize(read_spans(SPANS_FILE)), started,
+                      {'completed': len(tasks) - len(failed), 'failed': len(failed)})
+    publish_file(report, args.output_dir)
+    if PROFILE_DIR:
+        for name in sorted(os.listdir(PROFILE_DIR)):
+            publish_file(os.path.join(PROFILE_DIR, name), os.path.join(args.output_dir, 'profiles'))
+
+    if failed:
+        raise RuntimeError(f"{len(failed)} input files failed: {failed}")
+
+
+def run_merge(argv=None):
+    """Combine the part-files written by the shards of a manifest run into one results table."""
+    parser = argparse.ArgumentParser(prog='merge', description='Merge SNVstory part-files into one results table')
+    parser.add_argument('--parts', dest='parts', required=True, nargs='+', help="<REQUIRED> s3 or local part-files, or directories containing them, e.g. <output-dir>/parts/")
+    parser.add_argument('--output', dest='output', required=True, type=str, help="<REQUIRED> s3 or local path of the merged results table")
+    parser.add_argument('--output-format', dest='output_format', type=str, default=None, choices=list(FORMATS), help="<OPTIONAL> Format of the merged table, defaults to the extension of --output")
+    args = parser.parse_args(argv)
+
+    DATA_DIR = setup_workspace()
+    output_format = args.output_format
+    if output_format is None:
+        output_format = next((k for k, v in FORMATS.items() if args.output.endswith(v)), 'csv')
+    paths = []
+    for i, path in enumerate(args.parts):
+        if path.startswith('s3://'):
+            local_dir = os.path.join(DATA_DIR, f'parts{i}')
+            os.makedirs(local_dir)
+            path = flex_input(path, local_dir, directory=not path.endswith(tuple(FORMATS.values())))
+        paths.append(path)
+    parts = find_parts(paths)
+    print(f'Merging {len(parts)} part-files into {args.output}')
+    # the part-file layout only depends on the model labels, not on resource paths;
+    # parts of a --models run hold only the selected models
+    var = variables(DATA_DIR)
+    if parts:
+        var.select_models(results_models(parts[0], var))
+    out_path = merge_results(parts, os.path.join(DATA_DIR, os.path.basename(args.output)), var, output_format)
+    flex_output(out_path, os.path.dirname(args.output) or '.')
+
+
+def run_serve(argv=None):
+    """Load every model once and serve predictions over HTTP or a unix socket until interrupted."""
+    parser = argparse.ArgumentParser(prog='serve', description='SNVstory prediction service')
+    parser.add_argument('--resource', dest='resource', required=True, type=str, help="<REQUIRED> specify the location of the resource folder")
+    parser.add_argument('--host', dest='host', type=str, default='127.0.0.1', help="<OPTIONAL> Interface to listen on")
+    parser.add_argument('--port', dest='port', type=int, default=8080, help="<OPTIONAL> TCP port to listen on")
+    parser.add_argument('--socket', dest='socket', type=str, default=None, help="<OPTIONAL> Listen on this unix socket path instead of TCP")
+    parser.add_argument('--genome-ver', dest='genome_ver', type=str, choices=['37', '38'], default='38', help="<OPTIONAL> Genome version of requests that do not give one")
+    parser.add_argument('--mode', dest='mode', type=str, choices=['WES', 'WGS'], default='WES', help="<OPTIONAL> Sequencing mode of requests that do not give one")
+    parser.add_argument('--batch-size', dest='batch_size', type=int, default=64, help="<OPTIONAL> Maximum number of samples scored together")
+    parser.add_argument('--batch-wait-ms', dest='batch_wait_ms', type=float, default=10, help="<OPTIONAL> Milliseconds to wait for more requests before scoring a batch")
+    parser.add_argument('--queue-size', dest='queue_size', type=int, default=256, help="<OPTIONAL> Maximum number of waiting requests; further requests get 503")
+    parser.add_argument('--vcf-root', dest='vcf_root', type=str, default=None, help="<OPTIONAL> Directory the vcf paths of requests must resolve into; without it only genotype requests are served")
+    parser.add_argument('--max-encoding', dest='max_encoding', type=int, default=4, help="<OPTIONAL> Maximum number of requests parsed and encoded at once")
+    parser.add_argument('--cache-dir', dest='cache_dir', type=str, default=None, help="<OPTIONAL> Local directory of cached predictions keyed by genotype-vector hash and model checksum")
+    parser.add_argument('--cache-size', dest='cache_size', type=str, default='1G', help="<OPTIONAL> Size bound of the prediction cache, e.g. 512M or 2G")
+    parser.add_argument('--logging', dest='logging', type=str, default=None, help="<OPTIONAL> Local path of the service log")
+    add_model_args(parser)
+    add_resource_cache_args(parser)
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(filename=args.logging, level=logging.INFO, format="%(asctime)s:%(levelname)s:%(message)s")
+    DATA_DIR = setup_workspace()
+    RSRC_DIR = f"{DATA_DIR}/resources/"
+    os.makedirs(RSRC_DIR)
+    RSRC_DIR = fetch_resources(args.resource, RSRC_DIR, args.resource_cache, args.resource_cache_size, args.models)
+    cache = PredictionCache(args.cache_dir, parse_size(args.cache_size)) if args.cache_dir else None
+    predictor = AncestryPredictor(RSRC_DIR, args.genome_ver, args.mode, cache, args.models)
+    batcher = PredictionBatcher(predictor, args.batch_size, args.batch_wait_ms / 1000, args.queue_size)
+    server = make_server(batcher, args.host, args.port, args.socket, vcf_root=args.vcf_root,
+                         max_encoding=args.max_encoding)
+    print(f"Serving {len(predictor.models)} models on {args.socket or f'http://{args.host}:{args.port}'}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        batcher.close()
+
+
+def run_warmup(argv=None):
+    """
+    Compile the package bytecode and the numba kernels of every continental UMAP
+    into persistent caches, e.g. at image build, then time the same stages in a
+    fresh process to report the cold-start time the caches save.
+    """
+    parser = argparse.ArgumentParser(prog='warmup', description='Precompile SNVstory bytecode and numba/UMAP caches')
+    parser.add_argument('--resource', dest='resource', type=str, default=None, help="<OPTIONAL> s3 or local resource folder whose continental UMAP fits are warmed; without it only bytecode and imports are warmed")
+    parser.add_argument('--numba-cache-dir', dest='numba_cache_dir', type=str, default=os.environ.get('NUMBA_CACHE_DIR'), help="<OPTIONAL> Persistent numba cache directory, defaults to $NUMBA_CACHE_DIR")
+    parser.add_argument('--skip-compile', dest='skip_compile', action='store_true', help="<OPTIONAL> Do not precompile the package bytecode")
+    parser.add_argument('--no-verify', dest='no_verify', action='store_true', help="<OPTIONAL> Do not time the stages again in a fresh process")
+    parser.add_argument('--report', dest='report', type=str, default=None, help="<OPTIONAL> Local path of a JSON report of the stage timings")
+    add_resource_cache_args(parser)
+    args = parser.parse_args(argv)
+
+    # numba reads its cache location when it is first imported
+    if args.numba_cache_dir:
+        os.makedirs(args.numba_cache_dir, exist_ok=True)
+        os.environ['NUMBA_CACHE_DIR'] = args.numba_cache_dir
+    else:
+        print('NUMBA_CACHE_DIR is not set, compiled kernels are cached next to the umap sources if writable')
+    var = None
+    if args.resource:
+        DATA_DIR = setup_workspace()
+        RSRC_DIR = f"{DATA_DIR}/resources/"
+        os.makedirs(RSRC_DIR)
+        RSRC_DIR = fetch_resources(args.resource, RSRC_DIR, args.resource_cache, args.resource_cache_size)
+        var = variables(RSRC_DIR)
+    report = {'numba_cache_dir': args.numba_cache_dir, 'cold': run_stages(var, not args.skip_compile)}
+
+    if args.no_verify:
+        print(json.dumps(report['cold'], indent=1))
+    else:
+        # a new process only benefits from what was persisted to the caches
+        warm_report = os.path.join(tempfile.mkdtemp(), 'warm.json')
+        cmd = [sys.executable, '-m', 'igm_churchill_ancestry', 'warmup', '--no-verify', '--report', warm_report]
+        cmd += ['--resource', RSRC_DIR] if var is not None else []
+        cmd += ['--skip-compile'] if args.skip_compile else []
+        # the child imports this same copy of the package, installed or not
+        package_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [package_root, os.environ.get('PYTHONPATH')])))
+        subprocess.run(cmd, check=True, stdout=subprocess.DEVNULL, env=env)
+        with open(warm_report, 'r') as fin:
+            report['warm'] = json.load(fin)['cold']
+        report['saved'] = {stage: saved for stage, _, _, saved in savings(report['cold'], report['warm'])}
+        print(format_savings(savings(report['cold'], report['warm'])))
+    if args.report:
+        with open(args.report, 'w') as fout:
+            json.dump(report, fout, indent=1)
+
+
+def run_benchmark(argv=None):
+    """
+    Time the stages of the pipeline on synthetic vcfs and a miniature resource
+    folder, optionally failing on regressions against an earlier report.
+    """
+    parser = argparse.ArgumentParser(prog='benchmark', description='Benchmark SNVstory on synthetic inputs')
+    parser.add_argument('--workdir', dest='workdir', type=str, default=None, help="<OPTIONAL> Local directory of the generated resources, vcfs and outputs, defaults to a new temporary directory")
+    parser.add_argument('--samples', dest='samples', type=int, nargs='+', default=[1, 100], help="<OPTIONAL> Sample counts of the generated vcfs, e.g. 1 100 10000")
+    parser.add_argument('--mode', dest='mode', type=str, nargs='+', choices=['WES', 'WGS'], default=['WES'], help="<OPTIONAL> WES vcfs have 10 and WGS vcfs 100 background variants per ancestry informative site")
+    parser.add_argument('--compression', dest='compression', type=str, nargs='+', choices=['plain', 'gz', 'bgzip'], default=['plain'], help="<OPTIONAL> Compression of the generated vcfs")
+    parser.add_argument('--gvcf', dest='gvcf', action='store_true', help="<OPTIONAL> Generate gVCFs with reference blocks")
+    parser.add_argument('--genome-ver', dest='genome_ver', type=str, choices=['37', '38'], default='38', help="<OPTIONAL> Genome version of the generated vcfs")
+    parser.add_argument('--aims', dest='aims', type=int, default=200, help="<OPTIONAL> Ancestry informative loci per model")
+    parser.add_argument('--plots', dest='plots', action='store_true', help="<OPTIONAL> Also fit UMAPs and time the plots")
+    parser.add_argument('--repeat', dest='repeat', type=int, default=1, help="<OPTIONAL> Runs per case, the fastest is reported")
+    parser.add_argument('--output', dest='output', type=str, default=None, help="<OPTIONAL> Local path of the JSON benchmark report")
+    parser.add_argument('--baseline', dest='baseline', type=str, default=None, help="<OPTIONAL> Earlier JSON benchmark report to compare with; regressions exit with status 1")
+    parser.add_argument('--tolerance', dest='tolerance', type=float, default=0.2, help="<OPTIONAL> Fraction a stage may slow down before it is a regression")
+    args = parser.parse_args(argv)
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix='snvstory_benchmark_')
+    compressions = [None if x == 'plain' else x for x in args.compression]
+    report = run_benchmarks(workdir, args.samples, args.mode, compressions, args.gvcf, args.genome_ver,
+                            args.aims, args.plots, args.repeat)
+    print(format_report(report))
+    if args.output:
+        with open(args.output, 'w') as fout:
+            json.dump(report, fout, indent=1)
+    if args.baseline:
+        with open(args.baseline, 'r') as fin:
+            regressions = compare(json.load(fin), report, args.tolerance)
+        for name, stage, before, after in regressions:
+            print(f'Regression {name} {stage}: {before:.3f}s -> {after:.3f}s')
+        if regressions:
+            sys.exit(1)
+
+
+def run_equivalence_check(argv=None):
+    """
+    Check that the alternative engines of the pipeline produce the sparse
+    matrices and probabilities of the reference path, on synthetic cases or
+    on a given vcf and resource folder. Differences exit with status 1.
+    """
+    parser = argparse.ArgumentParser(prog='equivalence', description='Check SNVstory engines against the reference path')
+    parser.add_argument('--engines', dest='engines', type=str, nargs='+', choices=sorted(ENGINES), default=None, help="<OPTIONAL> Engines to check, defaults to all")
+    parser.add_argument('--cases', dest='cases', type=str, nargs='+', choices=list(CASES), default=None, help="<OPTIONAL> Synthetic cases to check, defaults to all")
+    parser.add_argument('--workdir', dest='workdir', type=str, default=None, help="<OPTIONAL> Local directory of the generated resources and vcfs, defaults to a new temporary directory")
+    parser.add_argument('--samples', dest='samples', type=int, default=8, help="<OPTIONAL> Samples per generated vcf")
+    parser.add_argument('--aims', dest='aims', type=int, default=100, help="<OPTIONAL> Ancestry informative loci per model")
+    parser.add_argument('--mode', dest='mode', type=str, choices=['WES', 'WGS'], default='WES', help="<OPTIONAL> Sequencing mode of the inputs")
+    parser.add_argument('--tolerance', dest='tolerance', type=float, default=1e-6, help="<OPTIONAL> Absolute tolerance of probabilities")
+    parser.add_argument('--vcf', dest='vcf', type=str, default=None, help="<OPTIONAL> Check a local vcf against --resource instead of the synthetic cases")
+    parser.add_argument('--resource', dest='resource', type=str, default=None, help="<OPTIONAL> Local resource folder of --vcf")
+    parser.add_argument('--genome-ver', dest='genome_ver', type=str, choices=['37', '38'], default='38', help="<OPTIONAL> Genome version of --vcf")
+    add_model_args(parser)
+    args = parser.parse_args(argv)
+
+    if args.vcf:
+        if not args.resource:
+            parser.error('--vcf needs --resource')
+        var = variables(args.resource)
+        if args.models:
+            var.select_models(args.models)
+        check_resources(var)
+        report = {os.path.basename(args.vcf): check_engines(var, args.vcf, args.genome_ver, args.mode, args.engines, args.tolerance)}
+    else:
+        workdir = args.workdir or tempfile.mkdtemp(prefix='snvstory_equivalence_')
+        report = run_equivalence(workdir, args.engines, args.cases, args.samples, args.mode, args.aims, args.tolerance)
+    print(format_equivalence(report))
+    if any(diffs for engines in report.values() for diffs in engines.values()):
+        sys.exit(1)
+
+
+# subcommands dispatched on the first argument; anything else runs the pipeline
+COMMANDS = {'benchmark': run_benchmark, 'equivalence': run_equivalence_check, 'merge': run_merge, 'serve': run_serve, 'warmup': run_warmup}
+
 
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    if argv and argv[0] in COMMANDS:
+        return COMMANDS[argv[0]](argv[1:])
+    return run_ancestry(argv)
@@ -1,17 +1,21 @@
-from igm_churchill_ancestry.utilities.parsing import parse_vcf, parse_multisample_vcf_sample, parse_multisample_vcf
+from igm_churchill_ancestry.utilities.parsing import parse_vcf, parse_multisample_vcf_sample, parse_multisample_vcf, parse_genotypes
 from igm_churchill_ancestry.utilities.vcf2sparse import vcf_to_json, load_snp_order, json_to_sparse_matrix
 from igm_churchill_ancestry.utilities.utilities import get_file_handle
+from igm_churchill_ancestry.utilities.plink import PLINK_EXTENSIONS, plink_header, parse_plink
+from igm_churchill_ancestry.utilities.bcf import BCF_EXTENSIONS, bcf_header, parse_bcf
 from igm_churchill_ancestry.utilities.plot_ancestry import plot_parser
+from igm_churchill_ancestry.utilities.writers import get_writer
 from igm_churchill_ancestry.utilities.plot_umap import plot_umap_parser
+from igm_churchill_ancestry.utilities.results import AncestryResults
+from igm_churchill_ancestry.utilities.store import genotype_hash
+from igm_churchill_ancestry.utilities.cache import model_checksum, row_hashes
+from igm_churchill_ancestry.utilities.stream import sample_records
+from igm_churchill_ancestry.utilities.run_report import span
+from igm_churchill_ancestry.utilities.metrics import inc
 # from igm_churchill_ancestry.utilities.sgdp_knn import sgdp_knn
-import pandas as pd
 import pickle
-import xgboost as xgb
 import numpy as np
-import scipy
-from scipy import sparse
 import glob
-import umap
 import os
 
 ## Sklearn falsely warns about unpickling an estimator from a version other than what was used to build the model.
@@ -19,6 +23,73 @@ import warnings
 warnings.filterwarnings('ignore', category=UserWarning, append=True)
 
 
+MODEL_FILES = {'xgb': '*.bin', 'svm': '*.p'}
+# samples scored and emitted together when results are streamed
+STREAM_BLOCK = 64
+# samples scored and written together otherwise
+WRITE_BLOCK = 1024
+# binary inputs: extensions -> (header lines naming the samples, reader of the loci and genotype codes at some loci)
+BINARY_READERS = {PLINK_EXTENSIONS: (plink_header, parse_plink), BCF_EXTENSIONS: (bcf_header, parse_bcf)}
+
+
+def load_model(ml_dir, model_type='xgb'):
+    """
+    Deserialize the classifier of a model directory, a gradient boosted
+    tree booster (xgb) or a pickled sklearn SVM (svm).
+
+    returns
+    -------
+    model - xgb.Booster or sklearn classifier, None if it cannot be loaded
+    """
+    model_path = glob.glob(ml_dir + '/' + MODEL_FILES[model_type])[0]
+    try:
+        if model_type == 'xgb':
+            import xgboost as xgb
+            model = xgb.Booster({'nthread': 1})  # static
+            model.load_model(model_path)
+        else:
+            with open(model_path, 'rb') as fin:
+                model = pickle.load(fin)
+    except Exception as e:
+        print(f'Cannot load model, check path: {model_path}. {e}')
+        return
+    return model
+
+
+def predict_proba(model, s_matrix, n_classes, model_type='xgb'):
+    """
+    Probabilities of a loaded model for every row of s_matrix.
+
+    returns
+    -------
+    yprob - a numpy array of the probabilities, one row per sample
+    """
+    from scipy import sparse
+    if model_type == 'xgb':
+        import xgboost as xgb
+        # Sparse and numpy matrix needs to be converted
+        if isinstance(s_matrix, xgb.core.DMatrix):
+            dtest = s_matrix
+        else:
+            try:
+                dtest = xgb.DMatrix(s_matrix, label=np.zeros(s_matrix.shape[0]))
+            except Exception as e:
+                print(f'Cannot coerce data. Check sparse matrix: {e}')
+                return
+        return model.predict(dtest).reshape(s_matrix.shape[0], n_classes)
+
+    # Sparse and numpy matrix needs to be converted
+    if isinstance(s_matrix, sparse.csr_matrix):
+        dtest = s_matrix
+    else:
+        print(f'Cannot coerce data. Check sparse matrix: {s_matrix}')
+        return
+    try:
+        return model.predict_proba(dtest).reshape(s_matrix.shape[0], n_classes)
+    except ValueError:
+        return model.predict_proba(dtest.A).reshape(s_matrix.shape[0], n_classes)
+
+
 def predict_ancestry(s_matrix, ml_dir, n_classes, model_type='xgb'):
     """
     Predicts ancestry at different geographic resolution
@@ -39,129 +110,246 @@ def predict_ancestry(s_matrix, ml_dir, n_classes, model_type='xgb'):
     ylabel - the numeric label that maps to the ancestral label
 
     """
-    if model_type == 'xgb':
-        # Prep the model
-        model_path = glob.glob(ml_dir + '/*.bin')[0]
-        bst = xgb.Booster({'nthread': 1})  # static
-        try:
-            bst.load_model(model_path)
-        except Exception as e:
-            print(f'Cannot load model, check path: {model_path}. {e}')
-            return
-        # Sparse and numpy matrix needs to be converted
-        if isinstance(s_matrix, xgb.core.DMatrix):
-            dtest = s_matrix
-        else:
-            try:
-                dtest = xgb.DMatrix(s_matrix, label=np.zeros(s_matrix.shape[0]))
-            except Exception as e:
-                print(f'Cannot coerce data. Check sparse matrix: {e}')
-                return
+    model = load_model(ml_dir, model_type)
+    if model is None:
+        return
+    yprob = predict_proba(model, s_matrix, n_classes, model_type)
+    if yprob is None:
+        return
+    ylabel = np.argmax(yprob, axis=1)[0]
+    return (yprob, ylabel)
 
-        yprob = bst.predict(dtest).reshape(s_matrix.shape[0], n_classes)
-        ylabel = np.argmax(yprob, axis=1)[0]
 
-    elif model_type == 'svm':
-        # Prep the model
-        model_path = glob.glob(ml_dir + '/*.p')[0]
-        try:
-            with open(model_path, 'rb') as fin:
-                clf = pickle.load(fin)
-        except Exception as e:
-            print(f'Cannot load model, check path: {model_path}. {e}')
-            return
-        # Sparse and numpy matrix needs to be converted
-        if isinstance(s_matrix, scipy.sparse.csr.csr_matrix):
-            dtest = s_matrix
+def predict_model(s_matrix, ml_dir, n_classes, m_type, cache=None, model=None):
+    """
+    Dispatch to the model type used by m_type; gnomAD models are
+    gradient boosted trees and the remaining models are SVMs. Identical
+    rows of s_matrix are predicted once, and rows found in the prediction
+    cache are not predicted at all. An already loaded model is used
+    instead of reading it from ml_dir.
+
+    returns
+    -------
+    yprob - a numpy array of the probabilities, one row per sample
+    """
+    model_type = 'xgb' if 'gnomAD' in m_type else 'svm'
+    unique, first, inverse = np.unique(row_hashes(s_matrix), return_index=True, return_inverse=True)
+    yprob = np.zeros((len(unique), n_classes), dtype=np.float32)
+    missing = list(range(len(unique)))
+    if cache is not None:
+        checksum = model_checksum(ml_dir, MODEL_FILES[model_type])
+        keys = [cache.key('proba', checksum, h) for h in unique]
+        missing = []
+        for j, key in enumerate(keys):
+            cached = cache.get(key)
+            if cached is None:
+                missing.append(j)
+            else:
+                yprob[j] = cached
+    if missing:
+        if model is None:
+            yprob[missing], ylabel = predict_ancestry(s_matrix[first[missing]], ml_dir=ml_dir, n_classes=n_classes, model_type=model_type)
         else:
-            print(f'Cannot coerce data. Check sparse matrix: {s_matrix}')
-            return
+            yprob[missing] = predict_proba(model, s_matrix[first[missing]], n_classes, model_type)
+        if cache is not None:
+            for j in missing:
+                cache.put(keys[j], yprob[j])
+    return yprob[inverse.reshape(-1)]
 
-        try:
-            yprob = clf.predict_proba(dtest).reshape(s_matrix.shape[0], n_classes)
-        except ValueError:
-            yprob = clf.predict_proba(dtest.A).reshape(s_matrix.shape[0], n_classes)
-        ylabel = np.argmax(yprob, axis=1)[0]
 
-    return (yprob, ylabel)
+def encode_sample(parsed_vcf, var, genome_ver, mode):
+    """
+    Make a parsed vcf ml compatible for every model.
 
+    returns
+    -------
+    s_matrices - dict of model -> sparse row matrix
+    """
+    s_matrices = {}
+    inc('snvstory_vcf_records_scanned', len(parsed_vcf))
+    for att_dir, ml_dir, n_classes, m_type in var.R_DIRS:
+        t = m_type.split('_')[0]
+        stats = {}
+        # locus conversion to the model's genome version and lookup of its ancestry informative loci
+        with span('liftover', model=m_type):
+            t_vcf_json = vcf_to_json(parsed_vcf=parsed_vcf, attribute_dir=att_dir, locus_converter_json_path=var.JSON_CONVERTS[genome_ver][mode][t], stats=stats)
+        with span('encode', model=m_type):
+            o_snps = load_snp_order(attribute_dir=att_dir)
+            s_matrices[m_type] = json_to_sparse_matrix(t_vcf_json, o_snps)
+        inc('snvstory_vcf_records_matched', stats.get('matched', 0), model=m_type)
+        inc('snvstory_aims_found', len(stats.get('loci', set()).intersection(o_snps)), model=m_type)
+        inc('snvstory_aims_expected', len(o_snps), model=m_type)
+    return s_matrices
 
-def run_ancestry_pipeline(vcf_path, multi_sample_status, sample, sample_position, var, outdir, genome_ver, mode, ofn):
 
-    # Read VCF-type file into memory
-    o, gz_file = get_file_handle(vcf_path)
-    print(f'Gzipped status: {gz_file}')
+def select_samples(o, gz_file, sample_position):
+    """
+    Resolve the samples of a multi-sample vcf to analyze.
 
-    # Single sample analysis
-    if multi_sample_status is False:
-        DATA_TO_PLOT = {}
-        p_vcf = parse_vcf(o, gz_file)
-        print('Getting model predictions:')
-        for att_dir, ml_dir, n_classes, m_type in var.R_DIRS:
-            print(m_type)
-            # Make the vcf ml compatible
-            t = m_type.split('_')[0]
-            t_vcf_json = vcf_to_json(parsed_vcf=p_vcf, attribute_dir=att_dir, locus_converter_json_path=var.JSON_CONVERTS[genome_ver][mode][t])
-            o_snps = load_snp_order(attribute_dir=att_dir)
-            s_matrix = json_to_sparse_matrix(t_vcf_json, o_snps)
-            # Ancestry prediction
-            if 'gnomAD' in m_type:
-                yprob, ylabel = predict_ancestry(s_matrix, ml_dir=ml_dir, n_classes=n_classes)
+    args
+    ----
+    sample_position - 'all' or comma separated sample positions/names
+
+    returns
+    -------
+    indices - column index of each sample
+    sample_names - name of each sample
+    """
+    if isinstance(sample_position, (list, tuple)):
+        sample_position = ','.join(sample_position)
+    if sample_position == 'all':
+        indices, sample_names = parse_multisample_vcf_sample(o, gz_file, sample_position)
+        return list(indices), list(sample_names)
+    indices = []
+    sample_names = []
+    # User chosen sample(s); if handpicked should be comma separated.
+    for s in sample_position.split(','):
+        index, sample_name = parse_multisample_vcf_sample(o, gz_file, s)
+        indices.append(index)
+        sample_names.append(sample_name)
+    return indices, sample_names
+
+
+def run_ancestry_pipeline(vcf_path, multi_sample_status, sample, sample_position, var, outdir, genome_ver, mode, ofn, output_format='csv', store=None, cache=None, stream=None, publisher=None, plots=True, resources=None):
+    """
+    Score, emit, plot and write the samples of a vcf. With a
+    resources.ResourceLoader the genotypes are read once while the models
+    load, and each model encodes and scores the samples as soon as it is
+    loaded; otherwise every sample is encoded with encode_sample and every
+    model is read from disk when it is used. PLINK filesets (.bed) and BCFs
+    need the loader, which tells which of their records to decode. With a
+    stream, stored samples are emitted at once and the others are scored and
+    emitted in blocks of STREAM_BLOCK samples, otherwise of WRITE_BLOCK. Each
+    block is written as one row group of ofn once it is scored.
+    """
+
+    from scipy import sparse
+    binary = next((reader for extensions, reader in BINARY_READERS.items() if vcf_path.endswith(extensions)), None)
+    if binary is not None:
+        if resources is None:
+            raise ValueError(f'{vcf_path} needs a ResourceLoader')
+        # the samples as a vcf header, the genotypes are read below
+        o, gz_file = binary[0](vcf_path), False
+    else:
+        # Read VCF-type file into memory
+        o, gz_file = get_file_handle(vcf_path)
+        print(f'Gzipped status: {gz_file}')
+
+    # Genotypes of every sample read once, independent of the models
+    if resources is not None:
+        if multi_sample_status is False:
+            sample_names, columns = list(sample), [9]
+        else:
+            columns, sample_names = select_samples(o, gz_file, sample_position)
+        with span('parse', samples=len(sample_names)):
+            if binary is not None:
+                loci, codes = binary[1](vcf_path, columns, resources.aim_loci(genome_ver, mode))
             else:
-                yprob, ylabel = predict_ancestry(s_matrix, ml_dir=ml_dir, n_classes=n_classes, model_type='svm')
-            # UMAP plotting
-            if 'continental' in m_type:
-                plot_umap_parser(s_matrix, ml_dir=ml_dir, att_dir=att_dir, sample_name=sample, outdir=outdir, m_type=m_type)
+                loci, codes = parse_genotypes(o, columns)
+        inc('snvstory_vcf_records_scanned', len(loci) * len(sample_names))
 
-            DATA_TO_PLOT[m_type] = yprob.flatten().tolist()
-        df_data = pd.DataFrame([DATA_TO_PLOT], sample)
+    # Single sample analysis
+    elif multi_sample_status is False:
+        sample_names = list(sample)
+        with span('sample', sample=sample_names[0]):
+            with span('parse'):
+                parsed = parse_vcf(o, gz_file)
+            encoded = [encode_sample(parsed, var, genome_ver, mode)]
 
     # Multisample anaylsis
     else:
-        DATA_TO_PLOT_LIST = []
-        if sample_position == 'all':
-            samples, sample_names = parse_multisample_vcf_sample(o, gz_file, sample_position)
-            for s in samples:
-                DATA_TO_PLOT = {}
-                p_mvcf = parse_multisample_vcf(o, gz_file, s)
-                for att_dir, ml_dir, n_classes, m_type in var.R_DIRS:
-                    print(m_type)
-                    # Make the vcf ml compatible
-                    t = m_type.split('_')[0]
-                    t_vcf_json = vcf_to_json(parsed_vcf=p_mvcf, attribute_dir=att_dir, locus_converter_json_path=var.JSON_CONVERTS[genome_ver][mode][t])
-                    o_snps = load_snp_order(attribute_dir=att_dir)
-                    s_matrix = json_to_sparse_matrix(t_vcf_json, o_snps)
-                    if 'gnomAD' in m_type:
-                        yprob, ylabel = predict_ancestry(s_matrix, ml_dir=ml_dir, n_classes=n_classes)
-                    else:
-                        yprob, ylabel = predict_ancestry(s_matrix, ml_dir=ml_dir, n_classes=n_classes, model_type='svm')
-                    DATA_TO_PLOT[m_type] = yprob.flatten().tolist()
-                DATA_TO_PLOT_LIST.append(DATA_TO_PLOT)
-            df_data = pd.DataFrame(DATA_TO_PLOT_LIST, sample_names)
-        else:
-            # User chosen sample(s); if handpicked should be comma separated.
-            sample_position_s = sample_position.split(',')
-            for s in sample_position_s:
-                DATA_TO_PLOT = {}
-                sample, sample_names = parse_multisample_vcf_sample(o, gz_file, s)
-                p_mvcf = parse_multisample_vcf(o, gz_file, sample)
-                for att_dir, ml_dir, n_classes, m_type in var.R_DIRS:
-                    t = m_type.split('_')[0]
-                    # Make the vcf ml compatible
-                    t_vcf_json = vcf_to_json(parsed_vcf=p_mvcf, attribute_dir=att_dir, locus_converter_json_path=var.JSON_CONVERTS[genome_ver][mode][t])
-                    o_snps = load_snp_order(attribute_dir=att_dir)
-                    s_matrix = json_to_sparse_matrix(t_vcf_json, o_snps)
-                    if 'gnomAD' in m_type:
-                        yprob, ylabel = predict_ancestry(s_matrix, ml_dir=ml_dir, n_classes=n_classes)
-                    else:
-                        yprob, ylabel = predict_ancestry(s_matrix, ml_dir=ml_dir, n_classes=n_classes, model_type='svm')
-                    DATA_TO_PLOT[m_type] = yprob.flatten().tolist()
-                DATA_TO_PLOT_LIST.append(DATA_TO_PLOT)
-            df_data = pd.DataFrame(DATA_TO_PLOT_LIST, sample_names)
-
-    # begin the plotting and figure writing
-    if not df_data.empty:
-        # Placeholder plotting
-        plot_parser(df_data, var, outdir, ofn)
+        indices, sample_names = select_samples(o, gz_file, sample_position)
+        encoded = []
+        for s, sample_name in zip(indices, sample_names):
+            with span('sample', sample=sample_name):
+                with span('parse'):
+                    p_mvcf = parse_multisample_vcf(o, gz_file, s)
+                encoded.append(encode_sample(p_mvcf, var, genome_ver, mode))
+
+    # All samples x models x classes are held in a single array
+    results = AncestryResults(sample_names, var)
+    inc('snvstory_samples_processed', len(results))
+    todo = list(range(len(results)))
+    if resources is not None:
+        # models in the order they finish loading
+        models = resources.as_completed()
+        s_matrices = {}
+        if store is not None:
+            # the store is keyed by the encoding of every model, in var.R_DIRS order
+            loaded = dict(models)
+            for m_type in resources.models:
+                res = loaded[m_type]
+                s_matrices[m_type] = res.encode(loci, codes, resources.converter(genome_ver, mode, res.t))
+            encoded = [{m_type: x[i] for m_type, x in s_matrices.items()} for i in todo]
+            models = loaded.items()
     else:
+        models = ((m_type, None) for att_dir, ml_dir, n_classes, m_type in var.R_DIRS)
+    if store is not None:
+        # Samples whose genotypes were already scored are read from the store
+        hashes = [genotype_hash(e) for e in encoded]
+        stored = store.lookup(results.samples, hashes)
+        for i, probs in stored.items():
+            results.probs[i] = probs
+        todo = [i for i in todo if i not in stored]
+        print(f'Samples already in results store: {len(stored)}')
+
+    source = os.path.basename(vcf_path)
+    if stream is not None and store is not None and stored:
+        # stored samples are complete already
+        for record in sample_records(results.take(sorted(stored)).normalized(), source):
+            stream.emit(record)
+
+    if not len(results):
         return
+    print('Getting model predictions:')
+    dirs = {m_type: (att_dir, ml_dir, n_classes) for att_dir, ml_dir, n_classes, m_type in var.R_DIRS}
+    # each block is emitted and written once every model scored it
+    size = STREAM_BLOCK if stream is not None else WRITE_BLOCK
+    blocks = [todo[i:i + size] for i in range(0, len(todo), size)]
+    pending = set(todo)
+    written = 0
+    with get_writer(os.path.join(outdir, ofn), var, output_format) as writer:
+        for b, block in enumerate(blocks):
+            last = b == len(blocks) - 1
+            scored = []
+            for m_type, res in models:
+                scored.append((m_type, res))
+                print(m_type)
+                att_dir, ml_dir, n_classes = dirs[m_type]
+                if res is None:
+                    s_matrix = sparse.vstack([encoded[i][m_type] for i in block], format='csr')
+                    with span('predict', model=m_type, samples=len(block)):
+                        results[m_type][block] = predict_model(s_matrix, ml_dir, n_classes, m_type, cache)
+                else:
+                    if m_type not in s_matrices:
+                        with span('encode', model=m_type):
+                            s_matrices[m_type] = res.encode(loci, codes, resources.converter(genome_ver, mode, res.t))
+                    s_matrix = (s_matrices.pop(m_type) if last else s_matrices[m_type])[block]
+                    with span('predict', model=m_type, samples=len(block)):
+                        results[m_type][block] = res.predict(s_matrix, cache)
+                # UMAP plotting
+                if plots and multi_sample_status is False and 'continental' in m_type:
+                    fits = resources.umap_fits(m_type) if resources is not None else None
+                    plot_umap_parser(s_matrix, ml_dir=ml_dir, att_dir=att_dir, sample_name=sample, outdir=outdir, m_type=m_type, cache=cache, fits=fits)
+            # the next blocks run the models in the order they loaded for the first
+            models = scored
+
+            # emitted before the next block is scored
+            if stream is not None:
+                for record in sample_records(results.take(block).normalized(), source):
+                    stream.emit(record)
+
+            # written with the stored samples before it, in file order
+            end = len(results) if last else block[-1] + 1
+            rows = list(range(written, end))
+            plot_parser(results.take(rows), var, outdir, ofn, output_format,
+                        plotted=[k for k, i in enumerate(rows) if i in pending] if plots else [], publisher=publisher,
+                        writer=writer)
+            written = end
+        if not blocks:
+            # every sample was stored
+            plot_parser(results, var, outdir, ofn, output_format, plotted=[], publisher=publisher, writer=writer)
+
+    # the new samples of the input in a single transaction
+    if store is not None and todo:
+        store.insert([results.samples[i] for i in todo], [hashes[i] for i in todo], results.probs[todo])
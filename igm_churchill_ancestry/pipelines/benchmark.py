@@ -0,0 +1,114 @@
+import os
+import sys
+import time
+import platform
+import itertools
+
+from igm_churchill_ancestry.pipelines.ancestry_prediction import run_ancestry_pipeline
+from igm_churchill_ancestry.utilities.run_report import read_spans, span, start_report, stop_report, summarize, peak_rss_mb
+from igm_churchill_ancestry.utilities.synthetic import generate_resources, generate_vcf
+from igm_churchill_ancestry.utilities.utilities import is_vcf_multisample
+from igm_churchill_ancestry.utilities.writers import output_filename
+
+'''
+Synthetic benchmarks of the stages of run_ancestry_pipeline.
+'''
+
+
+EXTENSIONS = {None: '.vcf', 'gz': '.vcf.gz', 'bgzip': '.vcf.gz'}
+
+
+def case_name(n_samples, mode, compression=None, gvcf=False):
+    return f"{n_samples}x{mode}-{compression or 'plain'}{'-gvcf' if gvcf else ''}"
+
+
+def benchmark_case(var, vcf, genome_ver, mode, workdir, plots=False, repeat=1):
+    """
+    Run the pipeline on one vcf repeat times and time its stages with a run report.
+
+    returns
+    -------
+    dict - the best total wall seconds, the stage summary of that run and the
+           peak RSS of this process
+    """
+    runs = []
+    for r in range(repeat):
+        outdir = os.path.join(workdir, f'out{r}')
+        os.makedirs(outdir, exist_ok=True)
+        spans_path = os.path.join(workdir, f'spans{r}.ndjson')
+        start_report(spans_path)
+        try:
+            with span('total'):
+                with span('header_probe'):
+                    multi_sample_status, sample_names = is_vcf_multisample(vcf, True)
+                run_ancestry_pipeline(vcf_path=vcf, multi_sample_status=multi_sample_status, sample=sample_names,
+                                      sample_position='all', var=var, outdir=outdir, genome_ver=genome_ver, mode=mode,
+                                      ofn=output_filename('benchmark', 'csv'), plots=plots)
+        finally:
+            stop_report()
+        stages = summarize(read_spans(spans_path))
+        runs.append((stages.pop('total')['wall_s'], stages))
+    wall_s, stages = min(runs, key=lambda x: x[0])
+    return {'wall_s': wall_s, 'peak_rss_mb': peak_rss_mb(), 'stages': stages}
+
+
+def run_benchmarks(workdir, samples=(1, 100), modes=('WES',), compressions=(None,), gvcf=False, genome_ver='38',
+                   n_aims=200, plots=False, repeat=1, seed=0):
+    """
+    Generate a miniature resource folder and one synthetic vcf per
+    combination of samples, modes and compressions, and benchmark each. Cases
+    run in order of sample count, so the peak RSS of a case, the high-water
+    mark of this process, is mostly its own.
+
+    returns
+    -------
+    dict - environment, parameters and per case results keyed by case_name
+    """
+    os.makedirs(workdir, exist_ok=True)
+    var, sites = generate_resources(os.path.join(workdir, 'resources'), n_aims=n_aims, umap=plots, seed=seed)
+    report = {'python': sys.version.split()[0], 'platform': platform.platform(), 'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+              'params': {'genome_ver': genome_ver, 'n_aims': n_aims, 'gvcf': gvcf, 'plots': plots, 'repeat': repeat},
+              'cases': {}}
+    for n_samples, mode, compression in itertools.product(sorted(samples), modes, compressions):
+        name = case_name(n_samples, mode, compression, gvcf)
+        case_dir = os.path.join(workdir, name)
+        os.makedirs(case_dir, exist_ok=True)
+        vcf = os.path.join(case_dir, f'synthetic{EXTENSIONS[compression]}')
+        generate_vcf(vcf, sites, n_samples, genome_ver, mode, compression, gvcf, seed=seed)
+        result = benchmark_case(var, vcf, genome_ver, mode, case_dir, plots, repeat)
+        result['vcf_bytes'] = os.path.getsize(vcf)
+        report['cases'][name] = result
+        print(f"{name}: {result['wall_s']:.3f}s, peak RSS {result['peak_rss_mb']} MiB")
+    return report
+
+
+def compare(baseline, current, tolerance=0.2, min_seconds=0.05):
+    """
+    Stages of the cases of both reports that got slower by more than
+    tolerance (a fraction), ignoring stages faster than min_seconds in both.
+
+    returns
+    -------
+    list - (case, stage, baseline seconds, current seconds) per regression
+    """
+    regressions = []
+    for name, case in current['cases'].items():
+        base = baseline['cases'].get(name)
+        if base is None:
+            continue
+        pairs = [('total', base['wall_s'], case['wall_s'])]
+        pairs += [(stage, base['stages'][stage]['wall_s'], s['wall_s'])
+                  for stage, s in case['stages'].items() if stage in base['stages']]
+        for stage, before, after in pairs:
+            if max(before, after) >= min_seconds and after > before * (1 + tolerance):
+                regressions.append((name, stage, before, after))
+    return regressions
+
+
+def format_report(report):
+    lines = [f"{'case':<24}{'stage':<16}{'count':>8}{'wall s':>10}{'cpu s':>10}{'peak MiB':>10}"]
+    for name, case in report['cases'].items():
+        lines.append(f"{name:<24}{'total':<16}{'':>8}{case['wall_s']:>10.3f}{'':>10}{case['peak_rss_mb']:>10.1f}")
+        for stage, s in case['stages'].items():
+            lines.append(f"{'':<24}{stage:<16}{s['count']:>8}{s['wall_s']:>10.3f}{s['cpu_s']:>10.3f}{s['peak_rss_mb']:>10.1f}")
+    return '\n'.join(lines)
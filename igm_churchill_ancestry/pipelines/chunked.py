@@ -0,0 +1,183 @@
+import os
+import tempfile
+import contextlib
+import numpy as np
+
+from igm_churchill_ancestry.pipelines.ancestry_prediction import select_samples
+from igm_churchill_ancestry.utilities.plot_ancestry import plot_parser
+from igm_churchill_ancestry.utilities.results import AncestryResults
+from igm_churchill_ancestry.utilities.store import genotype_hash
+from igm_churchill_ancestry.utilities.stream import sample_records
+from igm_churchill_ancestry.utilities.writers import get_writer
+from igm_churchill_ancestry.utilities.utilities import open_vcf
+from igm_churchill_ancestry.utilities.plink import PLINK_EXTENSIONS, PlinkFileset, plink_header
+from igm_churchill_ancestry.utilities.bcf import BCF_EXTENSIONS, bcf_header, parse_bcf
+from igm_churchill_ancestry.utilities.run_report import rss_mb, span
+from igm_churchill_ancestry.utilities.metrics import inc
+
+'''
+Memory bounded pipeline of multi-sample vcfs, streamed in blocks of sample columns.
+'''
+
+
+# bytes per sample and AIM: the dense int8 encoding plus its csr copy (int8 data, int32 indices)
+ENCODED_BYTES_PER_AIM = 6
+# bytes per sample and AIM of the model being predicted, whose input is densified to float64
+PREDICT_BYTES_PER_AIM = 16
+# bytes per sample column of the vcf line being split
+LINE_BYTES_PER_SAMPLE = 64
+# allocations that do not grow with the block, e.g. modules first imported by the writer or the plots
+RESERVED_BYTES = 32 << 20
+
+
+def sample_block_size(resources, n_samples, max_memory, rss=None):
+    """
+    Samples per block such that a block's encoded genotypes and predictions
+    fit in what max_memory leaves over the current RSS of this process, in
+    which the resources are already loaded, and RESERVED_BYTES.
+
+    args
+    ----
+    resources - ResourceSet of the models run
+    n_samples - samples of the vcf
+    max_memory - memory budget in bytes
+    rss - current RSS in bytes, measured when None
+
+    returns
+    -------
+    int - between 1 and n_samples
+
+    raises
+    ------
+    MemoryError - when not even one sample fits in the budget
+    """
+    if rss is None:
+        rss = (rss_mb() or 0) * (1 << 20)
+    n_snps = [res.n_snps for res in resources.models.values()]
+    per_sample = ENCODED_BYTES_PER_AIM * sum(n_snps) + PREDICT_BYTES_PER_AIM * max(n_snps)
+    available = max_memory - rss - RESERVED_BYTES - LINE_BYTES_PER_SAMPLE * n_samples
+    if available < per_sample:
+        raise MemoryError(f'A memory budget of {max_memory >> 20} MiB leaves {max(available, 0) >> 20} MiB over the '
+                          f'{int(rss) >> 20} MiB in use, less than the {per_sample >> 10} KiB a sample needs')
+    return int(min(n_samples, available // per_sample))
+
+
+def write_aim_lines(vcf_path, aims, path):
+    """
+    Copy the records of a vcf whose locus id is in aims, without its header,
+    to an uncompressed file at path, so that later passes read only those.
+
+    returns
+    -------
+    int - number of records copied
+    """
+    o, gz_file = open_vcf(vcf_path)
+    n_lines = 0
+    with o, open(path, 'w') as fout:
+        for line in o:
+            if gz_file:
+                line = line.decode('utf-8')
+            if line.startswith('#'):
+                continue
+            values = line.split('\t', 5)
+            if len(values) < 5 or f'{values[0]}_{values[1]}_{values[3]}_{values[4]}' not in aims:
+                continue
+            fout.write(line)
+            n_lines += 1
+    return n_lines
+
+
+def run_chunked_pipeline(vcf_path, sample_position, var, resources, outdir, genome_ver, mode, ofn, max_memory,
+                         output_format='csv', store=None, cache=None, stream=None, publisher=None, plots=True,
+                         workdir=None):
+    """
+    run_ancestry_pipeline for multi-sample vcfs under a memory budget. The
+    selected samples are split into blocks of sample_block_size columns.
+    Each block is encoded, predicted, emitted, plotted and appended to the
+    results table, and released before the next block is read. With more than
+    one block, the records of the vcf at the AIMs of the models are first
+    copied to a temporary file in one pass, and each block streams that file
+    instead of the whole vcf. Nothing is embedded with UMAP, as for every
+    multi-sample vcf. The blocks of a PLINK fileset (.bed) are decoded from
+    its memory mapped genotype matrix, only at the AIMs of the models, and
+    those of a BCF from its records at the AIMs.
+
+    args
+    ----
+    resources - ResourceSet of var, its encoder matches encode_sample
+    max_memory - memory budget of this process in bytes
+    workdir - directory of the temporary file, the system's temporary directory when None
+
+    returns
+    -------
+    int - number of blocks
+    """
+    fileset = None
+    if vcf_path.endswith(PLINK_EXTENSIONS):
+        header, gz_file = plink_header(vcf_path), False
+        fileset = PlinkFileset(vcf_path)
+        rows, loci, swapped = fileset.select(resources.aim_loci(genome_ver, mode))
+    elif vcf_path.endswith(BCF_EXTENSIONS):
+        header, gz_file = bcf_header(vcf_path), False
+    else:
+        o, gz_file = open_vcf(vcf_path)
+        header = []
+        with o:
+            # the header only, select_samples reads it once per named sample
+            for line in o:
+                header.append(line)
+                if (line.decode('utf-8') if gz_file else line).startswith('#CHROM'):
+                    break
+    columns, sample_names = select_samples(header, gz_file, sample_position)
+    block = sample_block_size(resources, len(columns), max_memory)
+    n_blocks = -(-len(columns) // block)
+    print(f'Memory budget {max_memory >> 20} MiB: {len(columns)} samples in {n_blocks} blocks of up to {block}')
+    with contextlib.ExitStack() as stack:
+        writer = stack.enter_context(get_writer(os.path.join(outdir, ofn), var, output_format))
+        lines_path = vcf_path
+        if fileset is None and not vcf_path.endswith(BCF_EXTENSIONS) and n_blocks > 1:
+            lines_path = os.path.join(stack.enter_context(tempfile.TemporaryDirectory(dir=workdir)), 'aims.vcf')
+            with span('filter'):
+                n_lines = write_aim_lines(vcf_path, resources.aim_loci(genome_ver, mode), lines_path)
+            print(f'{n_lines} records at AIMs read by every block')
+        for start in range(0, len(columns), block):
+            names = sample_names[start:start + block]
+            with span('block', samples=len(names)):
+                if fileset is not None:
+                    with span('encode'):
+                        codes = fileset.genotypes(rows, np.asarray(columns[start:start + block]) - 9, swapped)
+                        s_matrices = resources.encode_codes(loci, codes, genome_ver, mode)
+                        del codes
+                elif vcf_path.endswith(BCF_EXTENSIONS):
+                    with span('encode'):
+                        loci, codes = parse_bcf(vcf_path, columns[start:start + block], resources.aim_loci(genome_ver, mode))
+                        s_matrices = resources.encode_codes(loci, codes, genome_ver, mode)
+                        del loci, codes
+                else:
+                    o, gz_file = open_vcf(lines_path)
+                    with o, span('encode'):
+                        s_matrices = resources.encode_lines(o, columns[start:start + block], genome_ver, mode)
+                results = AncestryResults(names, var)
+                inc('snvstory_samples_processed', len(results))
+                todo = list(range(len(results)))
+                if store is not None:
+                    hashes = [genotype_hash({m_type: x[i] for m_type, x in s_matrices.items()}) for i in todo]
+                    stored = store.lookup(results.samples, hashes)
+                    for i, probs in stored.items():
+                        results.probs[i] = probs
+                    todo = [i for i in todo if i not in stored]
+                for m_type, res in resources.models.items():
+                    if not todo:
+                        break
+                    with span('predict', model=m_type, samples=len(todo)):
+                        results[m_type][todo] = res.predict(s_matrices[m_type][todo], cache)
+                del s_matrices
+                # committed per block, so that memory stays bounded and finished blocks survive an interruption
+                if store is not None and todo:
+                    store.insert([results.samples[i] for i in todo], [hashes[i] for i in todo], results.probs[todo])
+                if stream is not None:
+                    for record in sample_records(results.normalized(), os.path.basename(vcf_path)):
+                        stream.emit(record)
+                plot_parser(results, var, outdir, ofn, output_format, plotted=todo if plots else [],
+                            publisher=publisher, writer=writer)
+    return n_blocks
@@ -0,0 +1,205 @@
+import os
+import numpy as np
+
+from igm_churchill_ancestry.pipelines.ancestry_prediction import encode_sample, predict_ancestry, predict_model, select_samples
+from igm_churchill_ancestry.pipelines.resources import ResourceSet, ResourceLoader
+from igm_churchill_ancestry.utilities.parsing import parse_vcf, parse_multisample_vcf, parse_genotypes
+from igm_churchill_ancestry.utilities.vcf2sparse import vcf_to_json, load_snp_order, json_to_sparse_matrix
+from igm_churchill_ancestry.utilities.synthetic import generate_resources, generate_vcf
+from igm_churchill_ancestry.utilities.utilities import get_file_handle, is_vcf_multisample
+
+'''
+Golden-output equivalence of alternative parse, encode and inference engines with the reference chain.
+'''
+
+
+# name -> engine(var, vcf, genome_ver, mode) returning (sample_names, s_matrices, probs), see register_engine
+ENGINES = {}
+
+# synthetic inputs every engine is checked on: generate_vcf keyword arguments per case
+CASES = {
+    'unphased': {'phased': 0.0, 'missing': 0.0, 'multiallelic': 0.0},
+    'phased': {'phased': 1.0, 'missing': 0.0, 'multiallelic': 0.0},
+    'missing': {'missing': 0.3},
+    'multiallelic': {'multiallelic': 0.5},
+    'liftover': {'genome_ver': '37'},
+    'gvcf': {'gvcf': True},
+    'single': {'n_samples': 1},
+}
+
+
+def register_engine(name):
+    """
+    Decorator adding an engine to ENGINES. An engine reads every sample of a
+    vcf and returns their names, a dict of model -> sparse matrix with one
+    row per sample and a dict of model -> (n_samples, n_classes) probabilities.
+
+        @register_engine('my_reader')
+        def my_reader(var, vcf, genome_ver, mode):
+            ...
+    """
+    def decorator(engine):
+        ENGINES[name] = engine
+        return engine
+    return decorator
+
+
+def reference_engine(var, vcf, genome_ver, mode):
+    """
+    The golden path: one sample at a time through vcf_to_json,
+    json_to_sparse_matrix and predict_ancestry, loading every model for every
+    sample.
+    """
+    from scipy import sparse
+    multi_sample_status, sample_names = is_vcf_multisample(vcf, True)
+    o, gz_file = get_file_handle(vcf)
+    if multi_sample_status:
+        indices, sample_names = select_samples(o, gz_file, 'all')
+        parsed = [parse_multisample_vcf(o, gz_file, s) for s in indices]
+    else:
+        parsed = [parse_vcf(o, gz_file)]
+    s_matrices, probs = {}, {}
+    for att_dir, ml_dir, n_classes, m_type in var.R_DIRS:
+        t = m_type.split('_')[0]
+        model_type = 'xgb' if 'gnomAD' in m_type else 'svm'
+        rows, yprobs = [], []
+        for p_vcf in parsed:
+            t_vcf_json = vcf_to_json(parsed_vcf=p_vcf, attribute_dir=att_dir, locus_converter_json_path=var.JSON_CONVERTS[genome_ver][mode][t])
+            s_matrix = json_to_sparse_matrix(t_vcf_json, load_snp_order(attribute_dir=att_dir))
+            yprob, ylabel = predict_ancestry(s_matrix, ml_dir=ml_dir, n_classes=n_classes, model_type=model_type)
+            rows.append(s_matrix)
+            yprobs.append(yprob)
+        s_matrices[m_type] = sparse.vstack(rows, format='csr')
+        probs[m_type] = np.vstack(yprobs)
+    return [str(s) for s in sample_names], s_matrices, probs
+
+
+@register_engine('pipeline')
+def pipeline_engine(var, vcf, genome_ver, mode):
+    """run_ancestry_pipeline's path: encode_sample per sample, then one deduplicated predict_model batch per model."""
+    from scipy import sparse
+    multi_sample_status, sample_names = is_vcf_multisample(vcf, True)
+    o, gz_file = get_file_handle(vcf)
+    if multi_sample_status:
+        indices, sample_names = select_samples(o, gz_file, 'all')
+        encoded = [encode_sample(parse_multisample_vcf(o, gz_file, s), var, genome_ver, mode) for s in indices]
+    else:
+        encoded = [encode_sample(parse_vcf(o, gz_file), var, genome_ver, mode)]
+    s_matrices, probs = {}, {}
+    for att_dir, ml_dir, n_classes, m_type in var.R_DIRS:
+        s_matrices[m_type] = sparse.vstack([e[m_type] for e in encoded], format='csr')
+        probs[m_type] = predict_model(s_matrices[m_type], ml_dir, n_classes, m_type)
+    return [str(s) for s in sample_names], s_matrices, probs
+
+
+@register_engine('resources')
+def resources_engine(var, vcf, genome_ver, mode):
+    """ResourceSet's single pass encoder and preloaded models, as used by AncestryPredictor and serve."""
+    resources = ResourceSet(var)
+    o, gz_file = get_file_handle(vcf)
+    columns, sample_names = select_samples(o, gz_file, 'all')
+    s_matrices = resources.encode_lines(o, columns, genome_ver, mode)
+    results = resources.predict([str(s) for s in sample_names], s_matrices)
+    return results.samples, s_matrices, {m_type: results[m_type] for m_type in results.models}
+
+
+@register_engine('loader')
+def loader_engine(var, vcf, genome_ver, mode):
+    """parse_genotypes once, then each model of a ResourceLoader encodes and predicts as it finishes loading."""
+    loader = ResourceLoader(var)
+    o, gz_file = get_file_handle(vcf)
+    columns, sample_names = select_samples(o, gz_file, 'all')
+    loci, codes = parse_genotypes(o, columns)
+    s_matrices, probs = {}, {}
+    for m_type, res in loader.as_completed():
+        s_matrices[m_type] = res.encode(loci, codes, loader.converter(genome_ver, mode, res.t))
+        probs[m_type] = res.predict(s_matrices[m_type])
+    return [str(s) for s in sample_names], s_matrices, probs
+
+
+def diff_outputs(expected, actual, atol=1e-6):
+    """
+    Differences of the outputs of an engine from the expected (reference)
+    outputs: sample names, the set of models, the shape and every entry of
+    each model's sparse matrix, exactly, and its probabilities within atol.
+
+    returns
+    -------
+    list - one message per difference, empty when the outputs are equivalent
+    """
+    from scipy import sparse
+    names, s_matrices, probs = expected
+    a_names, a_matrices, a_probs = actual
+    diffs = []
+    if list(map(str, a_names)) != list(map(str, names)):
+        diffs.append(f'samples {list(a_names)} != {list(names)}')
+    for m_type in s_matrices:
+        if m_type not in a_matrices or m_type not in a_probs:
+            diffs.append(f'{m_type}: missing')
+            continue
+        x, y = sparse.csr_matrix(s_matrices[m_type]), sparse.csr_matrix(a_matrices[m_type])
+        if x.shape != y.shape:
+            diffs.append(f'{m_type}: matrix shape {y.shape} != {x.shape}')
+        else:
+            rows, cols = (x != y).nonzero()
+            if len(rows):
+                i, j = rows[0], cols[0]
+                diffs.append(f'{m_type}: {len(rows)} matrix entries differ, first at sample {i} column {j}: {y[i, j]} != {x[i, j]}')
+        p, q = np.asarray(probs[m_type], dtype=float), np.asarray(a_probs[m_type], dtype=float)
+        if p.shape != q.shape:
+            diffs.append(f'{m_type}: probabilities shape {q.shape} != {p.shape}')
+        elif not np.allclose(p, q, rtol=0, atol=atol):
+            i, j = np.unravel_index(np.argmax(np.abs(p - q)), p.shape)
+            diffs.append(f'{m_type}: probabilities differ by up to {abs(p[i, j] - q[i, j]):.3g} at sample {i} class {j}')
+    diffs += [f'{m_type}: not a reference model' for m_type in a_matrices if m_type not in s_matrices]
+    return diffs
+
+
+def check_engines(var, vcf, genome_ver, mode, engines=None, atol=1e-6):
+    """
+    Run the reference path and every engine on one vcf.
+
+    args
+    ----
+    engines - names of registered engines, defaults to all of ENGINES
+    atol - absolute tolerance of probabilities
+
+    returns
+    -------
+    dict - engine name -> list of differences, see diff_outputs
+    """
+    expected = reference_engine(var, vcf, genome_ver, mode)
+    return {name: diff_outputs(expected, ENGINES[name](var, vcf, genome_ver, mode), atol)
+            for name in (engines or ENGINES)}
+
+
+def run_equivalence(workdir, engines=None, cases=None, n_samples=8, mode='WES', n_aims=100, atol=1e-6, seed=0):
+    """
+    Generate a miniature resource folder and a synthetic vcf per case of
+    CASES, and check every engine against the reference path on each.
+
+    returns
+    -------
+    dict - case -> engine -> list of differences
+    """
+    unknown = set(engines or ()) - set(ENGINES)
+    if unknown:
+        raise ValueError(f'Unknown engines {sorted(unknown)}, choose from {sorted(ENGINES)}')
+    os.makedirs(workdir, exist_ok=True)
+    var, sites = generate_resources(os.path.join(workdir, 'resources'), n_aims=n_aims, umap=False, seed=seed)
+    report = {}
+    for case in (cases or CASES):
+        kwargs = {'n_samples': n_samples, 'genome_ver': '38', **CASES[case]}
+        vcf = os.path.join(workdir, f'{case}.vcf')
+        generate_vcf(vcf, sites, mode=mode, seed=seed, **kwargs)
+        report[case] = check_engines(var, vcf, kwargs['genome_ver'], mode, engines, atol)
+    return report
+
+
+def format_equivalence(report):
+    lines = []
+    for case, engines in report.items():
+        for name, diffs in engines.items():
+            lines.append(f"{case:<16}{name:<16}{'ok' if not diffs else f'{len(diffs)} differences'}")
+            lines += [f"{'':<32}{x}" for x in diffs]
+    return '\n'.join(lines)
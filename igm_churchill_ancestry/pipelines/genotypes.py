@@ -0,0 +1,72 @@
+import os
+import itertools
+
+from igm_churchill_ancestry.utilities.plot_ancestry import plot_parser
+from igm_churchill_ancestry.utilities.results import AncestryResults
+from igm_churchill_ancestry.utilities.store import genotype_hash
+from igm_churchill_ancestry.utilities.stream import sample_records
+from igm_churchill_ancestry.utilities.writers import get_writer
+from igm_churchill_ancestry.utilities.run_report import span
+from igm_churchill_ancestry.utilities.metrics import inc
+
+'''
+Pipeline of genotypes given directly at AIM sites, see parsing.parse_genotype_json, without reading any vcf.
+'''
+
+
+# samples encoded and scored together
+BATCH_SIZE = 1024
+
+
+def run_genotype_pipeline(records, var, resources, outdir, genome_ver, mode, ofn, output_format='csv', store=None,
+                          cache=None, stream=None, source='vcf_json', batch_size=BATCH_SIZE):
+    """
+    Score (sample, genotypes) records in batches of batch_size samples. Each
+    batch is encoded with ResourceSet.encode_genotypes, scored, emitted and
+    appended to the results table before the next batch is read, so an NDJSON
+    stream of any length runs in bounded memory. Nothing is plotted.
+
+    args
+    ----
+    records - iterable of (sample name, dict of locus id -> genotype)
+    resources - ResourceSet of var
+    source - input name of the stream records
+
+    returns
+    -------
+    int - number of samples
+    """
+    records = iter(records)
+    n_samples = 0
+    with get_writer(os.path.join(outdir, ofn), var, output_format) as writer:
+        while True:
+            batch = list(itertools.islice(records, batch_size))
+            if not batch:
+                break
+            names = [sample for sample, genotypes in batch]
+            with span('block', samples=len(names)):
+                with span('encode'):
+                    s_matrices = resources.encode_genotypes([genotypes for sample, genotypes in batch], genome_ver, mode)
+                results = AncestryResults(names, var)
+                inc('snvstory_samples_processed', len(results))
+                todo = list(range(len(results)))
+                if store is not None:
+                    hashes = [genotype_hash({m_type: x[i] for m_type, x in s_matrices.items()}) for i in todo]
+                    stored = store.lookup(results.samples, hashes)
+                    for i, probs in stored.items():
+                        results.probs[i] = probs
+                    todo = [i for i in todo if i not in stored]
+                for m_type, res in resources.models.items():
+                    if not todo:
+                        break
+                    with span('predict', model=m_type, samples=len(todo)):
+                        results[m_type][todo] = res.predict(s_matrices[m_type][todo], cache)
+                # committed per block, so that memory stays bounded and finished blocks survive an interruption
+                if store is not None and todo:
+                    store.insert([results.samples[i] for i in todo], [hashes[i] for i in todo], results.probs[todo])
+                if stream is not None:
+                    for record in sample_records(results.normalized(), source):
+                        stream.emit(record)
+                plot_parser(results, var, outdir, ofn, output_format, plotted=[], writer=writer)
+            n_samples += len(results)
+    return n_samples
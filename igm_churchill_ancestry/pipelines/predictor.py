@@ -0,0 +1,114 @@
+import os
+from collections.abc import Mapping
+
+from igm_churchill_ancestry.pipelines.variables import variables
+from igm_churchill_ancestry.pipelines.resources import ResourceSet
+from igm_churchill_ancestry.pipelines.ancestry_prediction import select_samples
+from igm_churchill_ancestry.utilities.utilities import get_file_handle
+
+'''
+Importable ancestry predictor for long-lived Python processes.
+'''
+
+
+class AncestryPredictor:
+    """
+    Loads the resources and models once and scores samples in memory. Nothing
+    is plotted, embedded or written; the caller decides what to do with the
+    returned AncestryResults (e.g. results.normalized(), writers.get_writer).
+
+        predictor = AncestryPredictor('/data/resource_dir', genome_ver='38', mode='WES')
+        results = predictor.predict('/data/cohort.vcf.gz', samples=['proband', 'mother'])
+        results.normalized()['gnomAD_continental']
+
+    args
+    ----
+    resource - local resource folder
+    genome_ver - default genome version of inputs, '37' or '38'
+    mode - default sequencing mode of inputs, 'WES' or 'WGS'
+    cache - optional PredictionCache
+    models - optional list of models to load, plus the continental models they are normalized by
+    """
+
+    def __init__(self, resource, genome_ver='38', mode='WES', cache=None, models=None):
+        self.var = variables(resource)
+        if models:
+            self.var.select_models(models)
+        for x in self.var.MATRIX_ATT_DIRS + self.var.MODEL_DIRS:
+            if not os.path.isdir(x):
+                raise FileNotFoundError(f'Failed to find the resource directory {x}')
+        self.genome_ver, self.mode = self._check_input(genome_ver, mode)
+        self.cache = cache
+        self.resources = ResourceSet(self.var)
+
+    @property
+    def models(self):
+        return list(self.resources.models)
+
+    def _check_input(self, genome_ver=None, mode=None):
+        genome_ver = str(genome_ver or self.genome_ver)
+        mode = mode or self.mode
+        if genome_ver not in ('37', '38') or mode not in ('WES', 'WGS'):
+            raise ValueError(f'genome_ver must be 37 or 38 and mode WES or WGS, got {genome_ver} and {mode}')
+        return genome_ver, mode
+
+    def encode(self, source, samples='all', genome_ver=None, mode=None, loci=None):
+        """
+        Encode the samples of source into model input rows.
+
+        args
+        ----
+        source - one of
+                 path to a vcf/gvcf (optionally gzipped)
+                 dict of sample name -> dict of locus id (chrom_pos_ref_alt) -> genotype ('0/1' or 0, 1, 2)
+                 (n_samples, n_loci) genotype matrix of 0, 1, 2 with loci giving the locus id of each column
+                 dict of model -> encoded sparse matrix, as returned by this method
+        samples - for a vcf 'all' or a list of sample positions/names; otherwise the sample names
+        genome_ver - '37' or '38', defaults to the predictor's
+        mode - 'WES' or 'WGS', defaults to the predictor's
+        loci - locus ids of the columns of a genotype matrix
+
+        returns
+        -------
+        sample_names - name of each sample
+        s_matrices - dict of model -> sparse matrix with one row per sample
+        """
+        genome_ver, mode = self._check_input(genome_ver, mode)
+        if isinstance(source, (str, os.PathLike)):
+            handle = get_file_handle(os.fspath(source))
+            if handle is None:
+                raise FileNotFoundError(f'Unable to open {source}')
+            o, gz_file = handle
+            columns, sample_names = select_samples(o, gz_file, samples)
+            return [str(s) for s in sample_names], self.resources.encode_lines(o, columns, genome_ver, mode)
+        if isinstance(source, Mapping) and source and set(source) <= set(self.models):
+            missing = set(self.models) - set(source)
+            if missing:
+                raise ValueError(f'Encoded input lacks the models {sorted(missing)}')
+            return self._sample_names(samples, next(iter(source.values())).shape[0]), dict(source)
+        if isinstance(source, Mapping):
+            return [str(s) for s in source], self.resources.encode_genotypes(list(source.values()), genome_ver, mode)
+        if loci is None:
+            raise ValueError('A genotype matrix needs the locus id of each column in loci')
+        s_matrices = self.resources.encode_matrix(source, loci, genome_ver, mode)
+        return self._sample_names(samples, source.shape[0]), s_matrices
+
+    @staticmethod
+    def _sample_names(samples, n_samples):
+        if isinstance(samples, str) or len(samples) != n_samples:
+            raise ValueError(f'samples must name each of the {n_samples} rows')
+        return [str(s) for s in samples]
+
+    def score(self, sample_names, s_matrices):
+        """Score encoded samples with every model, see encode."""
+        return self.resources.predict(sample_names, s_matrices, self.cache)
+
+    def predict(self, source, samples='all', genome_ver=None, mode=None, loci=None):
+        """
+        Predict the ancestry of the samples of source, see encode for the accepted inputs.
+
+        returns
+        -------
+        AncestryResults - raw probabilities of every sample and model
+        """
+        return self.score(*self.encode(source, samples, genome_ver, mode, loci))
@@ -0,0 +1,415 @@
+import os
+import json
+import glob
+import logging
+import concurrent.futures
+import numpy as np
+
+from igm_churchill_ancestry.pipelines.ancestry_prediction import MODEL_FILES, load_model, predict_model
+from igm_churchill_ancestry.utilities.vcf2sparse import variant_index_path, load_snp_order
+from igm_churchill_ancestry.utilities.utilities import genotype_dictionary
+from igm_churchill_ancestry.utilities.results import AncestryResults
+from igm_churchill_ancestry.utilities.cache import model_checksum
+from igm_churchill_ancestry.utilities.metrics import inc
+
+'''
+Models, AIM indices and locus converters loaded once and reused for every sample.
+'''
+
+
+class ModelResources:
+    """
+    Everything one model needs to score samples: the column of every AIM in
+    the model's SNP order, the value of AIMs absent from a VCF and the
+    deserialized classifier.
+
+    args
+    ----
+    att_dir - matrix attribute directory of the model
+    ml_dir - machine learning model directory of the model
+    n_classes - number of classes
+    m_type - model name, e.g. gnomAD_continental
+    """
+
+    def __init__(self, att_dir, ml_dir, n_classes, m_type):
+        self.att_dir = att_dir
+        self.ml_dir = ml_dir
+        self.n_classes = n_classes
+        self.m_type = m_type
+        self.t = m_type.split('_')[0]
+        self.model_type = 'xgb' if 'gnomAD' in m_type else 'svm'
+        with open(variant_index_path(att_dir), 'r') as fin:
+            variant_container = json.load(fin)
+        o_snps = load_snp_order(att_dir)
+        # AIMs missing from the container are never filled in, see json_to_sparse_matrix
+        self.columns = {locus: j for j, locus in enumerate(o_snps) if locus in variant_container}
+        self.defaults = np.asarray([variant_container[locus] for locus in o_snps], dtype=np.int8)
+        self.model = load_model(ml_dir, self.model_type)
+        if self.model is None:
+            raise RuntimeError(f'Cannot load the {m_type} model from {ml_dir}')
+        self.checksum = model_checksum(ml_dir, MODEL_FILES[self.model_type])
+
+    @property
+    def n_snps(self):
+        return len(self.defaults)
+
+    def predict(self, s_matrix, cache=None):
+        """Probabilities of every row of s_matrix, see predict_model."""
+        return predict_model(s_matrix, self.ml_dir, self.n_classes, self.m_type, cache, model=self.model)
+
+    def encode(self, loci, codes, converter=None):
+        """
+        Encode genotypes read by parsing.parse_genotypes into model input rows.
+        Like vcf_to_json, the last record of a locus wins.
+
+        args
+        ----
+        loci - locus id of each record
+        codes - (n_records, n_samples) genotype codes
+        converter - locus converter dict of the model family, see ResourceSet.converter
+
+        returns
+        -------
+        sparse matrix with one row per sample
+        """
+        from scipy import sparse
+        last = {}
+        matched = 0
+        for k, locus in enumerate(loci):
+            j = self.columns.get(converter.get(locus, locus) if converter is not None else locus)
+            if j is not None:
+                last[j] = k
+                matched += 1
+        dense = np.tile(self.defaults, (codes.shape[1], 1))
+        if last:
+            js = np.fromiter(last.keys(), dtype=np.int64, count=len(last))
+            block = codes[np.fromiter(last.values(), dtype=np.int64, count=len(last))]
+            if (block < 0).any():
+                k = list(last.values())[int(np.argwhere(block < 0)[0][0])]
+                raise ValueError(f'Unknown genotype at {loci[k]}')
+            dense[:, js] = block.T
+        # counted per sample, like encode_sample
+        inc('snvstory_vcf_records_matched', matched * codes.shape[1], model=self.m_type)
+        inc('snvstory_aims_found', len(last) * codes.shape[1], model=self.m_type)
+        inc('snvstory_aims_expected', self.n_snps * codes.shape[1], model=self.m_type)
+        return sparse.csr_matrix(dense)
+
+
+class ResourceSet:
+    """
+    The resources of every model in var.R_DIRS, loaded once, with fast
+    encoding of VCF lines and genotype payloads into model input rows.
+    Encoding matches vcf_to_json followed by json_to_sparse_matrix.
+
+    args
+    ----
+    var - variables instance of a local resource folder
+    models - optional dict of model -> already loaded ModelResources, see ResourceLoader
+    converters - optional dict of path -> already loaded locus converter
+    """
+
+    def __init__(self, var, models=None, converters=None):
+        self.var = var
+        self.models = {}
+        for att_dir, ml_dir, n_classes, m_type in var.R_DIRS:
+            if models is not None and m_type in models:
+                self.models[m_type] = models[m_type]
+                continue
+            logging.info(f'Loading {m_type}')
+            self.models[m_type] = ModelResources(att_dir, ml_dir, n_classes, m_type)
+        self._converters = dict(converters or {})
+        self._aims = {}
+
+    def converter(self, genome_ver, mode, t):
+        """Locus converter dict of a model family, None if loci are used as is."""
+        path = self.var.JSON_CONVERTS[genome_ver][mode][t]
+        if path is None:
+            return None
+        if path not in self._converters:
+            with open(path, 'r') as fin:
+                self._converters[path] = json.load(fin)
+        return self._converters[path]
+
+    def _lookups(self, genome_ver, mode):
+        """Models grouped by the locus converter they share."""
+        groups = {}
+        for res in self.models.values():
+            converter = self.converter(genome_ver, mode, res.t)
+            groups.setdefault(id(converter), (converter, []))[1].append(res)
+        return list(groups.values())
+
+    def aim_loci(self, genome_ver='38', mode='WES'):
+        """
+        Locus ids, in the coordinates of genome_ver, that any model encodes, so
+        that readers of indexed genotypes (see plink.parse_plink) decode only
+        those records.
+        """
+        if (genome_ver, mode) not in self._aims:
+            loci = set()
+            for converter, models in self._lookups(genome_ver, mode):
+                columns = set().union(*(res.columns for res in models))
+                loci.update(columns)
+                if converter is not None:
+                    loci.update(locus for locus, converted in converter.items() if converted in columns)
+            self._aims[genome_ver, mode] = loci
+        return self._aims[genome_ver, mode]
+
+    def _empty(self, n_samples):
+        return {m_type: np.tile(res.defaults, (n_samples, 1)) for m_type, res in self.models.items()}
+
+    def encode_lines(self, lines, columns=(9,), genome_ver='38', mode='WES'):
+        """
+        Encode VCF lines for every model in a single pass over the file.
+
+        args
+        ----
+        lines - iterable of str or bytes VCF lines, header lines are skipped
+        columns - column index of every sample, 9 is the first sample
+        genome_ver - '37' or '38'
+        mode - 'WES' or 'WGS'
+
+        returns
+        -------
+        s_matrices - dict of model -> sparse matrix with one row per sample
+        """
+        from scipy import sparse
+        lookups = self._lookups(genome_ver, mode)
+        dense = self._empty(len(columns))
+        gt_codes = {}
+        scanned = 0
+        matched = dict.fromkeys(self.models, 0)
+        found = {m_type: set() for m_type in self.models}
+        for line in lines:
+            if isinstance(line, bytes):
+                line = line.decode('utf-8')
+            if line.startswith('#'):
+                continue
+            values = line.strip().split('\t')
+            if len(values) < 5:
+                continue
+            scanned += 1
+            locus_id = values[0] + '_' + values[1] + '_' + values[3] + '_' + values[4]
+            for converter, models in lookups:
+                locus = converter.get(locus_id, locus_id) if converter is not None else locus_id
+                for res in models:
+                    j = res.columns.get(locus)
+                    if j is None:
+                        continue
+                    matched[res.m_type] += 1
+                    found[res.m_type].add(j)
+                    row = dense[res.m_type]
+                    for i, c in enumerate(columns):
+                        genotype = values[c][:3]
+                        code = gt_codes.get(genotype)
+                        if code is None:
+                            code = gt_codes[genotype] = genotype_dictionary(genotype)
+                        row[i, j] = code
+        # counted per sample, like encode_sample
+        inc('snvstory_vcf_records_scanned', scanned * len(columns))
+        for m_type, res in self.models.items():
+            inc('snvstory_vcf_records_matched', matched[m_type] * len(columns), model=m_type)
+            inc('snvstory_aims_found', len(found[m_type]) * len(columns), model=m_type)
+            inc('snvstory_aims_expected', res.n_snps * len(columns), model=m_type)
+        return {m_type: sparse.csr_matrix(x) for m_type, x in dense.items()}
+
+    def encode_codes(self, loci, codes, genome_ver='38', mode='WES'):
+        """
+        ModelResources.encode of every model, for the loci and genotype codes
+        read by parsing.parse_genotypes or plink.parse_plink.
+
+        returns
+        -------
+        s_matrices - dict of model -> sparse matrix with one row per sample
+        """
+        return {m_type: res.encode(loci, codes, self.converter(genome_ver, mode, res.t))
+                for m_type, res in self.models.items()}
+
+    def encode_genotypes(self, genotypes, genome_ver='38', mode='WES'):
+        """
+        Encode genotype payloads, one dict of locus id (chrom_pos_ref_alt, in
+        the coordinates of genome_ver) -> genotype per sample. Genotypes are
+        VCF style strings such as '0/1' or the numeric 0, 1 or 2, as numbers
+        or strings.
+
+        returns
+        -------
+        s_matrices - dict of model -> sparse matrix with one row per sample
+        """
+        from scipy import sparse
+        lookups = self._lookups(genome_ver, mode)
+        dense = self._empty(len(genotypes))
+        for i, sample in enumerate(genotypes):
+            for locus_id, genotype in sample.items():
+                code = genotype_dictionary(genotype) if isinstance(genotype, str) and not genotype.isdigit() else int(genotype)
+                if code not in (0, 1, 2):
+                    raise ValueError(f'Unknown genotype at {locus_id}: {genotype}')
+                for converter, models in lookups:
+                    locus = converter.get(locus_id, locus_id) if converter is not None else locus_id
+                    for res in models:
+                        j = res.columns.get(locus)
+                        if j is not None:
+                            dense[res.m_type][i, j] = code
+        return {m_type: sparse.csr_matrix(x) for m_type, x in dense.items()}
+
+    def encode_matrix(self, matrix, loci, genome_ver='38', mode='WES'):
+        """
+        Encode a (n_samples, n_loci) matrix of numeric genotypes (0, 1, 2) whose
+        columns are the locus ids in loci.
+
+        returns
+        -------
+        s_matrices - dict of model -> sparse matrix with one row per sample
+        """
+        from scipy import sparse
+        matrix = np.asarray(matrix.toarray() if sparse.issparse(matrix) else matrix)
+        if matrix.ndim != 2 or matrix.shape[1] != len(loci):
+            raise ValueError(f'Genotype matrix of shape {matrix.shape} does not match {len(loci)} loci')
+        dense = self._empty(matrix.shape[0])
+        for converter, models in self._lookups(genome_ver, mode):
+            converted = [converter.get(x, x) for x in loci] if converter is not None else list(loci)
+            for res in models:
+                src, dst = [], []
+                for k, locus in enumerate(converted):
+                    j = res.columns.get(locus)
+                    if j is not None:
+                        src.append(k)
+                        dst.append(j)
+                dense[res.m_type][:, dst] = matrix[:, src]
+        return {m_type: sparse.csr_matrix(x) for m_type, x in dense.items()}
+
+    def predict(self, samples, s_matrices, cache=None):
+        """
+        Score encoded samples with every model.
+
+        returns
+        -------
+        AncestryResults - raw probabilities of every sample
+        """
+        results = AncestryResults(samples, self.var)
+        if len(results):
+            for m_type, res in self.models.items():
+                results[m_type] = res.predict(s_matrices[m_type], cache)
+        return results
+
+
+def load_json(path):
+    with open(path, 'r') as fin:
+        return json.load(fin)
+
+
+def load_umap_fits(ml_dir, att_dir):
+    """SVD and UMAP fits and plot attributes of a continental model, see plot_umap.plot_umap_parser."""
+    from igm_churchill_ancestry.utilities.plot_umap import load_pca, load_umap, load_plot_attr
+    return load_pca(ml_dir), load_umap(ml_dir), load_plot_attr(att_dir)
+
+
+class ResourceLoader:
+    """
+    Loads the resources of every model in var.R_DIRS concurrently on a
+    thread pool: the ModelResources (AIM index, SNP order and classifier) of
+    each model, the locus converters of their families and, with umap, the
+    UMAP fits and plot attributes of the continental models. Loading starts
+    on construction, so it overlaps with whatever the caller does next, e.g.
+    downloading and probing an input, and each model can be used as soon as
+    its own resources are in.
+
+        loader = ResourceLoader(var)
+        ...
+        for m_type, res in loader.as_completed():
+            yprob = res.predict(res.encode(loci, codes, loader.converter(genome_ver, mode, res.t)))
+
+    args
+    ----
+    var - variables instance of a local resource folder
+    umap - also load the UMAP fits of the continental models that have them
+    workers - number of threads, one per model by default
+    """
+
+    def __init__(self, var, umap=False, workers=None):
+        self.var = var
+        self._pool = concurrent.futures.ThreadPoolExecutor(max_workers=workers or len(var.R_DIRS) or 1,
+                                                           thread_name_prefix='resources')
+        self._models = {m_type: self._pool.submit(ModelResources, att_dir, ml_dir, n_classes, m_type)
+                        for att_dir, ml_dir, n_classes, m_type in var.R_DIRS}
+        families = {m_type.split('_')[0] for m_type in self._models}
+        paths = {path for ver in var.JSON_CONVERTS.values() for mode in ver.values()
+                 for t, path in mode.items() if t in families and path is not None and os.path.exists(path)}
+        self._converters = {path: self._pool.submit(load_json, path) for path in sorted(paths)}
+        self._umap = {}
+        if umap:
+            for att_dir, ml_dir, n_classes, m_type in var.R_DIRS:
+                if 'continental' in m_type and glob.glob(ml_dir + '/*umap*.pkl'):
+                    self._umap[m_type] = self._pool.submit(load_umap_fits, ml_dir, att_dir)
+        # ResourceSet computing aim_loci, once every model is loaded
+        self._aim_resources = None
+        # nothing else is submitted, the threads exit once everything is loaded
+        self._pool.shutdown(wait=False)
+
+    @property
+    def models(self):
+        return list(self._models)
+
+    def ready(self, m_type):
+        """Whether the ModelResources of m_type finished loading (or failed to)."""
+        return self._models[m_type].done()
+
+    def model(self, m_type, timeout=None):
+        """ModelResources of m_type, waiting for it to load; raises the error that failed its loading."""
+        return self._models[m_type].result(timeout)
+
+    def converter(self, genome_ver, mode, t):
+        """Locus converter dict of a model family, None if loci are used as is."""
+        path = self.var.JSON_CONVERTS[genome_ver][mode][t]
+        if path is None:
+            return None
+        if path not in self._converters:
+            raise FileNotFoundError(f'Locus converter {path} of {t} was not found')
+        return self._converters[path].result()
+
+    def umap_fits(self, m_type):
+        """(svd, umap, plot attributes) of a continental model, None unless loaded with umap."""
+        future = self._umap.get(m_type)
+        return future.result() if future is not None else None
+
+    def as_completed(self, models=None):
+        """
+        Yield (m_type, ModelResources) of models (all by default) in the order
+        they finish loading.
+        """
+        futures = {self._models[m_type]: m_type for m_type in (models or self._models)}
+        for future in concurrent.futures.as_completed(futures):
+            yield futures[future], future.result()
+
+    def aim_loci(self, genome_ver='38', mode='WES'):
+        """ResourceSet.aim_loci, waiting for every model."""
+        if self._aim_resources is None:
+            self._aim_resources = self.resource_set()
+        return self._aim_resources.aim_loci(genome_ver, mode)
+
+    def wait(self):
+        """Wait for every resource to load, raising the first error, and for the loading threads to exit."""
+        for future in [*self._models.values(), *self._converters.values(), *self._umap.values()]:
+            future.result()
+        self._pool.shutdown(wait=True)
+        return self
+
+    def share(self, shared):
+        """
+        Wait for every resource and move the large arrays of the models and
+        UMAP fits into shared memory, see shared_arrays.SharedArrays. Called
+        before forking workers that inherit this loader.
+
+        returns
+        -------
+        int - bytes moved
+        """
+        self.wait()
+        before = shared.nbytes
+        for future in [*self._models.values(), *self._umap.values()]:
+            shared.share(future.result())
+        return shared.nbytes - before
+
+    def resource_set(self):
+        """ResourceSet of every loaded model and converter, waiting for them."""
+        converters = {path: future.result() for path, future in self._converters.items()}
+        return ResourceSet(self.var, {m_type: self.model(m_type) for m_type in self._models}, converters)
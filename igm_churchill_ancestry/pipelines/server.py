@@ -0,0 +1,241 @@
+import os
+import json
+import time
+import queue
+import logging
+import threading
+import socketserver
+import concurrent.futures
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+'''
+Long-running prediction service that keeps every model loaded between requests.
+'''
+
+
+class PredictionBatcher:
+    """
+    Scores requests on a single thread. Encoded samples wait in a bounded
+    queue; the batcher takes the first waiting request and every request that
+    arrives within batch_wait seconds, up to batch_size samples, and runs each
+    model once for the whole batch.
+
+    args
+    ----
+    predictor - AncestryPredictor
+    batch_size - maximum number of samples scored together
+    batch_wait - seconds to wait for more requests before scoring a batch
+    queue_size - maximum number of waiting requests, submit raises queue.Full beyond it
+    """
+
+    def __init__(self, predictor, batch_size=64, batch_wait=0.01, queue_size=256):
+        self.predictor = predictor
+        self.batch_size = batch_size
+        self.batch_wait = batch_wait
+        self.queue = queue.Queue(maxsize=queue_size)
+        self._thread = threading.Thread(target=self._run, name='prediction-batcher', daemon=True)
+        self._thread.start()
+
+    def submit(self, samples, s_matrices):
+        """Queue encoded samples and return a Future of their AncestryResults."""
+        future = concurrent.futures.Future()
+        self.queue.put_nowait((list(samples), s_matrices, future))
+        return future
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            batch = [item]
+            n_samples = len(item[0])
+            deadline = time.monotonic() + self.batch_wait
+            while n_samples < self.batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    item = self.queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                if item is None:
+                    self._score(batch)
+                    return
+                batch.append(item)
+                n_samples += len(item[0])
+            self._score(batch)
+
+    def _score(self, batch):
+        from scipy import sparse
+        try:
+            samples = [s for b in batch for s in b[0]]
+            s_matrices = {m_type: sparse.vstack([b[1][m_type] for b in batch], format='csr')
+                          for m_type in self.predictor.models}
+            results = self.predictor.score(samples, s_matrices)
+        except Exception as e:
+            logging.exception('Failed to score a batch')
+            for _, _, future in batch:
+                future.set_exception(e)
+            return
+        start = 0
+        for b_samples, _, future in batch:
+            future.set_result(results.take(range(start, start + len(b_samples))))
+            start += len(b_samples)
+        logging.debug(f'Scored a batch of {len(batch)} requests, {len(samples)} samples')
+
+    def close(self):
+        self.queue.put(None)
+        self._thread.join()
+
+
+def results_json(results, normalize=True):
+    """
+    JSON ready dict of the (normalized) probabilities of every sample:
+    {'samples': [...], 'models': {model: {'labels': [...], 'probabilities': [[...], ...]}}}
+    """
+    probs = results.normalized() if normalize else results
+    models = {}
+    for m_type in results.models:
+        models[m_type] = {'labels': [results.var.ABBR[x][0] for x in results.labels(m_type)],
+                          'probabilities': probs[m_type].astype(float).round(9).tolist()}
+    return {'samples': list(results.samples), 'models': models}
+
+
+class ForbiddenPath(ValueError):
+    """A requested vcf path outside the directory the service may read."""
+
+
+def resolve_vcf_path(path, vcf_root):
+    """
+    Real path of a requested vcf, relative paths taken from vcf_root. Paths
+    that resolve (symlinks included) outside vcf_root are refused, as are all
+    paths when the service has no vcf_root.
+    """
+    if vcf_root is None:
+        raise ForbiddenPath('vcf requests are disabled, start the service with --vcf-root')
+    root = os.path.realpath(vcf_root)
+    resolved = os.path.realpath(os.path.join(root, str(path)))
+    if os.path.commonpath([root, resolved]) != root:
+        raise ForbiddenPath(f'{path} is outside the vcf root')
+    return resolved
+
+
+def encode_request(predictor, payload, vcf_root=None):
+    """
+    Encode the samples of a request, either a VCF on the server's filesystem
+    or genotype payloads.
+
+    args
+    ----
+    payload - dict with optional genome_ver and mode (defaults of the predictor) and either
+              vcf: path to a vcf under vcf_root, samples: 'all' or a list of sample positions/names
+              genotypes: dict of sample name -> dict of locus id -> genotype
+    vcf_root - directory vcf paths are confined to, vcf requests are refused without it
+
+    returns
+    -------
+    sample_names - name of each sample
+    s_matrices - dict of model -> sparse matrix with one row per sample
+    """
+    genome_ver, mode = payload.get('genome_ver'), payload.get('mode')
+    if 'genotypes' in payload:
+        genotypes = payload['genotypes']
+        if not isinstance(genotypes, dict):
+            raise ValueError('genotypes must map sample names to {locus id: genotype}')
+        return predictor.encode(genotypes, genome_ver=genome_ver, mode=mode)
+    if 'vcf' in payload:
+        vcf = resolve_vcf_path(payload['vcf'], vcf_root)
+        return predictor.encode(vcf, payload.get('samples', 'all'), genome_ver, mode)
+    raise ValueError('Request needs either vcf or genotypes')
+
+
+class PredictionHandler(BaseHTTPRequestHandler):
+    """
+    GET /health - loaded models and queue depth
+    POST /predict - JSON request, see encode_request; 'normalize': false returns raw probabilities
+    """
+
+    protocol_version = 'HTTP/1.1'
+
+    def address_string(self):
+        # unix socket clients have no address
+        return self.client_address[0] if self.client_address else 'unix'
+
+    def log_message(self, format, *args):
+        logging.info(f'{self.address_string()} {format % args}')
+
+    def _send(self, status, body):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if self.path != '/health':
+            return self._send(404, {'error': f'Unknown path {self.path}'})
+        batcher = self.server.batcher
+        self._send(200, {'status': 'ok', 'models': batcher.predictor.models,
+                         'queued': batcher.queue.qsize()})
+
+    def do_POST(self):
+        if self.path != '/predict':
+            return self._send(404, {'error': f'Unknown path {self.path}'})
+        start = time.perf_counter()
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            payload = json.loads(self.rfile.read(length) or b'{}')
+        except Exception as e:
+            return self._send(400, {'error': str(e)})
+        # at most max_encoding requests encode at once
+        if not self.server.encoding.acquire(timeout=self.server.timeout_s):
+            return self._send(503, {'error': 'Too many requests being encoded, retry later'})
+        try:
+            samples, s_matrices = encode_request(self.server.batcher.predictor, payload, self.server.vcf_root)
+        except ForbiddenPath as e:
+            return self._send(403, {'error': str(e)})
+        except Exception as e:
+            return self._send(400, {'error': str(e)})
+        finally:
+            self.server.encoding.release()
+        try:
+            future = self.server.batcher.submit(samples, s_matrices)
+        except queue.Full:
+            return self._send(503, {'error': 'Prediction queue is full, retry later'})
+        try:
+            results = future.result(timeout=self.server.timeout_s)
+        except Exception as e:
+            return self._send(500, {'error': str(e)})
+        body = results_json(results, payload.get('normalize', True))
+        body['elapsed_ms'] = round((time.perf_counter() - start) * 1000, 3)
+        self._send(200, body)
+
+
+class ThreadingUnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def make_server(batcher, host='127.0.0.1', port=8080, socket_path=None, timeout_s=300, vcf_root=None,
+                max_encoding=4):
+    """
+    HTTP server over TCP, or over a unix socket when socket_path is given,
+    that handles every connection on its own thread.
+
+    args
+    ----
+    vcf_root - directory the vcf paths of requests are confined to, vcf requests are refused without it
+    max_encoding - maximum number of requests parsed and encoded at once, others wait up to timeout_s
+    """
+    if socket_path is not None:
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        server = ThreadingUnixHTTPServer(socket_path, PredictionHandler)
+    else:
+        server = ThreadingHTTPServer((host, port), PredictionHandler)
+    server.batcher = batcher
+    server.timeout_s = timeout_s
+    server.vcf_root = vcf_root
+    server.encoding = threading.BoundedSemaphore(max_encoding)
+    return server
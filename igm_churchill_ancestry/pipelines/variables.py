@@ -1,3 +1,6 @@
+import os
+
+
 def join_paths(path1, path2):
     path = path1 + path2
     return [path]
@@ -7,7 +10,9 @@ class variables:
     # static variables
     ext = ['.g.vcf', '.gvcf', 'vcf']
     ext_gz = [f'{x}.gz' for x in ext]
-    EXTENSIONS = tuple(ext + ext_gz)
+    # PLINK 1 filesets, named by their .bed, and BCFs
+    ext_binary = ['.bed', '.bcf']
+    EXTENSIONS = tuple(ext + ext_gz + ext_binary)
 
     def __init__(self, rsrc_root):
 
@@ -95,10 +100,51 @@ class variables:
         n_classes = [self.N_CLASSES_CONTINENTAL, self.N_CLASSES_SUBCONTINENTAL_EUR, self.N_CLASSES_SUBCONTINENTAL_EAS, self.N_CLASSES_1000_GENOMES_AMR, self.N_CLASSES_1000_GENOMES_AFR, self.N_CLASSES_1000_GENOMES_EAS, self.N_CLASSES_1000_GENOMES_EUR, self.N_CLASSES_1000_GENOMES_SAS, self.N_CLASSES_CONTINENTAL_NYGC, self.N_CLASSES_SGDP_CONTINENTAL]
         self.R_DIRS = list(zip(self.MATRIX_ATT_DIRS, self.MODEL_DIRS, n_classes, mode))
 
+        # sub continental models are normalized by the probability of their
+        # population in the continental model: model -> (parent model, parent index)
+        self.NORMALIZERS = {'gnomAD_eur': ('gnomAD_continental', 4), 'gnomAD_eas': ('gnomAD_continental', 3),
+                            '1kGP_amr': ('1kGP_continental', 2), '1kGP_afr': ('1kGP_continental', 4),
+                            '1kGP_eur': ('1kGP_continental', 0), '1kGP_sas': ('1kGP_continental', 3),
+                            '1kGP_eas': ('1kGP_continental', 1)}
+
+        self.RSRC_ROOT = rsrc_root
+
         # plotting axis order the plot is 2,5
         axis_order = [0, 2, 4, 6, 7, 5, 3, 8, 1, 9]
         self.axis_loc = dict(zip(mode, axis_order))
 
         # change names to something more descriptive
         subplt_titles = ['gnomAD_continental', 'gnomAD_eur', 'gnomAD_eas', '1KGP_amr', '1KGP_afr', '1KGP_eas', '1KGP_eur', '1KGP_sas', '1KGP_continental', 'SGDP_continental']
-        self.TITLES = dict(zip(mode, subplt_titles))
\ No newline at end of file
+        self.TITLES = dict(zip(mode, subplt_titles))
+
+    def select_models(self, models):
+        """
+        Restrict the models that are loaded and run to models and the
+        continental models they are normalized by, see NORMALIZERS.
+
+        args
+        ----
+        models - list of model names, e.g. ['gnomAD_eur', '1kGP_continental']
+        """
+        known = [m_type for _, _, _, m_type in self.R_DIRS]
+        unknown = [m for m in models if m not in known]
+        if unknown:
+            raise ValueError(f'Unknown models {unknown}. Choose from {known}')
+        selected = set(models) | {self.NORMALIZERS[m][0] for m in models if m in self.NORMALIZERS}
+        self.R_DIRS = [x for x in self.R_DIRS if x[3] in selected]
+        self.MATRIX_ATT_DIRS = [x[0] for x in self.R_DIRS]
+        self.MODEL_DIRS = [x[1] for x in self.R_DIRS]
+        return self
+
+    def resource_dirs(self):
+        """
+        Directories of the resource folder, relative to its root, that the
+        selected models need: their attribute and model directories and the
+        directories of their locus converters.
+        """
+        families = {m_type.split('_')[0] for _, _, _, m_type in self.R_DIRS}
+        converters = {path for ver in self.JSON_CONVERTS.values() for mode in ver.values()
+                      for t, path in mode.items() if t in families and path is not None}
+        dirs = self.MATRIX_ATT_DIRS + self.MODEL_DIRS + [os.path.dirname(x) for x in converters]
+        root = os.path.normpath(self.RSRC_ROOT)
+        return sorted({os.path.relpath(os.path.normpath(x), root) for x in dirs})
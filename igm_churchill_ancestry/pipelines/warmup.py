@@ -0,0 +1,87 @@
+import os
+import glob
+import time
+import logging
+import compileall
+import numpy as np
+
+from igm_churchill_ancestry.utilities.vcf2sparse import load_snp_order
+
+'''
+Warm the numba/UMAP and bytecode caches so that short-lived jobs start hot.
+'''
+
+
+# models whose UMAP embedding is plotted, see plot_umap_parser
+UMAP_MODELS = ['gnomAD_continental', '1kGP_continental', 'SGDP_continental']
+
+
+def timed(timings, stage, func, *args, **kwargs):
+    """Run func and record its wall time in seconds under stage."""
+    start = time.perf_counter()
+    out = func(*args, **kwargs)
+    timings[stage] = round(time.perf_counter() - start, 3)
+    logging.info(f'Warmup {stage}: {timings[stage]}s')
+    return out
+
+
+def synthetic_sample(att_dir, seed=0):
+    """A random genotype row (0, 1, 2) in the SNP order of a model."""
+    from scipy import sparse
+    n_snps = len(load_snp_order(att_dir))
+    rng = np.random.default_rng(seed)
+    return sparse.csr_matrix(rng.integers(0, 3, (1, n_snps)))
+
+
+def run_stages(var=None, compile_bytecode=True):
+    """
+    Run every cold-start stage once: bytecode compilation of the package,
+    importing umap (numba) and, per continental model with a UMAP fit,
+    unpickling the SVD/UMAP models and transforming a synthetic sample. The
+    first transform compiles the numba kernels, which are written to
+    NUMBA_CACHE_DIR when it is set.
+
+    returns
+    -------
+    timings - dict of stage -> seconds
+    """
+    from igm_churchill_ancestry.utilities.plot_umap import load_pca, load_umap, transform_input
+    timings = {}
+    if compile_bytecode:
+        package_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        timed(timings, 'compile_bytecode', compileall.compile_dir, package_dir, quiet=1)
+    timed(timings, 'import_umap', __import__, 'umap')
+    if var is None:
+        return timings
+    for att_dir, ml_dir, _, m_type in var.R_DIRS:
+        if m_type not in UMAP_MODELS:
+            continue
+        if not glob.glob(ml_dir + '/*umap*.pkl') or not glob.glob(ml_dir + '/*svd*.pkl'):
+            logging.info(f'Warmup: no UMAP fit in {ml_dir}, skipping {m_type}')
+            continue
+        pca, umap = timed(timings, f'load_{m_type}', lambda: (load_pca(ml_dir), load_umap(ml_dir)))
+        s_matrix = synthetic_sample(att_dir)
+        timed(timings, f'transform_{m_type}', transform_input, s_matrix, pca, umap)
+    return timings
+
+
+def savings(cold, warm):
+    """
+    Rows of (stage, cold seconds, warm seconds, saved seconds) for the stages
+    timed in both runs.
+    """
+    rows = []
+    for stage, cold_s in cold.items():
+        if stage in warm:
+            rows.append((stage, cold_s, warm[stage], round(cold_s - warm[stage], 3)))
+    return rows
+
+
+def format_savings(rows):
+    lines = [f"{'stage':<32}{'cold s':>10}{'warm s':>10}{'saved s':>10}"]
+    for stage, cold_s, warm_s, saved in rows:
+        lines.append(f'{stage:<32}{cold_s:>10.3f}{warm_s:>10.3f}{saved:>10.3f}')
+    if rows:
+        total = [round(sum(r[i] for r in rows), 3) for i in (1, 2, 3)]
+        lines.append(f"{'total':<32}{total[0]:>10.3f}{total[1]:>10.3f}{total[2]:>10.3f}")
+    return '\n'.join(lines)
@@ -0,0 +1,226 @@
+import re
+import zlib
+import struct
+import numpy as np
+
+'''
+BCF2 files read as genotype codes from their typed binary records, without writing or splitting vcf lines.
+'''
+
+
+BCF_EXTENSIONS = ('.bcf',)
+BCF_MAGIC = b'BCF\x02'
+GZIP_MAGIC = b'\x1f\x8b'
+# numpy type and size of each typed value type: missing, int8, int16, int32, float and char
+TYPES = {0: (np.uint8, 0), 1: (np.int8, 1), 2: (np.int16, 2), 3: (np.int32, 4), 5: (np.float32, 4), 7: (np.uint8, 1)}
+# the missing value and the end of a shorter vector of each integer type
+INT_MISSING = {1: -0x80, 2: -0x8000, 3: -0x80000000}
+INT_VECTOR_END = {1: -0x7f, 2: -0x7fff, 3: -0x7fffffff}
+
+
+class BgzfReader:
+    """
+    Minimal reader of BGZF (blocked gzip, as written by bgzip and bcftools),
+    each block inflated on its own as it is needed.
+    """
+
+    def __init__(self, path):
+        self._fin = open(path, 'rb')
+        self._data = b''
+        self._pos = 0
+
+    def _block(self):
+        header = self._fin.read(12)
+        if len(header) < 12:
+            return None
+        if header[:2] != GZIP_MAGIC or not header[3] & 4:
+            raise ValueError(f'{self._fin.name} is not BGZF compressed')
+        xlen = struct.unpack_from('<H', header, 10)[0]
+        extra = self._fin.read(xlen)
+        # the BC subfield holds the block size minus one
+        bsize, i = None, 0
+        while i + 4 <= len(extra):
+            length = struct.unpack_from('<H', extra, i + 2)[0]
+            if extra[i:i + 2] == b'BC':
+                bsize = struct.unpack_from('<H', extra, i + 4)[0] + 1
+            i += 4 + length
+        if bsize is None:
+            raise ValueError(f'{self._fin.name} has a gzip block without a BGZF block size')
+        cdata = self._fin.read(bsize - xlen - 20)
+        crc, isize = struct.unpack('<II', self._fin.read(8))
+        data = zlib.decompress(cdata, -15)
+        if len(data) != isize or zlib.crc32(data) != crc:
+            raise ValueError(f'{self._fin.name} has a corrupt BGZF block')
+        return data
+
+    def read(self, n):
+        """Up to n bytes, fewer only at the end of the file."""
+        while len(self._data) - self._pos < n:
+            block = self._block()
+            if block is None:
+                break
+            self._data = self._data[self._pos:] + block
+            self._pos = 0
+        data = self._data[self._pos:self._pos + n]
+        self._pos += len(data)
+        return data
+
+    def close(self):
+        self._fin.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def open_bcf(path):
+    """Binary reader of a BCF, BGZF compressed (the default of bcftools) or not."""
+    with open(path, 'rb') as fin:
+        magic = fin.read(2)
+    return BgzfReader(path) if magic == GZIP_MAGIC else open(path, 'rb')
+
+
+def read_header(fin):
+    """The text header of an open BCF, one str per line."""
+    magic = fin.read(5)
+    if magic[:4] != BCF_MAGIC:
+        raise ValueError('Not a BCF2 file')
+    l_text = struct.unpack('<I', fin.read(4))[0]
+    return [line + '\n' for line in fin.read(l_text).rstrip(b'\x00').decode('utf-8').splitlines()]
+
+
+def bcf_header(path):
+    """
+    The header lines of a BCF, ending with its #CHROM line, so that samples are
+    selected by position or name exactly as in a vcf, see select_samples.
+    """
+    with open_bcf(path) as fin:
+        return read_header(fin)
+
+
+def header_dictionaries(header):
+    """
+    The dictionaries BCF records index into: contig names, and the ids of the
+    FILTER, INFO and FORMAT lines, PASS first, both in header order unless
+    given an IDX.
+
+    returns
+    -------
+    contigs - dict of index -> contig name
+    strings - dict of id -> index
+    """
+    contigs, strings = {}, {'PASS': 0}
+    for line in header:
+        match = re.match(r'##(contig|FILTER|INFO|FORMAT)=<ID=([^,>]+)(.*)>', line)
+        if match is None:
+            continue
+        kind, name, rest = match.groups()
+        idx = re.search(r',IDX=(\d+)', rest)
+        if kind == 'contig':
+            contigs[int(idx.group(1)) if idx else len(contigs)] = name
+        elif name not in strings:
+            strings[name] = int(idx.group(1)) if idx else max(strings.values()) + 1
+    return contigs, strings
+
+
+def typed(buf, offset):
+    """
+    Descriptor of the typed value at offset.
+
+    returns
+    -------
+    t - value type, see TYPES
+    n - number of values
+    offset - offset of the first value
+    """
+    descriptor = buf[offset]
+    t, n = descriptor & 0xf, descriptor >> 4
+    offset += 1
+    if n == 15:
+        # the count follows as a typed integer
+        nt = buf[offset] & 0xf
+        dtype, size = TYPES[nt]
+        n = int(np.frombuffer(buf, dtype, 1, offset + 1)[0])
+        offset += 1 + size
+    return t, n, offset
+
+
+def genotype_codes(gt, t):
+    """
+    Genotype codes (see genotype_dictionary) of typed GT values, one row of
+    (allele index + 1) << 1 | phased per sample. As for the first three
+    characters of a vcf GT: missing alleles read like 0/0, and genotypes
+    that are missing or haploid are -1, not understood.
+    """
+    if gt.shape[1] < 2:
+        return np.full(gt.shape[0], -1, dtype=np.int8)
+    first, second = gt[:, 0].astype(np.int64), gt[:, 1].astype(np.int64)
+    a, b = first >> 1, second >> 1
+    codes = np.where(a == b, np.where(a <= 1, 0, 2), 1).astype(np.int8)
+    codes[(first == INT_MISSING[t]) | (second == INT_VECTOR_END[t])] = -1
+    return codes
+
+
+def parse_bcf(path, columns, aims=None):
+    """
+    parse_genotypes for a BCF: the locus id and GT codes of its records, only
+    those whose locus id is in aims when given, so that the genotypes of the
+    records no model uses are never decoded. CHROM, POS, REF and ALT come
+    from the shared part of each record and GT from its typed sample values.
+
+    args
+    ----
+    path - BCF, BGZF compressed or not
+    columns - vcf column index of every sample, 9 is the first sample, see bcf_header
+    aims - optional set of locus ids to read, e.g. ResourceSet.aim_loci
+
+    returns
+    -------
+    loci - locus id (chrom_pos_ref_alt) of each record read
+    codes - (n_records, n_samples) int8 genotype codes
+    """
+    samples = np.asarray(columns, dtype=np.int64) - 9
+    loci, rows = [], []
+    with open_bcf(path) as fin:
+        contigs, strings = header_dictionaries(read_header(fin))
+        gt_key = strings.get('GT')
+        missing = np.full(len(samples), -1, dtype=np.int8)
+        while True:
+            head = fin.read(8)
+            if len(head) < 8:
+                break
+            l_shared, l_indiv = struct.unpack('<II', head)
+            shared = fin.read(l_shared)
+            chrom, pos, rlen, qual, n_allele_info, n_fmt_sample = struct.unpack_from('<iiifII', shared)
+            n_allele = n_allele_info >> 16
+            # ID, then the alleles
+            t, n, offset = typed(shared, 24)
+            offset += n * TYPES[t][1]
+            alleles = []
+            for _ in range(n_allele):
+                t, n, offset = typed(shared, offset)
+                alleles.append(shared[offset:offset + n].rstrip(b'\x00').decode('utf-8'))
+                offset += n
+            locus = f"{contigs[chrom]}_{pos + 1}_{alleles[0]}_{','.join(alleles[1:]) or '.'}"
+            indiv = fin.read(l_indiv)
+            if aims is not None and locus not in aims:
+                continue
+            n_fmt, n_sample = n_fmt_sample >> 24, n_fmt_sample & 0xffffff
+            row = missing
+            offset = 0
+            for _ in range(n_fmt):
+                t, n, offset = typed(indiv, offset)
+                key = int(np.frombuffer(indiv, TYPES[t][0], 1, offset)[0])
+                offset += TYPES[t][1]
+                t, n, offset = typed(indiv, offset)
+                dtype, size = TYPES[t]
+                if key == gt_key:
+                    gt = np.frombuffer(indiv, dtype, n_sample * n, offset).reshape(n_sample, n)
+                    row = genotype_codes(gt[samples], t)
+                    break
+                offset += n_sample * n * size
+            loci.append(locus)
+            rows.append(row)
+    return loci, (np.vstack(rows) if rows else np.zeros((0, len(samples)), dtype=np.int8))
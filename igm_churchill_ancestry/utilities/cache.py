@@ -0,0 +1,139 @@
+import os
+import glob
+import uuid
+import hashlib
+import logging
+import numpy as np
+
+from igm_churchill_ancestry.utilities.metrics import inc
+
+'''
+Content-addressed on-disk cache of model outputs keyed by genotype-vector hash.
+'''
+
+
+_CHECKSUMS = {}
+
+
+def file_checksum(*paths):
+    """
+    sha256 of one or more files, memoized on path, size and modification time
+    so each model file is only read once per process.
+    """
+    h = hashlib.sha256()
+    for path in paths:
+        st = os.stat(path)
+        memo_key = (os.path.abspath(path), st.st_size, st.st_mtime_ns)
+        if memo_key not in _CHECKSUMS:
+            fh = hashlib.sha256()
+            with open(path, 'rb') as fin:
+                for chunk in iter(lambda: fin.read(1 << 20), b''):
+                    fh.update(chunk)
+            _CHECKSUMS[memo_key] = fh.hexdigest()
+        h.update(_CHECKSUMS[memo_key].encode('utf-8'))
+    return h.hexdigest()
+
+
+def model_checksum(ml_dir, pattern):
+    """Checksum of the files in ml_dir matching the glob pattern(s), e.g. '*.bin'."""
+    patterns = [pattern] if isinstance(pattern, str) else pattern
+    return file_checksum(*[glob.glob(os.path.join(ml_dir, p))[0] for p in patterns])
+
+
+def row_hashes(s_matrix):
+    """
+    Stable hash of every row of a sparse matrix, built from its shape, column
+    indices and values.
+
+    returns
+    -------
+    list - sha256 hex digest per row
+    """
+    s_matrix = s_matrix.tocsr()
+    s_matrix.sum_duplicates()
+    n_cols = np.asarray([s_matrix.shape[1]], dtype=np.int64).tobytes()
+    hashes = []
+    for i in range(s_matrix.shape[0]):
+        start, stop = s_matrix.indptr[i], s_matrix.indptr[i + 1]
+        h = hashlib.sha256(n_cols)
+        h.update(s_matrix.indices[start:stop].astype(np.int64).tobytes())
+        h.update(s_matrix.data[start:stop].astype(np.int64).tobytes())
+        hashes.append(h.hexdigest())
+    return hashes
+
+
+class PredictionCache:
+    """
+    Size-bounded LRU cache of probabilities and embeddings on local disk.
+    Entries are .npy files named by sha256(kind, model checksum, row hash);
+    a hit refreshes the file modification time, and the least recently used
+    files are evicted once the directory grows beyond max_bytes.
+
+    args
+    ----
+    cache_dir - directory holding the cache, created if missing
+    max_bytes - size bound of the cache directory
+    """
+
+    def __init__(self, cache_dir, max_bytes=1 << 30):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(cache_dir, exist_ok=True)
+        self._size = sum(e.stat().st_size for e in os.scandir(cache_dir) if e.name.endswith('.npy'))
+
+    @staticmethod
+    def key(kind, checksum, row_hash):
+        return hashlib.sha256(f'{kind}:{checksum}:{row_hash}'.encode('utf-8')).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, f'{key}.npy')
+
+    def get(self, key):
+        """Return the cached array of key or None."""
+        path = self._path(key)
+        try:
+            value = np.load(path)
+            os.utime(path)
+        except (OSError, ValueError):
+            self.misses += 1
+            inc('snvstory_cache_requests', cache='prediction', result='miss')
+            return None
+        self.hits += 1
+        inc('snvstory_cache_requests', cache='prediction', result='hit')
+        return value
+
+    def put(self, key, value):
+        """Store an array under key, evicting old entries if over the size bound."""
+        path = self._path(key)
+        tmp_path = f'{path}.{uuid.uuid4().hex}.tmp'
+        with open(tmp_path, 'wb') as fout:
+            np.save(fout, np.asarray(value))
+        self._size += os.path.getsize(tmp_path)
+        os.replace(tmp_path, path)
+        if self._size > self.max_bytes:
+            self.evict()
+
+    def evict(self):
+        """Remove least recently used entries until the cache fits in max_bytes."""
+        entries = []
+        for e in os.scandir(self.cache_dir):
+            if e.name.endswith('.npy'):
+                st = e.stat()
+                entries.append((st.st_mtime, st.st_size, e.path))
+        entries.sort()
+        self._size = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if self._size <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+                self._size -= size
+            except OSError:
+                pass
+        logging.debug(f'Prediction cache {self.cache_dir} evicted to {self._size} bytes')
+
+    def hit_ratio(self):
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
@@ -0,0 +1,131 @@
+import os
+import json
+import shutil
+import logging
+
+from igm_churchill_ancestry.utilities.flex import flex_input, flex_output
+from igm_churchill_ancestry.utilities.s3 import validate_s3_path, get_client
+from igm_churchill_ancestry.utilities.run_report import span
+
+'''
+Checkpoint manifest of completed inputs kept next to the outputs of a run.
+'''
+
+
+MANIFEST = 'snvstory_checkpoint.json'
+# outputs of one input that were published while it was running, see record_published
+PUBLISHED = '.snvstory_published.json'
+
+
+class Checkpoint:
+    """
+    Records every completed input, with the sha256 of its content, its stamp
+    (see input_stamp) and the outputs it produced, in a manifest stored in
+    the output location. A run that loads the manifest can skip inputs that
+    are already complete: by stamp before they are downloaded, or else by
+    content.
+
+    args
+    ----
+    output_dir - local directory or s3 path the run publishes to
+    work_dir - local directory for the working copy of the manifest
+    name - file name of the manifest, e.g. one per shard
+    """
+
+    def __init__(self, output_dir, work_dir, name=MANIFEST):
+        self.output_dir = output_dir
+        self.work_dir = work_dir
+        self.name = name
+        self.local_path = os.path.join(work_dir, name)
+        self.completed = {}
+
+    def load(self):
+        """Read the manifest of a previous run, if there is one."""
+        remote_path = os.path.join(self.output_dir, self.name)
+        try:
+            path = flex_input(remote_path, self.work_dir)
+            with open(path, 'r') as fin:
+                self.completed = json.load(fin)['completed']
+        except Exception as e:
+            logging.info(f'No checkpoint manifest loaded from {remote_path}: {e}')
+            self.completed = {}
+        return self
+
+    def is_complete(self, name, digest=None, stamp=None):
+        """Whether name was completed with the same stamp or, failing that, the same sha256."""
+        entry = self.completed.get(name)
+        if entry is None:
+            return False
+        if stamp is not None and entry.get('stamp') == stamp:
+            return True
+        return digest is not None and entry['sha256'] == digest
+
+    def mark_complete(self, name, digest, outputs, stamp=None):
+        """Record a completed input and publish the manifest."""
+        self.completed[name] = {'sha256': digest, 'outputs': sorted(outputs)}
+        if stamp is not None:
+            self.completed[name]['stamp'] = stamp
+        tmp_path = f'{self.local_path}.tmp'
+        with open(tmp_path, 'w') as fout:
+            json.dump({'completed': self.completed}, fout, indent=1, sort_keys=True)
+        os.replace(tmp_path, self.local_path)
+        publish_file(self.local_path, self.output_dir)
+
+
+def input_stamp(path, obj=None):
+    """
+    Identity of an input that is cheap to get without reading it: the ETag
+    and size of an s3 object, from obj (an entry of s3.list_s3_objects) when
+    given, or the size and modification time of a local file. None when the
+    input cannot be found.
+    """
+    try:
+        if path.startswith('s3://'):
+            if obj is None:
+                bucket, key = validate_s3_path(path)
+                head = get_client().head_object(Bucket=bucket, Key=key)
+                obj = {'ETag': head['ETag'].strip('"'), 'Size': head['ContentLength']}
+            return f"s3:{obj['ETag']}:{obj['Size']}"
+        st = os.stat(path)
+        return f'local:{st.st_size}:{st.st_mtime_ns}'
+    except Exception as e:
+        logging.info(f'No stamp of {path}: {e}')
+        return None
+
+
+def publish_file(path, output_dir):
+    """Copy one local file into a local directory or s3 path."""
+    if not output_dir.startswith('s3://'):
+        os.makedirs(output_dir, exist_ok=True)
+    with span('upload', file=os.path.basename(path)):
+        return flex_output(path, output_dir)
+
+
+def record_published(staging, paths):
+    """Note in the staging directory of an input which of its outputs were already published."""
+    with open(os.path.join(staging, PUBLISHED), 'w') as fout:
+        json.dump(sorted(os.path.basename(x) for x in paths), fout)
+
+
+def publish_outputs(staging, out_dir, output_dir):
+    """
+    Move the outputs of one input from its staging directory into out_dir and
+    publish each of them to output_dir, except those already published while
+    the input was running.
+
+    returns
+    -------
+    list - names of the published outputs
+    """
+    published = set()
+    if os.path.exists(os.path.join(staging, PUBLISHED)):
+        with open(os.path.join(staging, PUBLISHED), 'r') as fin:
+            published = set(json.load(fin))
+        os.remove(os.path.join(staging, PUBLISHED))
+    names = sorted(os.listdir(staging)) if os.path.isdir(staging) else []
+    for name in names:
+        path = os.path.join(out_dir, name)
+        shutil.move(os.path.join(staging, name), path)
+        if name not in published:
+            publish_file(path, output_dir)
+    return names
@@ -0,0 +1,125 @@
+import os
+import csv
+import logging
+
+from igm_churchill_ancestry.utilities.writers import FORMATS, get_writer, read_results, read_sources
+
+'''
+Manifest-driven cohort runs split into shards, and merging of the shard part-files.
+'''
+
+
+MANIFEST_COLUMNS = ['path', 'mode', 'genome_ver', 'samples']
+
+
+def read_manifest(path):
+    """
+    Read a cohort manifest: a TSV with the columns path, mode, genome_ver and
+    optionally samples ('all' or comma separated sample positions/names).
+    A header row is optional; empty lines and lines starting with '#' are skipped.
+
+    returns
+    -------
+    list of dict - one per manifest row
+    """
+    rows = []
+    with open(path, 'r', newline='') as fin:
+        for fields in csv.reader(fin, delimiter='\t'):
+            if not fields or not fields[0].strip() or fields[0].startswith('#'):
+                continue
+            fields = [x.strip() for x in fields]
+            if fields[0] == 'path':
+                continue
+            if len(fields) < 3:
+                raise ValueError(f'Manifest row needs at least path, mode and genome_ver: {fields}')
+            row = dict(zip(MANIFEST_COLUMNS, fields))
+            row.setdefault('samples', 'all')
+            row['samples'] = row['samples'] or 'all'
+            if row['mode'] not in ('WES', 'WGS') or row['genome_ver'] not in ('37', '38'):
+                raise ValueError(f'Invalid mode or genome_ver in manifest row: {fields}')
+            rows.append(row)
+    return rows
+
+
+def parse_shard(shard):
+    """Parse 'i/N' into (i, N), the zero-based shard index and the number of shards."""
+    try:
+        i, n = (int(x) for x in shard.split('/'))
+    except ValueError:
+        raise ValueError(f'Shard must look like i/N, e.g. 0/8: {shard}')
+    if n < 1 or not 0 <= i < n:
+        raise ValueError(f'Shard index must satisfy 0 <= i < N: {shard}')
+    return i, n
+
+
+def shard_rows(rows, i, n):
+    """
+    The contiguous slice of the manifest processed by shard i of n, so that
+    concatenating the shards in order restores manifest order.
+
+    returns
+    -------
+    list of (manifest row index, row)
+    """
+    start = len(rows) * i // n
+    stop = len(rows) * (i + 1) // n
+    return list(enumerate(rows))[start:stop]
+
+
+def part_name(i, n, output_format='csv'):
+    return f'part-{i:05d}-of-{n:05d}{FORMATS[output_format]}'
+
+
+def find_parts(paths):
+    """
+    Expand directories into their part-files, check that every shard of the
+    set is present exactly once and return the part-files in shard order.
+
+    raises
+    ------
+    ValueError - when shards are missing or given twice, or the part-files belong to sets of different sizes
+    """
+    parts = []
+    for path in paths:
+        if os.path.isdir(path):
+            parts += [os.path.join(path, x) for x in os.listdir(path) if x.startswith('part-')]
+        else:
+            parts.append(path)
+    parts = sorted(parts, key=os.path.basename)
+    if not parts:
+        raise ValueError(f'No part-files found in {paths}')
+    shards = [(int(os.path.basename(p).split('-')[1]), int(os.path.basename(p).split('-of-')[1].split('.')[0]))
+              for p in parts]
+    sizes = sorted({n for _, n in shards})
+    if len(sizes) > 1:
+        raise ValueError(f'Part-files of sets of {sizes} shards, e.g. a stale part next to a newer set: {parts}')
+    n = sizes[0]
+    found = [i for i, _ in shards]
+    duplicated = sorted({i for i in found if found.count(i) > 1})
+    if duplicated:
+        raise ValueError(f'Part-files given more than once for shards {duplicated} of {n}: ' +
+                         ', '.join(p for p, i in zip(parts, found) if i in duplicated))
+    if found != list(range(n)):
+        missing = sorted(set(range(n)) - set(found))
+        raise ValueError(f'Missing part-files for shards {missing} of {n}')
+    return parts
+
+
+def merge_results(paths, out_path, var, output_format='csv', sources=None):
+    """
+    Concatenate results files, in the given order, into one results table
+    with a source column naming the input of every sample, so that samples
+    of the same name in different inputs stay apart.
+
+    args
+    ----
+    paths - results files
+    sources - optional input of each path; by default the source column of
+              each file (e.g. part-files), or its file name when it has none
+    """
+    with get_writer(out_path, var, output_format, with_source=True) as writer:
+        for i, path in enumerate(paths):
+            logging.info(f'Merging {path}')
+            source = sources[i] if sources is not None else read_sources(path) or os.path.basename(path)
+            writer.write(read_results(path, var), source)
+    return out_path
@@ -0,0 +1,209 @@
+import os
+import json
+import time
+import socket
+import logging
+import threading
+
+'''
+Counters of a run, aggregated over its processes and exported as an OpenMetrics text file.
+'''
+
+
+# every metric exported: name -> (type, help). Counters are exported with the _total suffix.
+METRICS = {
+    'snvstory_samples_processed': ('counter', 'Samples scored or read from the results store.'),
+    'snvstory_vcf_records_scanned': ('counter', 'VCF records read, counted once per sample analyzed.'),
+    'snvstory_vcf_records_matched': ('counter', 'VCF records matching an ancestry informative locus of the model, per sample analyzed.'),
+    'snvstory_aims_found': ('counter', 'Distinct ancestry informative loci of the model present in the input, per sample analyzed.'),
+    'snvstory_aims_expected': ('counter', 'Ancestry informative loci of the model, per sample analyzed.'),
+    'snvstory_aim_coverage_ratio': ('gauge', 'Fraction of the ancestry informative loci of the model present in the inputs.'),
+    'snvstory_cache_requests': ('counter', 'Cache lookups by cache and result (hit or miss).'),
+    'snvstory_cache_hit_ratio': ('gauge', 'Fraction of cache lookups that were hits.'),
+    'snvstory_s3_transferred_bytes': ('counter', 'Bytes transferred to (upload) and from (download) s3.'),
+    'snvstory_stage_seconds': ('counter', 'Wall seconds spent in a stage of the pipeline, see the run report.'),
+    'snvstory_stage_spans': ('counter', 'Spans of a stage of the pipeline.'),
+    'snvstory_run_inputs': ('counter', 'Input files of the run by status.'),
+    'snvstory_run_wall_seconds': ('gauge', 'Wall seconds since the run started.'),
+    'snvstory_run_timestamp_seconds': ('gauge', 'Unix time the metrics were written.'),
+}
+
+# (name, sorted label items) -> value of this process, see inc
+_COUNTERS = {}
+_LOCK = threading.Lock()
+# the directory the counters of this process are saved to and the pid that started it, see start_metrics
+_SINK = {}
+
+
+def inc(name, value=1, **labels):
+    """Add value to a counter of this process, e.g. inc('snvstory_cache_requests', cache='prediction', result='hit')."""
+    key = (name, tuple(sorted((k, str(v)) for k, v in labels.items())))
+    with _LOCK:
+        _COUNTERS[key] = _COUNTERS.get(key, 0) + value
+
+
+def counters():
+    with _LOCK:
+        return dict(_COUNTERS)
+
+
+def start_metrics(directory):
+    """Save the counters of this process into directory from now on, see save_counters."""
+    if _SINK.get('pid') not in (None, os.getpid()):
+        # a forked worker starts with the counters of its parent, which saves them itself
+        with _LOCK:
+            _COUNTERS.clear()
+    os.makedirs(directory, exist_ok=True)
+    _SINK.update(dir=directory, pid=os.getpid())
+
+
+def save_counters():
+    """Replace this process' counter file in the metrics directory, a no-op when metrics were not started."""
+    directory = _SINK.get('dir')
+    if directory is None:
+        return
+    path = os.path.join(directory, f'{socket.gethostname()}-{os.getpid()}.json')
+    records = [[name, dict(labels), value] for (name, labels), value in counters().items()]
+    with open(f'{path}.tmp', 'w') as fout:
+        json.dump(records, fout)
+    os.replace(f'{path}.tmp', path)
+
+
+def load_counters(directory):
+    """Sum of the counter files of every process of a run."""
+    totals = {}
+    for name in sorted(os.listdir(directory)) if os.path.isdir(directory) else []:
+        if not name.endswith('.json'):
+            continue
+        try:
+            with open(os.path.join(directory, name), 'r') as fin:
+                records = json.load(fin)
+        except (OSError, ValueError) as e:
+            logging.warning(f'Skipping unreadable metrics file {name}: {e}')
+            continue
+        for metric, labels, value in records:
+            key = (metric, tuple(sorted(labels.items())))
+            totals[key] = totals.get(key, 0) + value
+    return totals
+
+
+def derived_gauges(totals):
+    """AIM coverage and cache hit ratios of summed counters."""
+    gauges = {}
+    expected = {dict(labels)['model']: v for (name, labels), v in totals.items() if name == 'snvstory_aims_expected'}
+    for (name, labels), v in totals.items():
+        if name == 'snvstory_aims_found' and expected.get(dict(labels)['model']):
+            gauges[('snvstory_aim_coverage_ratio', labels)] = v / expected[dict(labels)['model']]
+    lookups = {}
+    for (name, labels), v in totals.items():
+        if name == 'snvstory_cache_requests':
+            labels = dict(labels)
+            hits, total = lookups.get(labels['cache'], (0, 0))
+            lookups[labels['cache']] = (hits + (v if labels['result'] == 'hit' else 0), total + v)
+    for cache, (hits, total) in lookups.items():
+        if total:
+            gauges[('snvstory_cache_hit_ratio', (('cache', cache),))] = hits / total
+    return gauges
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _number(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def render(values):
+    """
+    OpenMetrics text of metric values, grouped into the families of METRICS.
+
+    args
+    ----
+    values - dict of (name, sorted label items) -> value
+
+    returns
+    -------
+    str - ending with '# EOF'
+    """
+    lines = []
+    for name, (kind, help_text) in METRICS.items():
+        samples = sorted((labels, v) for (n, labels), v in values.items() if n == name)
+        if not samples:
+            continue
+        lines.append(f'# TYPE {name} {kind}')
+        lines.append(f'# HELP {name} {help_text}')
+        suffix = '_total' if kind == 'counter' else ''
+        for labels, v in samples:
+            label_text = ','.join(f'{k}="{_escape(x)}"' for k, x in labels)
+            lines.append(f"{name}{suffix}{'{' + label_text + '}' if label_text else ''} {_number(v)}")
+    lines.append('# EOF')
+    return '\n'.join(lines) + '\n'
+
+
+def write_metrics(path, directory, stages=None, started=None, inputs=None):
+    """
+    Write the OpenMetrics file of a run: the summed counters of its
+    processes, their derived ratios, the stage summary of the run report and
+    run info. The file is replaced atomically, as the textfile collector of
+    node_exporter expects.
+
+    args
+    ----
+    path - local .prom file
+    directory - metrics directory of the run, see start_metrics
+    stages - optional per stage summary, see run_report.summarize
+    started - optional unix time the run started
+    inputs - optional dict of status -> number of input files
+
+    returns
+    -------
+    path
+    """
+    save_counters()
+    values = load_counters(directory)
+    values.update(derived_gauges(values))
+    for stage, s in (stages or {}).items():
+        values[('snvstory_stage_seconds', (('stage', stage),))] = s['wall_s']
+        values[('snvstory_stage_spans', (('stage', stage),))] = s['count']
+    for status, n in (inputs or {}).items():
+        values[('snvstory_run_inputs', (('status', status),))] = n
+    if started is not None:
+        values[('snvstory_run_wall_seconds', ())] = round(time.time() - started, 3)
+    values[('snvstory_run_timestamp_seconds', ())] = round(time.time(), 3)
+    if os.path.dirname(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(f'{path}.tmp', 'w') as fout:
+        fout.write(render(values))
+    os.replace(f'{path}.tmp', path)
+    return path
+
+
+class MetricsExporter:
+    """
+    Rewrites the metrics file every interval seconds in a background thread
+    while a run is going.
+
+    args
+    ----
+    write - callable writing the metrics file, e.g. a partial of write_metrics
+    interval - seconds between writes
+    """
+
+    def __init__(self, write, interval):
+        self.write = write
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._loop, daemon=True)
+        self._thread.start()
+
+    def _loop(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.write()
+            except Exception as e:
+                logging.error(f'Failed to write metrics: {e}')
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
@@ -1,5 +1,10 @@
+import os
+import sys
+import gzip
+import json
 import numpy as np
 from igm_churchill_ancestry.pipelines.variables import variables
+from igm_churchill_ancestry.utilities.utilities import genotype_dictionary
 
 
 def parse_vcf(o, gz_file):
@@ -112,3 +117,106 @@ def parse_multisample_vcf(o, gz_file, sample):
                 print(f'Failed to parse sample {sample} from line {line}. {e}')
                 return
     return parsed_vcf
+
+
+def parse_genotypes(o, columns):
+    """
+    Read the locus id and genotype codes of every record of a vcf in one
+    pass, independent of any model, so that it can run while the models load.
+
+    args
+    ----
+    o - iterable of str or bytes vcf lines, header lines are skipped
+    columns - column index of every sample, 9 is the first sample
+
+    returns
+    -------
+    loci - locus id (chrom_pos_ref_alt) of each record
+    codes - (n_records, n_samples) int8 genotype codes, see genotype_dictionary;
+            -1 where the genotype is not understood
+    """
+    loci = []
+    rows = []
+    gt_codes = {}
+    for line in o:
+        if isinstance(line, bytes):
+            line = line.decode('utf-8')
+        if line.startswith('#'):
+            continue
+        values = line.strip().split('\t')
+        if len(values) < 5:
+            continue
+        loci.append(values[0] + '_' + values[1] + '_' + values[3] + '_' + values[4])
+        row = []
+        for c in columns:
+            genotype = values[c][:3]
+            code = gt_codes.get(genotype)
+            if code is None:
+                try:
+                    code = genotype_dictionary(genotype)
+                except Exception:
+                    code = None
+                code = gt_codes[genotype] = -1 if code is None else code
+            row.append(code)
+        rows.append(row)
+    return loci, np.asarray(rows, dtype=np.int8).reshape(len(loci), len(columns))
+
+
+# extensions of newline delimited genotype records, one sample per line
+NDJSON_EXTENSIONS = ('.ndjson', '.jsonl', '.ndjson.gz', '.jsonl.gz')
+
+
+def _genotype_samples(payload, name):
+    """(sample, genotypes) of a JSON payload: {locus id: genotype} or {sample: {locus id: genotype}}."""
+    if not isinstance(payload, dict):
+        raise ValueError(f'Genotype JSON of {name} must be an object')
+    if payload and all(isinstance(v, dict) for v in payload.values()):
+        return [(str(sample), genotypes) for sample, genotypes in payload.items()]
+    return [(name, payload)]
+
+
+def parse_genotype_json(values, name='sample'):
+    """
+    Read the genotypes given to -j/--vcf_json, one sample at a time, without
+    any vcf. values are, in any mix:
+
+        2_238272966_T_C:0/1     locus id (chrom_pos_ref_alt):genotype of the sample `name`
+        {"2_238272966_T_C": 1}  inline JSON, see below
+        genotypes.json          {locus id: genotype} of a sample named after the file, or
+                                {sample: {locus id: genotype}} of many samples
+        cohort.ndjson           one {"sample": name, "genotypes": {locus id: genotype}} per line,
+                                also .jsonl, gzipped, or '-' for stdin
+
+    Genotypes are VCF style strings such as '0/1' or the numeric 0, 1 or 2.
+
+    returns
+    -------
+    generator of (sample name, dict of locus id -> genotype)
+    """
+    inline = {}
+    for value in values:
+        if value.lstrip().startswith('{'):
+            yield from _genotype_samples(json.loads(value), name)
+        elif value == '-' or value.endswith(NDJSON_EXTENSIONS):
+            fin = sys.stdin if value == '-' else (gzip.open(value, 'rt') if value.endswith('.gz') else open(value, 'r'))
+            try:
+                for n, line in enumerate(fin):
+                    if not line.strip():
+                        continue
+                    record = json.loads(line)
+                    if not isinstance(record, dict) or not isinstance(record.get('genotypes'), dict):
+                        raise ValueError(f'Line {n + 1} of {value} needs {{"sample": ..., "genotypes": {{...}}}}')
+                    yield str(record.get('sample', f'{name}{n}')), record['genotypes']
+            finally:
+                if fin is not sys.stdin:
+                    fin.close()
+        elif os.path.isfile(value):
+            with open(value, 'r') as fin:
+                yield from _genotype_samples(json.load(fin), os.path.basename(value).split('.')[0])
+        elif ':' in value:
+            locus_id, genotype = value.rsplit(':', 1)
+            inline[locus_id] = genotype
+        else:
+            raise ValueError(f'{value} is neither a locus_id:genotype pair, JSON nor a genotype file')
+    if inline:
+        yield name, inline
@@ -0,0 +1,155 @@
+import os
+import numpy as np
+
+'''
+PLINK 1 binary filesets (.bed/.bim/.fam) read as genotype codes, without converting them to vcf.
+'''
+
+
+PLINK_EXTENSIONS = ('.bed',)
+# SNP-major .bed files start with these bytes
+BED_MAGIC = b'\x6c\x1b\x01'
+# PLINK's numeric codes of the non-autosomal chromosomes, named like the vcfs it writes
+PLINK_CHROMS = {'23': 'X', '24': 'Y', '25': 'X', '26': 'MT'}
+# genotype code (see genotype_dictionary) of each 2-bit .bed value: homozygous A1, missing, heterozygous, homozygous A2.
+# A1 is the alternate allele and A2 the reference, missing reads like ./.
+A1_CODES = np.array([2, 0, 1, 0], dtype=np.int8)
+# the same with A1 as the reference allele, for variants whose alleles PLINK swapped
+A2_CODES = np.array([0, 0, 1, 2], dtype=np.int8)
+
+
+def plink_prefix(path):
+    """Path of a fileset without its extension, e.g. cohort for cohort.bed."""
+    return path[:-len('.bed')] if path.endswith(PLINK_EXTENSIONS) else path
+
+
+def read_fam(path):
+    """Individual id (second column) of every sample of the .fam of a fileset."""
+    with open(plink_prefix(path) + '.fam', 'r') as fin:
+        return [line.split()[1] for line in fin if line.strip()]
+
+
+def plink_header(path):
+    """
+    A vcf #CHROM line naming the samples of a fileset, so that samples are
+    selected by position or name exactly as in a vcf, see select_samples.
+    The first sample is column 9.
+    """
+    fields = ['#CHROM', 'POS', 'ID', 'REF', 'ALT', 'QUAL', 'FILTER', 'INFO', 'FORMAT'] + read_fam(path)
+    return ['\t'.join(fields) + '\n']
+
+
+class PlinkFileset:
+    """
+    A SNP-major PLINK 1 fileset. The .bed genotype matrix is memory mapped
+    and never read whole: only the bytes holding the selected samples of the
+    selected variants are paged in and decoded.
+
+    args
+    ----
+    path - the .bed of the fileset, its .bim and .fam are next to it
+    """
+
+    def __init__(self, path):
+        prefix = plink_prefix(path)
+        self.samples = read_fam(path)
+        chroms, positions, a1, a2 = [], [], [], []
+        with open(prefix + '.bim', 'r') as fin:
+            for line in fin:
+                values = line.split()
+                if len(values) < 6:
+                    continue
+                chroms.append(PLINK_CHROMS.get(values[0], values[0]))
+                positions.append(values[3])
+                a1.append(values[4])
+                a2.append(values[5])
+        self.chroms, self.positions, self.a1, self.a2 = chroms, positions, a1, a2
+        self.n_variants = len(positions)
+        self.bytes_per_variant = -(-len(self.samples) // 4)
+        with open(prefix + '.bed', 'rb') as fin:
+            magic = fin.read(len(BED_MAGIC))
+        if magic != BED_MAGIC:
+            raise ValueError(f'{prefix}.bed is not a SNP-major PLINK 1 .bed file')
+        size = os.path.getsize(prefix + '.bed') - len(BED_MAGIC)
+        if size != self.n_variants * self.bytes_per_variant:
+            raise ValueError(f'{prefix}.bed holds {size} bytes of genotypes, {self.n_variants} variants of '
+                             f'{len(self.samples)} samples need {self.n_variants * self.bytes_per_variant}')
+        self.bed = np.memmap(prefix + '.bed', dtype=np.uint8, mode='r', offset=len(BED_MAGIC),
+                             shape=(self.n_variants, self.bytes_per_variant))
+
+    def loci(self, swapped=False):
+        """Locus id (chrom_pos_ref_alt) of every variant, A2 taken as the reference unless swapped."""
+        ref, alt = (self.a1, self.a2) if swapped else (self.a2, self.a1)
+        return [f'{c}_{p}_{r}_{a}' for c, p, r, a in zip(self.chroms, self.positions, ref, alt)]
+
+    def select(self, aims=None):
+        """
+        Variants to read: all of them, or those whose locus id is in aims in
+        either allele order.
+
+        returns
+        -------
+        rows - index of each variant read, in .bim order
+        loci - locus id of each
+        swapped - whether each has its alleles swapped relative to the .bim
+        """
+        loci = self.loci()
+        if aims is None:
+            return np.arange(self.n_variants), loci, np.zeros(self.n_variants, dtype=bool)
+        rows, selected, swapped = [], [], []
+        for k, (locus, other) in enumerate(zip(loci, self.loci(swapped=True))):
+            if locus in aims:
+                rows.append(k)
+                selected.append(locus)
+                swapped.append(False)
+            elif other in aims:
+                rows.append(k)
+                selected.append(other)
+                swapped.append(True)
+        return np.asarray(rows, dtype=np.int64), selected, np.asarray(swapped, dtype=bool)
+
+    def genotypes(self, rows, columns, swapped=None):
+        """
+        Decode the genotype codes of some variants and samples.
+
+        args
+        ----
+        rows - variant indices
+        columns - sample indices, 0 is the first sample
+        swapped - optional bool per row, count the A2 allele of those rows instead
+
+        returns
+        -------
+        (len(rows), len(columns)) int8 genotype codes, see genotype_dictionary
+        """
+        rows = np.asarray(rows, dtype=np.int64)
+        columns = np.asarray(columns, dtype=np.int64)
+        # the byte of each selected sample in each selected variant, four samples to a byte, lowest bits first
+        packed = self.bed[rows[:, None], (columns // 4)[None, :]]
+        values = (packed >> (2 * (columns % 4)).astype(np.uint8)[None, :]) & 3
+        codes = A1_CODES[values]
+        if swapped is not None and np.any(swapped):
+            codes[swapped] = A2_CODES[values[swapped]]
+        return codes
+
+
+def parse_plink(path, columns, aims=None):
+    """
+    parse_genotypes for a PLINK fileset: the locus id and genotype codes of
+    its variants, only those whose locus id is in aims when given, so that
+    the variants no model uses are never decoded.
+
+    args
+    ----
+    path - .bed of the fileset
+    columns - vcf column index of every sample, 9 is the first sample, see plink_header
+    aims - optional set of locus ids to read, e.g. ResourceSet.aim_loci
+
+    returns
+    -------
+    loci - locus id (chrom_pos_ref_alt) of each variant read
+    codes - (n_variants, n_samples) int8 genotype codes
+    """
+    fileset = PlinkFileset(path)
+    rows, loci, swapped = fileset.select(aims)
+    return loci, fileset.genotypes(rows, np.asarray(columns, dtype=np.int64) - 9, swapped)
@@ -1,9 +1,10 @@
 import os
-import pandas as pd
-import matplotlib
-import matplotlib.pyplot as plt
+import contextlib
 import numpy as np
-from ast import literal_eval
+
+from igm_churchill_ancestry.utilities.results import AncestryResults
+from igm_churchill_ancestry.utilities.writers import get_writer
+from igm_churchill_ancestry.utilities.run_report import span
 
 
 '''
@@ -15,43 +16,18 @@ r1 = 1.3  # Wedge plot radius
 color_dict = {'purple':'#B847A3', 'yellow':'#FBDF6C', 'orange':'#ED592A', 'grey':'#646464', 'blue':'#2FA4DC', 'pink':'#FFC1C1', 'red':'#DC2E31', 'green':'#2EDB7E'}
 
 
-# Normalize the sub continental model predictions using the continental probabilities
-def get_score_normalizers(data, var):
-    normalize_sub_continent = np.asarray(data['gnomAD_continental'])
-    normalize_1kg_continent = np.asarray(data['1kGP_continental'])
-    # Normalizing the subcontinent data
-    data['gnomAD_eur'] = np.asarray(data['gnomAD_eur']) * normalize_sub_continent[4] # Indicies are the positions of the sub populations in the coninental array
-    data['gnomAD_eas'] = np.asarray(data['gnomAD_eas']) * normalize_sub_continent[3]
-    data['1kGP_amr'] = np.asarray(data['1kGP_amr']) * normalize_1kg_continent[2]
-    data['1kGP_afr'] = np.asarray(data['1kGP_afr']) * normalize_1kg_continent[4]
-    data['1kGP_eur'] = np.asarray(data['1kGP_eur']) * normalize_1kg_continent[0]
-    data['1kGP_sas'] = np.asarray(data['1kGP_sas']) * normalize_1kg_continent[3]
-    data['1kGP_eas'] = np.asarray(data['1kGP_eas']) * normalize_1kg_continent[1]
-    # Get the label associated with the max prob and generate an independent col
-    top_hits = []
-    for c in data.index:
-        top_i = np.argsort(data[c])[-2:]
-        top_val = np.asarray(data[c])[top_i]
-        top_labels = [var.LABS_CONVERTER[c][x][0] for x in top_i]
-        lab_val = (top_labels, top_val.tolist())
-        top_hits.append(lab_val)
-    return data, top_hits
-
-
-def write_out_normed_df(data_list, t_list):
-    normed_df = pd.concat(data_list, axis=1).T
-    normed_df['total'] = t_list
-    return normed_df
-
-
-def transform_df(p):
-    df = pd.read_csv(p, index_col=0)
-    df = df.applymap(literal_eval)
-    df = df.applymap(np.asarray)
+# continental models summarized in donut plots, left to right
+DONUTS = [('gnomAD_continental', 'gnomAD\n'), ('1kGP_continental', '1kGP\n'), ('SGDP_continental', 'SGDP\n')]
+
+
+def transform_df(p, var):
+    """Load a results csv back into an AncestryResults."""
+    return AncestryResults.read_csv(p, var)
 
 
 # Plot all three models in separate donut plots
 def get_values_for_donut_separate(data, model_lab, var, ax):
+    import pandas as pd
     labs = [x[0] for x in list(var.LABS_CONVERTER[model_lab].values())]
     lab_zip = dict(zip(labs, data[model_lab]))
     df = pd.DataFrame(data=lab_zip.values(), columns=[model_lab], index=lab_zip.keys())
@@ -76,6 +52,7 @@ def get_values_for_donut_separate(data, model_lab, var, ax):
 
 
 def hex2rbg(hex_color):
+    import matplotlib.colors
     h = matplotlib.colors.to_rgba(hex_color)
     return h
 
@@ -97,17 +74,19 @@ def shaded_area(vals, alt_order):
 
 
 def plot_predictions_separate(data, var, sample_name: str, outdir: str):
+    # matplotlib is only imported once there is something to plot
+    import matplotlib.pyplot as plt
     fig = plt.figure(figsize=(11,15))
     gs = plt.GridSpec(7,6)
     with plt.style.context('classic'):
         # Add lolipop plots
-        for plot_ind, idx in enumerate(data.index):
+        for plot_ind, idx in enumerate(data):
             if plot_ind%2 == 0:
                 ax = fig.add_subplot(gs[plot_ind//2, 0:3])
             else:
                 ax = fig.add_subplot(gs[plot_ind//2, 3:])
 
-            vals = np.asarray(data.loc[idx])
+            vals = np.asarray(data[idx])
             anc_order = np.asarray([x[1] for x in list(var.LABS_CONVERTER[idx].values())])
             for i, x in enumerate(vals):
                 ax.plot((0, x), (anc_order[i], anc_order[i]), color='grey', linewidth=2, zorder=1)
@@ -126,16 +105,12 @@ def plot_predictions_separate(data, var, sample_name: str, outdir: str):
             ax.set_title(var.TITLES[idx])
             ax.set_xlim(-0.05, 1.25, auto=True)
 
-        # Add donut plots
-        ax = fig.add_subplot(gs[5, 0:2])
-        get_values_for_donut_separate(data, 'gnomAD_continental', var, ax)
-        ax.set_title('gnomAD\n')
-        ax = fig.add_subplot(gs[5, 2:4])
-        get_values_for_donut_separate(data, '1kGP_continental', var, ax)
-        ax.set_title('1kGP\n')
-        ax = fig.add_subplot(gs[5, 4:6])
-        get_values_for_donut_separate(data, 'SGDP_continental', var, ax)
-        ax.set_title('SGDP\n')
+        # Add donut plots of the continental models that were run
+        donuts = [(m, title) for m, title in DONUTS if m in data]
+        for i, (model_lab, title) in enumerate(donuts):
+            ax = fig.add_subplot(gs[5, 2 * i:2 * i + 2])
+            get_values_for_donut_separate(data, model_lab, var, ax)
+            ax.set_title(title)
         
         fig.suptitle(sample_name, fontsize=16)
         fig.patch.set_facecolor('#EDEDED')
@@ -143,17 +118,25 @@ def plot_predictions_separate(data, var, sample_name: str, outdir: str):
         gs.tight_layout(fig, rect=[0, 0.03, 1, 0.95])
         
     plt.savefig(os.path.join(outdir, f'{sample_name}.pdf'), bbox_inches='tight')
-
-
-def plot_parser(df, var, outdir, ofn):
-    data_list = []
-    t_list = []
-    for row in df.iterrows():
-        sample_name = row[0]
-        data = row[1]
-        data, top_hits = get_score_normalizers(data, var)
-        data_list.append(data)
-        t_list.append(top_hits)
-        plot_predictions_separate(data, var, sample_name, outdir)
-    normed_df = write_out_normed_df(data_list, t_list)
-    normed_df.to_csv(os.path.join(outdir, ofn))
+    plt.close(fig)
+
+
+def plot_parser(results, var, outdir, ofn, output_format='csv', plotted=None, publisher=None, writer=None):
+    """
+    Normalize the results, plot each sample and write the prediction table.
+    plotted optionally restricts the plots to these sample indices. With an
+    ArtifactPublisher the plots of a sample are uploaded while the next
+    sample is plotted. An open results writer is appended to, flushed as the
+    row group(s) of these results and left open, instead of writing ofn.
+    """
+    normed = results.normalized()
+    plotted = set(range(len(normed)) if plotted is None else plotted)
+    with contextlib.nullcontext(writer) if writer is not None else get_writer(os.path.join(outdir, ofn), var, output_format) as writer:
+        for i, sample_name in enumerate(normed.samples):
+            if i in plotted:
+                with span('plot', sample=sample_name):
+                    plot_predictions_separate(normed.sample(i), var, sample_name, outdir)
+                if publisher is not None:
+                    publisher.submit_new(outdir, exclude=(ofn,))
+            writer.write(normed.take([i]))
+        writer.flush()
@@ -1,10 +1,10 @@
 import os
-import pandas as pd
+import numpy as np
 import pickle
 import glob
 
-from bokeh.plotting import figure, output_file, save
-from bokeh.models import ColumnDataSource, CDSView, GroupFilter, HoverTool, Legend
+from igm_churchill_ancestry.utilities.cache import model_checksum, row_hashes
+from igm_churchill_ancestry.utilities.run_report import span
 
 '''
 Plot UMAP of sample fitted by all three models
@@ -34,6 +34,7 @@ def load_umap(ml_dir):
         return
 
 def load_plot_attr(att_dir):
+    import pandas as pd
     df_plot_path = glob.glob(att_dir + f'/*umap_attributes.csv')[0]
     try:
         df_plot_attr = pd.read_csv(df_plot_path, index_col=0)
@@ -48,7 +49,29 @@ def transform_input(s_matrix, pca, umap):
     return(embedding)
 
 
+def embed_input(s_matrix, ml_dir, cache=None, fits=None):
+    """
+    UMAP embedding of each row, served from the prediction cache when every
+    row is cached. fits are the already loaded (svd, umap), see
+    resources.ResourceLoader.
+    """
+    if cache is not None:
+        checksum = model_checksum(ml_dir, ['*svd*.pkl', '*umap*.pkl'])
+        keys = [cache.key('embedding', checksum, h) for h in row_hashes(s_matrix)]
+        cached = [cache.get(k) for k in keys]
+        if all(c is not None for c in cached):
+            return np.vstack(cached)
+    pca, umap = fits if fits is not None else (load_pca(ml_dir), load_umap(ml_dir))
+    embedding = transform_input(s_matrix, pca, umap)
+    if cache is not None:
+        for k, e in zip(keys, embedding):
+            cache.put(k, e)
+    return embedding
+
+
 def bokeh_gnomad(embedding, plot_attr, sample_name, outdir):
+    from bokeh.plotting import figure, output_file, save
+    from bokeh.models import ColumnDataSource, CDSView, GroupFilter, HoverTool, Legend
     # Hover labels
     source = ColumnDataSource(plot_attr)
 
@@ -86,6 +109,8 @@ def bokeh_gnomad(embedding, plot_attr, sample_name, outdir):
 
 
 def bokeh_1kgp(embedding, plot_attr, sample_name, outdir):
+    from bokeh.plotting import figure, output_file, save
+    from bokeh.models import ColumnDataSource, CDSView, GroupFilter, HoverTool, Legend
     # Hover labels
     source = ColumnDataSource(plot_attr)
 
@@ -123,6 +148,8 @@ def bokeh_1kgp(embedding, plot_attr, sample_name, outdir):
 
 
 def bokeh_sgdp(embedding, plot_attr, sample_name, outdir):
+    from bokeh.plotting import figure, output_file, save
+    from bokeh.models import ColumnDataSource, CDSView, GroupFilter, HoverTool, Legend
     # Hover labels
     source = ColumnDataSource(plot_attr)
 
@@ -162,16 +189,16 @@ def bokeh_sgdp(embedding, plot_attr, sample_name, outdir):
 
 
 
-def plot_umap_parser(s_matrix, ml_dir, att_dir, sample_name, outdir, m_type):
-    pca = load_pca(ml_dir)
-    umap = load_umap(ml_dir)
-    embedding = transform_input(s_matrix, pca, umap)
-    plot_attr = load_plot_attr(att_dir)
-
-    if m_type == 'gnomAD_continental':
-        bokeh_gnomad(embedding, plot_attr, sample_name, outdir)
-    elif m_type == '1kGP_continental':
-        bokeh_1kgp(embedding, plot_attr, sample_name, outdir)
-    elif m_type == 'SGDP_continental':
-        bokeh_sgdp(embedding, plot_attr, sample_name, outdir)
+def plot_umap_parser(s_matrix, ml_dir, att_dir, sample_name, outdir, m_type, cache=None, fits=None):
+    with span('embed', sample=sample_name[0], model=m_type):
+        embedding = embed_input(s_matrix, ml_dir, cache, fits[:2] if fits is not None else None)
+    with span('plot_umap', sample=sample_name[0], model=m_type):
+        plot_attr = fits[2] if fits is not None else load_plot_attr(att_dir)
+
+        if m_type == 'gnomAD_continental':
+            bokeh_gnomad(embedding, plot_attr, sample_name, outdir)
+        elif m_type == '1kGP_continental':
+            bokeh_1kgp(embedding, plot_attr, sample_name, outdir)
+        elif m_type == 'SGDP_continental':
+            bokeh_sgdp(embedding, plot_attr, sample_name, outdir)
 
@@ -0,0 +1,175 @@
+import os
+import json
+import time
+import uuid
+import fcntl
+import shutil
+import hashlib
+import logging
+
+from igm_churchill_ancestry.utilities.s3 import validate_s3_path, list_s3_objects, download_s3_file, transfer_files
+from igm_churchill_ancestry.utilities.metrics import inc
+
+'''
+Node-level cache of s3 resource folders shared by the jobs running on one host.
+'''
+
+
+STAMP = '.snvstory_verified'
+
+# shared locks on the entries used by this process, held until it exits so
+# that no other job evicts a resource folder that is still being read
+_HELD = {}
+
+
+def etag_matches(path, etag):
+    """
+    Compare a downloaded file with its s3 ETag. The ETag of a single part
+    upload is the md5 of the object; multipart ETags ('<md5>-<parts>') depend
+    on the part size and are not checked.
+    """
+    if '-' in etag:
+        return True
+    h = hashlib.md5()
+    with open(path, 'rb') as fin:
+        for chunk in iter(lambda: fin.read(1 << 20), b''):
+            h.update(chunk)
+    return h.hexdigest() == etag
+
+
+class ResourceCache:
+    """
+    Content-addressed cache of s3 resource folders. An entry is keyed by the
+    s3 prefix and the key, ETag and size of every object under it, so a
+    changed resource folder is downloaded into a new entry. A verified stamp
+    is written once every file has been checked against its size and ETag;
+    later jobs that find the stamp use the entry without downloading or
+    re-reading it. Downloads are serialized per entry with file locks, and
+    the least recently used entries not in use by any job are evicted once
+    the cache grows beyond max_bytes.
+
+    args
+    ----
+    cache_dir - local directory shared by the jobs of a host
+    max_bytes - size bound of the cached entries
+    """
+
+    def __init__(self, cache_dir, max_bytes=64 << 30):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        os.makedirs(os.path.join(cache_dir, 'entries'), exist_ok=True)
+        os.makedirs(os.path.join(cache_dir, 'locks'), exist_ok=True)
+
+    @staticmethod
+    def key(prefix, objects):
+        h = hashlib.sha256(prefix.encode('utf-8'))
+        for obj in sorted(objects, key=lambda x: x['Key']):
+            h.update(f"\0{obj['Key']}\0{obj['ETag']}\0{obj['Size']}".encode('utf-8'))
+        return h.hexdigest()
+
+    def entry_path(self, key):
+        return os.path.join(self.cache_dir, 'entries', key)
+
+    def _lock_file(self, name):
+        return open(os.path.join(self.cache_dir, 'locks', f'{name}.lock'), 'a+')
+
+    def _stamp(self, key):
+        try:
+            with open(os.path.join(self.entry_path(key), STAMP), 'r') as fin:
+                stamp = json.load(fin)
+        except (OSError, ValueError):
+            return None
+        return stamp if stamp.get('key') == key else None
+
+    def _acquire(self, key):
+        """Take a shared lock on a verified entry and mark it as recently used."""
+        if key in _HELD:
+            return True
+        fh = self._lock_file(key)
+        fcntl.flock(fh, fcntl.LOCK_SH)
+        if self._stamp(key) is None:
+            fh.close()
+            return False
+        os.utime(os.path.join(self.entry_path(key), STAMP))
+        _HELD[key] = fh
+        return True
+
+    def fetch(self, s3_prefix):
+        """
+        Local copy of an s3 resource folder, downloaded and verified on the
+        first use of its content on this host.
+
+        returns
+        -------
+        path - local directory of the resource folder
+        """
+        prefix = s3_prefix.rstrip('/') + '/'
+        bucket, _ = validate_s3_path(prefix)
+        objects = [x for x in list_s3_objects(prefix) if not x['Key'].endswith('/')]
+        if not objects:
+            raise ValueError(f'No objects found under {prefix}')
+        key = self.key(prefix, objects)
+        if self._acquire(key):
+            logging.info(f'Resource cache hit for {prefix}: {self.entry_path(key)}')
+            inc('snvstory_cache_requests', cache='resource', result='hit')
+            return self.entry_path(key)
+        inc('snvstory_cache_requests', cache='resource', result='miss')
+        with self._lock_file(f'{key}.download') as fh:
+            fcntl.flock(fh, fcntl.LOCK_EX)
+            # another job may have finished the download while this one waited
+            if self._stamp(key) is None:
+                self._download(bucket, prefix, objects, key)
+        if not self._acquire(key):
+            raise RuntimeError(f'Resource cache entry of {prefix} was removed before use')
+        # the new entry is in use, so only older entries can be evicted
+        self.evict()
+        return self.entry_path(key)
+
+    def _download(self, bucket, prefix, objects, key):
+        _, key_prefix = validate_s3_path(prefix)
+        path = self.entry_path(key)
+        tmp_path = f'{path}.tmp-{uuid.uuid4().hex}'
+        logging.info(f'Resource cache miss for {prefix}: downloading {len(objects)} files')
+        local_files = [os.path.join(tmp_path, obj['Key'][len(key_prefix):]) for obj in objects]
+        try:
+            for local in local_files:
+                os.makedirs(os.path.dirname(local), exist_ok=True)
+            transfer_files(download_s3_file, [(f"s3://{bucket}/{obj['Key']}", local) for obj, local in zip(objects, local_files)])
+            for obj, local in zip(objects, local_files):
+                if os.path.getsize(local) != obj['Size'] or not etag_matches(local, obj['ETag']):
+                    raise RuntimeError(f"Downloaded s3://{bucket}/{obj['Key']} does not match its size or ETag")
+            # an unverified entry left by an interrupted download is replaced
+            shutil.rmtree(path, ignore_errors=True)
+            os.rename(tmp_path, path)
+        except Exception:
+            shutil.rmtree(tmp_path, ignore_errors=True)
+            raise
+        stamp = {'key': key, 'prefix': prefix, 'n_files': len(objects),
+                 'bytes': sum(x['Size'] for x in objects), 'verified': time.strftime('%Y-%m-%dT%H:%M:%S')}
+        with open(os.path.join(path, f'{STAMP}.tmp'), 'w') as fout:
+            json.dump(stamp, fout)
+        os.replace(os.path.join(path, f'{STAMP}.tmp'), os.path.join(path, STAMP))
+
+    def evict(self):
+        """Remove least recently used entries, skipping those in use, until the cache fits in max_bytes."""
+        entries = []
+        for e in os.scandir(os.path.join(self.cache_dir, 'entries')):
+            stamp = self._stamp(e.name) if e.is_dir() else None
+            if stamp is not None:
+                entries.append((os.stat(os.path.join(e.path, STAMP)).st_mtime, stamp['bytes'], e.name))
+        entries.sort()
+        size = sum(x[1] for x in entries)
+        for _, n_bytes, key in entries:
+            if size <= self.max_bytes:
+                break
+            with self._lock_file(key) as fh:
+                try:
+                    fcntl.flock(fh, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except OSError:
+                    # in use by a running job
+                    continue
+                os.remove(os.path.join(self.entry_path(key), STAMP))
+                shutil.rmtree(self.entry_path(key), ignore_errors=True)
+                size -= n_bytes
+                logging.info(f'Resource cache evicted {key}')
+        return size
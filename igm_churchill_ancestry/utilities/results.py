@@ -0,0 +1,155 @@
+import csv
+import numpy as np
+
+'''
+Compact container for ancestry probabilities of every sample across every model.
+'''
+
+
+class AncestryResults:
+    """
+    Holds the probabilities of all samples x models x classes in a single
+    float32 array. Each model owns a contiguous block of columns, located
+    through the class offsets derived from var.R_DIRS.
+
+    args
+    ----
+    samples - sample names, one per row
+    var - variables instance that defines the model order and class counts
+    probs - optional (n_samples, n_total_classes) array of probabilities
+    """
+
+    def __init__(self, samples, var, probs=None):
+        self.var = var
+        self.samples = [str(s) for s in samples]
+        self.models = [m_type for _, _, _, m_type in var.R_DIRS]
+        n_classes = [n for _, _, n, _ in var.R_DIRS]
+        self.offsets = np.concatenate([[0], np.cumsum(n_classes)]).astype(int)
+        shape = (len(self.samples), int(self.offsets[-1]))
+        if probs is None:
+            self.probs = np.zeros(shape, dtype=np.float32)
+        else:
+            self.probs = np.ascontiguousarray(probs, dtype=np.float32).reshape(shape)
+
+    def __len__(self):
+        return len(self.samples)
+
+    def model_slice(self, m_type):
+        i = self.models.index(m_type)
+        return slice(self.offsets[i], self.offsets[i + 1])
+
+    def __getitem__(self, m_type):
+        """Return the (n_samples, n_classes) view of a single model."""
+        return self.probs[:, self.model_slice(m_type)]
+
+    def __setitem__(self, m_type, yprob):
+        self.probs[:, self.model_slice(m_type)] = np.asarray(yprob).reshape(len(self), -1)
+
+    def sample(self, index):
+        """Return a dict of model -> 1d probability view for one sample."""
+        row = self.probs[index]
+        return {m_type: row[self.offsets[i]:self.offsets[i + 1]] for i, m_type in enumerate(self.models)}
+
+    def labels(self, m_type):
+        """Class labels of a model in column order."""
+        return [x[0] for x in self.var.LABS_CONVERTER[m_type].values()]
+
+    def column_names(self):
+        """Flat '<model>.<label abbreviation>' name of every column of probs."""
+        return [f'{m_type}.{self.var.ABBR[label][0]}' for m_type in self.models for label in self.labels(m_type)]
+
+    def take(self, indices):
+        """Return a new AncestryResults restricted to the given sample rows."""
+        indices = np.asarray(indices, dtype=int)
+        return AncestryResults([self.samples[i] for i in indices], self.var, self.probs[indices])
+
+    @classmethod
+    def concat(cls, results, var):
+        """Stack several AncestryResults (same model layout) into one."""
+        samples = [s for r in results for s in r.samples]
+        if not results:
+            return cls(samples, var)
+        return cls(samples, var, np.vstack([r.probs for r in results]))
+
+    def normalized(self):
+        """
+        Normalize the sub continental model predictions using the
+        continental probabilities, see var.NORMALIZERS.
+
+        returns
+        -------
+        AncestryResults - a normalized copy
+        """
+        normed = AncestryResults(self.samples, self.var, self.probs.copy())
+        for m_type, (parent, index) in self.var.NORMALIZERS.items():
+            if m_type in self.models and parent in self.models:
+                normed[m_type] = self[m_type] * self[parent][:, index:index + 1]
+        return normed
+
+    def top_hits(self, n=2):
+        """
+        Get the labels associated with the n highest probabilities of every model.
+
+        returns
+        -------
+        dict - model -> (indices, values), both (n_samples, n) in ascending order
+        """
+        hits = {}
+        for m_type in self.models:
+            probs = self[m_type]
+            top_i = np.argsort(probs, axis=1, kind='stable')[:, -n:]
+            hits[m_type] = (top_i, np.take_along_axis(probs, top_i, axis=1))
+        return hits
+
+    def to_csv(self, path_or_buf, header=True, sources=None):
+        """
+        Write the results with one row per sample and one list-literal cell
+        per model, followed by the 'total' column of top hits. The layout
+        matches the historical SNVstory csv.
+
+        args
+        ----
+        path_or_buf - output path or an open text file to append to
+        header - write the header row
+        sources - optional input of each sample, written as a last 'source' column
+        """
+        cells = []
+        for m_type in self.models:
+            vals = np.char.mod('%.9g', self[m_type])
+            cells.append(['[' + ', '.join(row) + ']' for row in vals])
+        hits = self.top_hits()
+        totals = []
+        for i in range(len(self)):
+            total = []
+            for m_type in self.models:
+                labels = self.labels(m_type)
+                top_i, top_val = hits[m_type]
+                top_labels = ', '.join(repr(labels[x]) for x in top_i[i])
+                top_vals = ', '.join(np.char.mod('%.9g', top_val[i]))
+                total.append(f'([{top_labels}], [{top_vals}])')
+            totals.append('[' + ', '.join(total) + ']')
+        if isinstance(path_or_buf, str):
+            with open(path_or_buf, 'w', newline='') as fout:
+                return self.to_csv(fout, header, sources)
+        writer = csv.writer(path_or_buf)
+        extra = [] if sources is None else ['source']
+        if header:
+            writer.writerow([''] + self.models + ['total'] + extra)
+        for i, sample_name in enumerate(self.samples):
+            extra = [] if sources is None else [sources[i]]
+            writer.writerow([sample_name] + [c[i] for c in cells] + [totals[i]] + extra)
+
+    @classmethod
+    def read_csv(cls, path, var):
+        """
+        Load a results csv written by to_csv (or by older SNVstory releases)
+        parsing each model column in one pass rather than cell by cell.
+        """
+        import pandas as pd
+        df = pd.read_csv(path, index_col=0, dtype=str)
+        results = cls(df.index.tolist(), var)
+        table = str.maketrans('[],\n', '    ')
+        for m_type in results.models:
+            text = ' '.join(df[m_type].tolist()).translate(table)
+            results[m_type] = np.fromstring(text, dtype=np.float32, sep=' ')
+        return results
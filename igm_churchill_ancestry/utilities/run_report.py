@@ -0,0 +1,201 @@
+import os
+import sys
+import json
+import time
+import socket
+import logging
+import resource
+import threading
+import contextlib
+
+'''
+Per-stage timing and memory spans of a run, gathered into a JSON run report.
+'''
+
+
+REPORT = 'snvstory_run_report.json'
+
+# the report spans of this process are recorded into, see start_report
+_ACTIVE = {}
+
+
+def rss_mb():
+    """Current resident set size of this process in MiB, None where /proc is not available."""
+    try:
+        with open('/proc/self/statm', 'r') as fin:
+            return round(int(fin.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / (1 << 20), 1)
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def uss_mb():
+    """
+    Memory of this process in MiB that no other process shares, e.g. the
+    copy-on-write pages a forked worker has written to, None where
+    /proc/self/smaps_rollup is not available.
+    """
+    try:
+        with open('/proc/self/smaps_rollup', 'r') as fin:
+            kib = sum(int(line.split()[1]) for line in fin if line.startswith(('Private_Clean:', 'Private_Dirty:')))
+        return round(kib / 1024, 1)
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def peak_rss_mb(who=resource.RUSAGE_SELF):
+    """Peak resident set size in MiB of this process (or of its finished children)."""
+    peak = resource.getrusage(who).ru_maxrss
+    # bytes on macOS, KiB elsewhere
+    return round(peak / (1 << 20 if sys.platform == 'darwin' else 1 << 10), 1)
+
+
+class RunReport:
+    """
+    Records one JSON line per finished span into a file shared by the
+    processes of a run: the stage, its tags (e.g. sample and model), the
+    start, wall and cpu seconds, and the current and peak resident set size
+    and the unshared memory (uss) of the process at its end. Peak RSS is the
+    high-water mark of the process, so a span whose peak exceeds that of the
+    previous span raised it. The uss of a forked worker leaves out the pages
+    it still shares with its parent. Spans inherit the
+    tags of the spans they run in, e.g. the model spans within a sample span.
+
+    With profile_dir every span of the main thread is also run under cProfile
+    and its pstats are dumped to <profile_dir>/<pid>-<seq>-<stage>.pstats. The
+    profile of a span pauses while a span within it runs, so each dump holds
+    the calls of its own stage only.
+
+    args
+    ----
+    path - local file the spans are appended to
+    profile_dir - optional local directory of pstats dumps
+    """
+
+    def __init__(self, path, profile_dir=None):
+        self.path = path
+        self.profile_dir = profile_dir
+        self._seq = 0
+        self._lock = threading.Lock()
+        self._profilers = []
+        self._local = threading.local()
+        if profile_dir:
+            os.makedirs(profile_dir, exist_ok=True)
+
+    @contextlib.contextmanager
+    def span(self, stage, **tags):
+        profiler = None
+        with self._lock:
+            self._seq += 1
+            seq = self._seq
+        if self.profile_dir and threading.current_thread() is threading.main_thread():
+            import cProfile
+            profiler = cProfile.Profile()
+            if self._profilers:
+                self._profilers[-1].disable()
+            self._profilers.append(profiler)
+        outer = getattr(self._local, 'tags', {})
+        tags = {**outer, **{k: str(v) for k, v in tags.items() if v is not None}}
+        self._local.tags = tags
+        start, cpu_start = time.time(), time.process_time()
+        if profiler is not None:
+            profiler.enable()
+        error = None
+        try:
+            yield
+        except BaseException as e:
+            error = type(e).__name__
+            raise
+        finally:
+            self._local.tags = outer
+            if profiler is not None:
+                profiler.disable()
+                profiler.dump_stats(os.path.join(self.profile_dir, f'{os.getpid()}-{seq:05d}-{stage}.pstats'))
+                self._profilers.pop()
+                if self._profilers:
+                    self._profilers[-1].enable()
+            record = {'stage': stage, **tags,
+                      'start': round(start, 3), 'wall_s': round(time.time() - start, 4),
+                      'cpu_s': round(time.process_time() - cpu_start, 4),
+                      'rss_mb': rss_mb(), 'uss_mb': uss_mb(), 'peak_rss_mb': peak_rss_mb(), 'pid': os.getpid(),
+                      'thread': threading.current_thread().name}
+            if error is not None:
+                record['error'] = error
+            self._write(record)
+
+    def _write(self, record):
+        # one append per line, so the worker processes of a run can share the file
+        fd = os.open(self.path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+        try:
+            os.write(fd, (json.dumps(record) + '\n').encode('utf-8'))
+        finally:
+            os.close(fd)
+
+
+def start_report(path, profile_dir=None):
+    """Record the spans of this process into path from now on, keeping an already active report of path."""
+    if _ACTIVE.get('report') is None or _ACTIVE['report'].path != path:
+        _ACTIVE['report'] = RunReport(path, profile_dir)
+    return _ACTIVE['report']
+
+
+def stop_report():
+    _ACTIVE.clear()
+
+
+def span(stage, **tags):
+    """
+    Context manager timing a stage of the active report of this process; a
+    no-op when no report was started.
+
+        with span('predict', model=m_type):
+            ...
+    """
+    report = _ACTIVE.get('report')
+    if report is None:
+        return contextlib.nullcontext()
+    return report.span(stage, **tags)
+
+
+def read_spans(path):
+    if not os.path.exists(path):
+        return []
+    with open(path, 'r') as fin:
+        return [json.loads(line) for line in fin if line.strip()]
+
+
+def summarize(spans):
+    """
+    Per stage totals of spans: count, total and max wall seconds, total cpu
+    seconds and the max peak RSS, slowest stage first.
+    """
+    stages = {}
+    for x in spans:
+        s = stages.setdefault(x['stage'], {'count': 0, 'wall_s': 0.0, 'max_wall_s': 0.0, 'cpu_s': 0.0, 'peak_rss_mb': 0.0})
+        s['count'] += 1
+        s['wall_s'] += x['wall_s']
+        s['cpu_s'] += x['cpu_s']
+        s['max_wall_s'] = max(s['max_wall_s'], x['wall_s'])
+        s['peak_rss_mb'] = max(s['peak_rss_mb'], x['peak_rss_mb'] or 0.0)
+    for s in stages.values():
+        s['wall_s'], s['cpu_s'] = round(s['wall_s'], 4), round(s['cpu_s'], 4)
+    return dict(sorted(stages.items(), key=lambda kv: -kv[1]['wall_s']))
+
+
+def write_report(spans_path, out_path, started, **info):
+    """
+    Write the run report: run info, wall seconds since started, the peak RSS
+    of this process and its workers, the per stage summary and every span.
+
+    returns
+    -------
+    out_path
+    """
+    spans = read_spans(spans_path)
+    report = {'host': socket.gethostname(), 'argv': sys.argv[1:], **info,
+              'wall_s': round(time.time() - started, 3),
+              'peak_rss_mb': max([peak_rss_mb(), peak_rss_mb(resource.RUSAGE_CHILDREN)] + [x['peak_rss_mb'] or 0.0 for x in spans]),
+              'stages': summarize(spans), 'spans': spans}
+    with open(out_path, 'w') as fout:
+        json.dump(report, fout, indent=1)
+    logging.info(f'Run report written to {out_path}')
+    return out_path
@@ -1,9 +1,57 @@
+import os
 import logging
-from typing import Tuple
+import functools
+import concurrent.futures
+from typing import List, Tuple
 from urllib.parse import urlparse
 
-import boto3
-from awscli.clidriver import create_clidriver
+from igm_churchill_ancestry.utilities.utilities import parse_size
+from igm_churchill_ancestry.utilities.metrics import inc
+
+# boto3 is imported by the transfers that use it, so local-only runs never
+# import it. One client per process is shared by every transfer; boto3
+# clients are thread safe but must not be shared across forked processes.
+
+_TRANSFER = {
+    'chunk_size': parse_size(os.environ.get('SNVSTORY_S3_CHUNK_SIZE', '64M')),
+    'concurrency': int(os.environ.get('SNVSTORY_S3_CONCURRENCY', 16)),
+}
+
+
+def configure_transfers(chunk_size=None, concurrency: int = None) -> None:
+    """
+    Set the multipart chunk size (bytes or e.g. '64M') and the number of
+    connections one transfer uses at once: the parts of a single file, or the
+    files of a directory times the parts of each, see transfer_files.
+    Defaults come from SNVSTORY_S3_CHUNK_SIZE and SNVSTORY_S3_CONCURRENCY.
+    """
+    if chunk_size is not None:
+        _TRANSFER['chunk_size'] = parse_size(chunk_size)
+    if concurrency is not None:
+        _TRANSFER['concurrency'] = max(1, int(concurrency))
+
+
+@functools.lru_cache(maxsize=None)
+def _client(pid: int, max_pool_connections: int):
+    import boto3
+    from botocore.config import Config
+    return boto3.session.Session().client("s3", config=Config(max_pool_connections=max_pool_connections))
+
+
+def get_client():
+    """
+    The pooled s3 client of this process. A transfer opens at most
+    concurrency connections, the other half of the pool serves a concurrent
+    transfer (e.g. background publishing) and single requests.
+    """
+    return _client(os.getpid(), 2 * _TRANSFER['concurrency'])
+
+
+def transfer_config(concurrency: int = None):
+    """Multipart settings of one file moved with up to concurrency parts at once, by default the configured one."""
+    from boto3.s3.transfer import TransferConfig
+    return TransferConfig(multipart_threshold=_TRANSFER['chunk_size'], multipart_chunksize=_TRANSFER['chunk_size'],
+                          max_concurrency=concurrency or _TRANSFER['concurrency'])
 
 
 def validate_s3_path(s3_url: str) -> Tuple[str, str]:
@@ -15,45 +63,99 @@ def validate_s3_path(s3_url: str) -> Tuple[str, str]:
     return bucket, path
 
 
-def download_s3_file(s3_url: str, local_file: str) -> None:
-    """Download file from s3 locally."""
+def list_s3_objects(s3_url: str) -> list:
+    """List every object under an s3 prefix as dicts with Key, ETag and Size."""
+    bucket, prefix = validate_s3_path(s3_url)
+    objects = []
+    for page in get_client().get_paginator("list_objects_v2").paginate(Bucket=bucket, Prefix=prefix):
+        objects += [{'Key': x['Key'], 'ETag': x['ETag'].strip('"'), 'Size': x['Size']}
+                    for x in page.get('Contents', [])]
+    return objects
+
+
+def download_s3_file(s3_url: str, local_file: str, concurrency: int = None) -> None:
+    """Download file from s3 locally, with up to concurrency parts at once."""
     bucket, key = validate_s3_path(s3_url)
-    client = boto3.client("s3")
     logging.info(f"Downloading {s3_url} to {local_file}")
-    client.download_file(bucket, key, local_file)
+    get_client().download_file(bucket, key, local_file, Config=transfer_config(concurrency))
+    inc('snvstory_s3_transferred_bytes', os.path.getsize(local_file), direction='download')
 
 
-def upload_s3_file(local_file: str, s3_url: str) -> None:
-    """Upload a local file to s3."""
+def upload_s3_file(local_file: str, s3_url: str, concurrency: int = None) -> None:
+    """Upload a local file to s3, with up to concurrency parts at once."""
     bucket, key = validate_s3_path(s3_url)
-    client = boto3.client("s3")
     logging.info(f"Uploading {local_file} to {s3_url}")
-    client.upload_file(local_file, bucket, key)
+    get_client().upload_file(local_file, bucket, key, Config=transfer_config(concurrency))
+    inc('snvstory_s3_transferred_bytes', os.path.getsize(local_file), direction='upload')
 
 
-def download_s3_directory(s3_dir_name: str, local_dir_name: str) -> None:
-    """Validate the s3 url, create cmd, download."""
-    validate_s3_path(s3_dir_name)
-    cmd = [
-        's3', 'cp', '--recursive', '--no-progress',
-        s3_dir_name, local_dir_name
-    ]
-    logging.info(f"Downloading {s3_dir_name} to {local_dir_name}")
-    rc = create_clidriver().main(cmd)
-    if rc != 0:
-        raise RuntimeError(
-            f"There was an error downloading the directory. {cmd}")
+def file_concurrency(n_files: int) -> Tuple[int, int]:
+    """
+    Split the configured concurrency between the files moved at once and
+    the parts of each, so that their product never exceeds it and the
+    connections stay within the client's pool.
+
+    returns
+    -------
+    files - number of files moved at once
+    parts - number of parts of each file moved at once
+    """
+    concurrency = _TRANSFER['concurrency']
+    files = max(1, min(concurrency, n_files))
+    return files, max(1, concurrency // files)
+
+
+def transfer_files(transfer, pairs: List[Tuple[str, str]]) -> None:
+    """
+    Run transfer(source, destination, concurrency=parts) for every pair,
+    concurrently, see file_concurrency.
+
+    raises
+    ------
+    RuntimeError - naming every pair that failed, after all transfers finished
+    """
+    failed = []
+    files, parts = file_concurrency(len(pairs))
+    with concurrent.futures.ThreadPoolExecutor(max_workers=files) as pool:
+        futures = {pool.submit(transfer, src, dst, concurrency=parts): (src, dst) for src, dst in pairs}
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                future.result()
+            except Exception as e:
+                logging.error(f"Failed to transfer {futures[future][0]} to {futures[future][1]}: {e}")
+                failed.append(futures[future])
+    if failed:
+        raise RuntimeError(f"There was an error transferring {len(failed)} of {len(pairs)} files: {sorted(failed)}")
+
+
+def _download_object(s3_url: str, local_file: str, concurrency: int = None) -> None:
+    os.makedirs(os.path.dirname(local_file) or '.', exist_ok=True)
+    download_s3_file(s3_url, local_file, concurrency)
+
+
+def download_s3_directory(s3_dir_name: str, local_dir_name: str, exclude=()) -> None:
+    """
+    Download every object under an s3 prefix into a local directory, like `aws s3 cp --recursive`,
+    except those whose path relative to the prefix is in exclude.
+    """
+    bucket, prefix = validate_s3_path(s3_dir_name)
+    prefix = f"{prefix.rstrip('/')}/" if prefix.strip('/') else ''
+    objects = [x for x in list_s3_objects(f"s3://{bucket}/{prefix}")
+               if not x['Key'].endswith('/') and x['Key'][len(prefix):] not in exclude]
+    logging.info(f"Downloading {s3_dir_name} to {local_dir_name}: {len(objects)} files")
+    os.makedirs(local_dir_name, exist_ok=True)
+    transfer_files(_download_object, [(f"s3://{bucket}/{x['Key']}", os.path.join(local_dir_name, x['Key'][len(prefix):]))
+                                      for x in objects])
 
 
 def upload_s3_directory(local_dir_name: str, s3_dir_name: str) -> None:
-    """Validate the s3 url, create cmd, upload."""
+    """Upload every file of a local directory under an s3 prefix, like `aws s3 cp --recursive`."""
     validate_s3_path(s3_dir_name)
-    cmd = [
-        's3', 'cp', '--recursive', '--no-progress',
-        local_dir_name, s3_dir_name
-    ]
-    logging.info(f"Uploading {local_dir_name} to {s3_dir_name}")
-    rc = create_clidriver().main(cmd)
-    if rc != 0:
-        raise RuntimeError(
-            f"There was an error uploading the directory. {cmd}")
\ No newline at end of file
+    pairs = []
+    for root, _, files in os.walk(local_dir_name):
+        for name in files:
+            path = os.path.join(root, name)
+            rel = os.path.relpath(path, local_dir_name).replace(os.sep, '/')
+            pairs.append((path, f"{s3_dir_name.rstrip('/')}/{rel}"))
+    logging.info(f"Uploading {local_dir_name} to {s3_dir_name}: {len(pairs)} files")
+    transfer_files(upload_s3_file, pairs)
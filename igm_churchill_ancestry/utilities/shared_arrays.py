@@ -0,0 +1,117 @@
+import os
+import logging
+import numpy as np
+from multiprocessing import shared_memory
+
+'''
+Large numpy arrays of loaded objects moved into shared memory, for processes forked after loading.
+'''
+
+
+# arrays smaller than this stay where they are
+MIN_SHARED_BYTES = 1 << 20
+# attribute levels searched for arrays below the object shared
+MAX_DEPTH = 8
+
+# packages whose objects are searched for arrays through their attributes, besides dicts, lists and tuples
+SEARCHED_PACKAGES = ('igm_churchill_ancestry', 'sklearn', 'scipy', 'umap', 'pynndescent', 'xgboost')
+
+
+class SharedArrays:
+    """
+    Moves the large numpy arrays held by objects, e.g. classifier weights,
+    UMAP embeddings and the data, indices and indptr of sparse matrices,
+    into multiprocessing.shared_memory blocks and points the objects at
+    them. Processes forked afterwards map the same pages rather than
+    inheriting them copy-on-write, so reference counting and garbage
+    collection in a worker never duplicate them.
+
+        shared = SharedArrays()
+        shared.share(model)
+        ... fork workers ...
+        shared.unlink()
+
+    args
+    ----
+    min_bytes - only arrays of at least this many bytes are moved
+    packages - top level packages of the objects searched through their attributes
+    """
+
+    def __init__(self, min_bytes=MIN_SHARED_BYTES, packages=SEARCHED_PACKAGES):
+        self.min_bytes = min_bytes
+        self.packages = tuple(packages)
+        self.blocks = []
+        self.nbytes = 0
+        self._pid = os.getpid()
+        self._unlinked = False
+
+    def share(self, obj):
+        """
+        Move the arrays reachable from obj through attributes, dicts, lists
+        and tuples into shared memory, in place. Returns obj, or its shared
+        copy when obj itself is a large array.
+        """
+        # id of every array moved -> (array, shared copy), so that aliases stay aliases
+        moved = {}
+        return self._share(obj, 0, set(), moved)
+
+    def _share(self, x, depth, seen, moved):
+        if isinstance(x, np.ndarray):
+            if id(x) not in moved:
+                moved[id(x)] = (x, self._array(x))
+            return moved[id(x)][1]
+        if depth > MAX_DEPTH or id(x) in seen:
+            return x
+        seen.add(id(x))
+        if isinstance(x, dict):
+            for k, v in list(x.items()):
+                new = self._share(v, depth + 1, seen, moved)
+                if new is not v:
+                    x[k] = new
+        elif isinstance(x, list):
+            for i, v in enumerate(x):
+                new = self._share(v, depth + 1, seen, moved)
+                if new is not v:
+                    x[i] = new
+        elif isinstance(x, tuple):
+            items = [self._share(v, depth + 1, seen, moved) for v in x]
+            if any(new is not v for new, v in zip(items, x)):
+                # namedtuples, e.g. the flattened trees of a UMAP search index, are rebuilt with their fields
+                return type(x)(*items) if hasattr(x, '_fields') else type(x)(items)
+        elif type(x).__module__.split('.')[0] in self.packages and isinstance(getattr(x, '__dict__', None), dict):
+            for k, v in list(vars(x).items()):
+                new = self._share(v, depth + 1, seen, moved)
+                if new is not v:
+                    try:
+                        setattr(x, k, new)
+                    except AttributeError:
+                        # read only properties backed by the instance dict
+                        vars(x)[k] = new
+        return x
+
+    def _array(self, a):
+        if a.nbytes < max(self.min_bytes, 1) or a.dtype.hasobject:
+            return a
+        shm = shared_memory.SharedMemory(create=True, size=a.nbytes)
+        shared = np.ndarray(a.shape, dtype=a.dtype, buffer=shm.buf)
+        shared[...] = a
+        shared.flags.writeable = a.flags.writeable
+        self.blocks.append(shm)
+        self.nbytes += a.nbytes
+        return shared
+
+    def unlink(self):
+        """
+        Remove the names of the shared memory blocks once the workers are done
+        with them. The blocks stay mapped, and the shared objects valid, for
+        as long as this instance holds them. A no-op in forked workers, which
+        do not own the blocks.
+        """
+        if os.getpid() != self._pid or self._unlinked:
+            return
+        self._unlinked = True
+        for shm in self.blocks:
+            try:
+                shm.unlink()
+            except FileNotFoundError:
+                logging.warning(f'Shared memory block {shm.name} was already removed')
@@ -0,0 +1,89 @@
+import sqlite3
+import hashlib
+import logging
+import numpy as np
+
+from igm_churchill_ancestry.utilities.metrics import inc
+
+'''
+Incremental SQLite store of per-sample model probabilities.
+'''
+
+
+def genotype_hash(s_matrices):
+    """
+    Stable hash of a sample's AIM genotype vector: the encoded sparse row of
+    every model, in model order.
+
+    args
+    ----
+    s_matrices - dict of model -> sparse row matrix as returned by encode_sample
+
+    returns
+    -------
+    str - sha256 hex digest
+    """
+    h = hashlib.sha256()
+    for m_type, s_matrix in s_matrices.items():
+        row = s_matrix.tocsr()
+        row.sum_duplicates()
+        h.update(m_type.encode('utf-8'))
+        h.update(np.asarray(row.shape, dtype=np.int64).tobytes())
+        h.update(row.indices.astype(np.int64).tobytes())
+        h.update(row.data.astype(np.int64).tobytes())
+    return h.hexdigest()
+
+
+class ResultsStore:
+    """
+    Local SQLite results store keyed by sample name and genotype hash. The raw
+    (unnormalized) probabilities of every model are kept as one float32 blob
+    per sample together with the model layout they were produced with, so a
+    store is never read back with a different set of models.
+
+    args
+    ----
+    path - path to the sqlite database, created if missing
+    var - variables instance that defines the model layout
+    """
+
+    def __init__(self, path, var):
+        self.path = path
+        self.layout = ','.join(f'{m_type}:{n_classes}' for _, _, n_classes, m_type in var.R_DIRS)
+        # concurrent workers wait on each other's write transactions
+        self.conn = sqlite3.connect(path, timeout=60)
+        with self.conn:
+            self.conn.execute(
+                'CREATE TABLE IF NOT EXISTS results ('
+                'sample TEXT NOT NULL, genotype_hash TEXT NOT NULL, layout TEXT NOT NULL, '
+                'probs BLOB NOT NULL, created TEXT DEFAULT CURRENT_TIMESTAMP, '
+                'PRIMARY KEY (sample, genotype_hash, layout))')
+
+    def lookup(self, samples, hashes):
+        """
+        Find the stored probabilities of (sample, hash) keys.
+
+        returns
+        -------
+        dict - position in samples -> float32 probability row
+        """
+        found = {}
+        query = 'SELECT probs FROM results WHERE sample = ? AND genotype_hash = ? AND layout = ?'
+        for i, key in enumerate(zip(samples, hashes)):
+            row = self.conn.execute(query, key + (self.layout,)).fetchone()
+            if row is not None:
+                found[i] = np.frombuffer(row[0], dtype=np.float32)
+        logging.info(f'Results store {self.path}: {len(found)} of {len(samples)} samples already scored')
+        inc('snvstory_cache_requests', len(found), cache='results_store', result='hit')
+        inc('snvstory_cache_requests', len(samples) - len(found), cache='results_store', result='miss')
+        return found
+
+    def insert(self, samples, hashes, probs):
+        """Insert the probability rows of new or changed samples in a single transaction."""
+        rows = [(s, h, self.layout, np.ascontiguousarray(p, dtype=np.float32).tobytes())
+                for s, h, p in zip(samples, hashes, probs)]
+        with self.conn:
+            self.conn.executemany('INSERT OR REPLACE INTO results (sample, genotype_hash, layout, probs) VALUES (?, ?, ?, ?)', rows)
+
+    def close(self):
+        self.conn.close()
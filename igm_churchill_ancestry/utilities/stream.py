@@ -0,0 +1,173 @@
+import os
+import json
+import socket
+import logging
+import threading
+import concurrent.futures
+
+from igm_churchill_ancestry.utilities.checkpoint import publish_file
+from igm_churchill_ancestry.utilities.s3 import validate_s3_path, get_client
+from igm_churchill_ancestry.utilities.metrics import inc
+
+'''
+Incremental emission of per-sample results and artifacts while a run is still going.
+'''
+
+
+def sample_records(results, source=None):
+    """
+    One JSON ready dict per sample of (normalized) AncestryResults:
+    {'sample': name, 'source': input file, 'models': {model: {label: probability}}}
+    """
+    labels = {m_type: [results.var.ABBR[x][0] for x in results.labels(m_type)] for m_type in results.models}
+    records = []
+    for i, sample_name in enumerate(results.samples):
+        row = results.sample(i)
+        models = {m_type: dict(zip(labels[m_type], row[m_type].astype(float).round(9).tolist()))
+                  for m_type in results.models}
+        records.append({'sample': str(sample_name), 'source': source, 'models': models})
+    return records
+
+
+class ResultStream:
+    """
+    NDJSON sink of per-sample results. Each emitted record is one line and is
+    written as soon as it is emitted:
+
+        '-'           stdout
+        s3://prefix/  one object per upload, uploaded in the background with
+                      every line emitted since the previous upload
+        other paths   a local file, appended to with one write per line so
+                      that several worker processes can share it
+
+    args
+    ----
+    target - '-', an s3 prefix or a local file path
+    """
+
+    def __init__(self, target):
+        self.target = target
+        self._lines = []
+        self._error = None
+        self._seq = 0
+        self._busy = False
+        self._cond = threading.Condition()
+        self._thread = None
+        if not target.startswith('s3://'):
+            if target != '-' and os.path.dirname(target):
+                os.makedirs(os.path.dirname(target), exist_ok=True)
+            self._fd = 1 if target == '-' else os.open(target, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+
+    def emit(self, record):
+        line = json.dumps(record, separators=(',', ':')) + '\n'
+        if not self.target.startswith('s3://'):
+            os.write(self._fd, line.encode('utf-8'))
+            return
+        with self._cond:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._upload_loop, daemon=True)
+                self._thread.start()
+            self._lines.append(line)
+            self._cond.notify_all()
+
+    def _upload_loop(self):
+        bucket, prefix = validate_s3_path(self.target)
+        prefix = f"{prefix.rstrip('/')}/" if prefix.strip('/') else ''
+        while True:
+            with self._cond:
+                while not self._lines:
+                    self._cond.wait()
+                lines, self._lines = self._lines, []
+                self._busy = True
+                self._seq += 1
+                key = f'{prefix}{socket.gethostname()}-{os.getpid()}-{self._seq:06d}.ndjson'
+            try:
+                body = ''.join(lines).encode('utf-8')
+                get_client().put_object(Bucket=bucket, Key=key, Body=body)
+                inc('snvstory_s3_transferred_bytes', len(body), direction='upload')
+            except Exception as e:
+                logging.error(f'Failed to stream {len(lines)} results to s3://{bucket}/{key}: {e}')
+                self._error = e
+            with self._cond:
+                self._busy = False
+                self._cond.notify_all()
+
+    def flush(self):
+        """Wait for every emitted record to be written, raising the first failed upload."""
+        if self.target.startswith('s3://'):
+            with self._cond:
+                while self._lines or self._busy:
+                    self._cond.wait()
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise RuntimeError(f'Failed to stream results to {self.target}: {error}')
+
+    def close(self):
+        self.flush()
+        if not self.target.startswith('s3://') and self._fd != 1:
+            os.close(self._fd)
+
+
+class ArtifactPublisher:
+    """
+    Publishes output files to a local directory or s3 path in background
+    threads, so that uploading the artifacts of one sample overlaps with the
+    computation of the next.
+
+    args
+    ----
+    output_dir - local directory or s3 path
+    workers - number of concurrent uploads
+    """
+
+    def __init__(self, output_dir, workers=4):
+        self.output_dir = output_dir
+        self.workers = workers
+        self._pool = None
+        self._futures = {}
+
+    def submit(self, path):
+        """Start publishing path unless it was already submitted."""
+        if path in self._futures:
+            return
+        if self._pool is None:
+            self._pool = concurrent.futures.ThreadPoolExecutor(max_workers=self.workers)
+        self._futures[path] = self._pool.submit(publish_file, path, self.output_dir)
+
+    def submit_new(self, directory, exclude=()):
+        """Publish every file of directory, except exclude, that was not submitted yet."""
+        for name in sorted(os.listdir(directory)):
+            path = os.path.join(directory, name)
+            if name not in exclude and os.path.isfile(path):
+                self.submit(path)
+
+    def wait(self):
+        """
+        Wait for the submitted uploads and forget them.
+
+        returns
+        -------
+        list - paths that were published
+
+        raises
+        ------
+        RuntimeError - naming the uploads that failed
+        """
+        published, failed = [], []
+        for path, future in self._futures.items():
+            try:
+                future.result()
+                published.append(path)
+            except Exception as e:
+                logging.error(f'Failed to publish {path} to {self.output_dir}: {e}')
+                failed.append(path)
+        self._futures = {}
+        if failed:
+            raise RuntimeError(f'Failed to publish {failed} to {self.output_dir}')
+        return published
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
+
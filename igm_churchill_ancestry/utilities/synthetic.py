@@ -0,0 +1,362 @@
+import os
+import re
+import json
+import gzip
+import pickle
+import struct
+import zlib
+import numpy as np
+
+from igm_churchill_ancestry.pipelines.variables import variables
+
+'''
+Synthetic VCFs/gVCFs and miniature resource folders in the real layout, for benchmarks and tests.
+'''
+
+
+N_POPULATIONS = 6
+BASES = np.array(['A', 'C', 'G', 'T'])
+# genotype strings indexed by the number of alternate alleles
+UNPHASED = np.array(['0/0', '0/1', '1/1'])
+PHASED = np.array(['0|0', '0|1', '1|1'])
+BGZF_BLOCK = 0xff00
+BGZF_EOF = bytes.fromhex('1f8b08040000000000ff0600424302001b0003000000000000000000')
+
+
+class SyntheticSites:
+    """
+    A universe of biallelic sites with b37 and hg38 coordinates and the allele
+    frequency of every site in N_POPULATIONS populations. gnomAD models use
+    b37 locus ids and the 1kGP and SGDP models hg38 ids, like the real
+    resources, so every genome version exercises a locus converter.
+
+    args
+    ----
+    n_sites - number of sites
+    seed - random seed
+    """
+
+    def __init__(self, n_sites, seed=0):
+        rng = np.random.default_rng(seed)
+        self.n_sites = n_sites
+        self.chrom = np.sort(rng.integers(1, 23, n_sites))
+        self.pos37 = np.zeros(n_sites, dtype=np.int64)
+        for c in np.unique(self.chrom):
+            idx = np.where(self.chrom == c)[0]
+            self.pos37[idx] = np.sort(rng.choice(np.arange(10000, 200_000_000, 1000), len(idx), replace=False))
+        # a constant shift per chromosome keeps the hg38 order equal to the b37 order
+        self.pos38 = self.pos37 + 50 * self.chrom
+        ref = rng.integers(0, 4, n_sites)
+        self.ref = BASES[ref]
+        self.alt = BASES[(ref + rng.integers(1, 4, n_sites)) % 4]
+        base = rng.uniform(0.05, 0.95, n_sites)
+        self.freqs = np.clip(base + rng.normal(0, 0.25, (N_POPULATIONS, n_sites)), 0.01, 0.99)
+
+    def locus_ids(self, genome_ver):
+        pos = self.pos37 if str(genome_ver) == '37' else self.pos38
+        return [f'{c}_{p}_{r}_{a}' for c, p, r, a in zip(self.chrom, pos, self.ref, self.alt)]
+
+    def genotypes(self, populations, rng):
+        """(n_samples, n_sites) alternate allele counts of samples drawn from populations."""
+        return rng.binomial(2, self.freqs[populations])
+
+
+def model_genome_ver(m_type):
+    """Genome version of the locus ids of a model's attributes."""
+    return '37' if m_type.startswith('gnomAD') else '38'
+
+
+def generate_resources(root, n_aims=200, n_train=20, umap=True, seed=0):
+    """
+    Write a miniature resource folder in the layout of variables(root): per
+    model an ancestry informative loci JSON and SNP order, a small XGBoost
+    (gnomAD) or SVM model trained on genotypes simulated from the sites'
+    population frequencies and, with umap, the SVD/UMAP fits and plot
+    attributes of the continental models; plus the b37 <-> hg38 locus
+    converters.
+
+    args
+    ----
+    root - resource folder to create
+    n_aims - ancestry informative loci per model
+    n_train - training samples per class
+    umap - also fit the continental UMAPs (slow the first time numba compiles)
+
+    returns
+    -------
+    var, sites - variables of root and the SyntheticSites the models use
+    """
+    from scipy import sparse
+    import xgboost as xgb
+    from sklearn.svm import SVC
+    root = str(root)
+    var = variables(root)
+    rng = np.random.default_rng(seed)
+    sites = SyntheticSites(int(n_aims * 1.5), seed)
+    ids = {ver: sites.locus_ids(ver) for ver in ('37', '38')}
+    for att_dir, ml_dir, n_classes, m_type in var.R_DIRS:
+        os.makedirs(att_dir, exist_ok=True)
+        os.makedirs(ml_dir, exist_ok=True)
+        panel = np.sort(rng.choice(sites.n_sites, n_aims, replace=False))
+        loci = [ids[model_genome_ver(m_type)][i] for i in panel]
+        name = 'sgdp.intersect_exome.sparse_matrix.var_ids.json' if 'sgdp' in att_dir else 'synthetic_aims.json'
+        with open(os.path.join(att_dir, name), 'w') as fout:
+            json.dump({x: 0 for x in loci}, fout)
+        with open(os.path.join(att_dir, 'synthetic_snp_order.txt'), 'w') as fout:
+            fout.write('\n'.join(loci) + '\n')
+        y = np.repeat(np.arange(n_classes), n_train)
+        X = sites.genotypes(y % N_POPULATIONS, rng)[:, panel]
+        if 'gnomAD' in m_type:
+            params = {'objective': 'multi:softprob', 'num_class': n_classes, 'nthread': 1, 'seed': seed}
+            xgb.train(params, xgb.DMatrix(sparse.csr_matrix(X), label=y), 5).save_model(os.path.join(ml_dir, 'synthetic_model.bin'))
+        else:
+            svm = SVC(probability=True, random_state=seed).fit(sparse.csr_matrix(X.astype(float)), y)
+            with open(os.path.join(ml_dir, 'synthetic_model.p'), 'wb') as fout:
+                pickle.dump(svm, fout)
+        if umap and 'continental' in m_type:
+            fit_umap(X, y, att_dir, ml_dir, var.LABS_CONVERTER[m_type], var.ABBR, seed)
+    converters = {var.HG38_JSON_CONVERTER: dict(zip(ids['38'], ids['37'])),
+                  var.WES_b37_JSON_CONVERTER: dict(zip(ids['37'], ids['38'])),
+                  var.SGDP_b37_JSON_CONVERTER: dict(zip(ids['37'], ids['38']))}
+    for path, converter in converters.items():
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as fout:
+            json.dump(converter, fout)
+    return var, sites
+
+
+def fit_umap(X, y, att_dir, ml_dir, labels, abbr, seed=0):
+    """Fit the SVD/UMAP of a continental model and write the reference points plotted with a sample."""
+    import umap
+    import pandas as pd
+    from sklearn.decomposition import TruncatedSVD
+    svd = TruncatedSVD(min(10, X.shape[1] - 1), random_state=seed).fit(X.astype(float))
+    fit = umap.UMAP(n_neighbors=10, random_state=seed).fit(svd.transform(X.astype(float)))
+    with open(os.path.join(ml_dir, 'synthetic_svd.pkl'), 'wb') as fout:
+        pickle.dump(svd, fout)
+    with open(os.path.join(ml_dir, 'synthetic_umap.pkl'), 'wb') as fout:
+        pickle.dump(fit, fout)
+    names = [labels[c][0] for c in y]
+    df = pd.DataFrame({'x': fit.embedding_[:, 0], 'y': fit.embedding_[:, 1],
+                       'color_code': [abbr[x][1] for x in names], 'Continent': names, 'Subcontinent': names,
+                       'Region': names, 'Country': names, 'Population ID': names})
+    df.to_csv(os.path.join(att_dir, 'synthetic_umap_attributes.csv'))
+
+
+class BgzfWriter:
+    """Minimal BGZF (blocked gzip, as written by bgzip) text or binary writer."""
+
+    def __init__(self, path):
+        self._fout = open(path, 'wb')
+        self._buffer = bytearray()
+
+    def write(self, text):
+        self._buffer += text.encode('utf-8') if isinstance(text, str) else text
+        while len(self._buffer) >= BGZF_BLOCK:
+            self._block(bytes(self._buffer[:BGZF_BLOCK]))
+            del self._buffer[:BGZF_BLOCK]
+
+    def _block(self, data):
+        compressor = zlib.compressobj(6, zlib.DEFLATED, -15)
+        cdata = compressor.compress(data) + compressor.flush()
+        header = struct.pack('<BBBBIBBHBBHH', 31, 139, 8, 4, 0, 0, 255, 6, 66, 67, 2, len(cdata) + 25)
+        self._fout.write(header + cdata + struct.pack('<II', zlib.crc32(data), len(data)))
+
+    def close(self):
+        if self._buffer:
+            self._block(bytes(self._buffer))
+        self._fout.write(BGZF_EOF)
+        self._fout.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def open_output(path, compression=None):
+    """Text writer for path, plain, gzip or bgzip compressed."""
+    if compression == 'bgzip':
+        return BgzfWriter(path)
+    if compression == 'gz':
+        return gzip.open(path, 'wt')
+    return open(path, 'w')
+
+
+def generate_vcf(path, sites, n_samples=1, genome_ver='38', mode='WES', compression=None, gvcf=False,
+                 phased=0.3, missing=0.02, multiallelic=0.05, background=None, seed=0):
+    """
+    Write a synthetic single or multi-sample VCF (or gVCF) of samples drawn
+    from random populations of sites. AIM sites are mixed with background
+    variants that no model uses: 10 per site for WES and 100 per site for WGS
+    unless background is given.
+
+    args
+    ----
+    path - output path, compressed when compression is 'gz' or 'bgzip'
+    sites - SyntheticSites of the resource folder
+    n_samples - number of sample columns
+    genome_ver - '37' or '38', coordinates of the sites
+    gvcf - write every other background record as a <NON_REF> reference block
+    phased - fraction of genotypes written phased
+    missing - fraction of genotypes written as ./.
+    multiallelic - fraction of sites with a second alternate allele
+
+    returns
+    -------
+    populations - population index of each sample
+    """
+    rng = np.random.default_rng(seed)
+    populations = rng.integers(0, N_POPULATIONS, n_samples)
+    background = (10 if mode == 'WES' else 100) if background is None else background
+    pos = sites.pos37 if str(genome_ver) == '37' else sites.pos38
+    samples = [f'SAMPLE{i:05d}' for i in range(n_samples)]
+    genotypes = sites.genotypes(populations, rng)
+    with open_output(path, compression) as fout:
+        fout.write('##fileformat=VCFv4.2\n')
+        fout.write('##FORMAT=<ID=GT,Number=1,Type=String,Description="Genotype">\n')
+        if gvcf:
+            fout.write('##ALT=<ID=NON_REF,Description="Represents any possible alternative allele">\n')
+            fout.write('##INFO=<ID=END,Number=1,Type=Integer,Description="Stop position of the interval">\n')
+        fout.write('\t'.join(['#CHROM', 'POS', 'ID', 'REF', 'ALT', 'QUAL', 'FILTER', 'INFO', 'FORMAT'] + samples) + '\n')
+        for i in range(sites.n_sites):
+            chrom, ref = str(sites.chrom[i]), sites.ref[i]
+            for j in range(background):
+                # background variants (or reference blocks) between the sites
+                bpos = pos[i] - 1 - background + j
+                if gvcf and j % 2 == 0:
+                    fout.write('\t'.join([chrom, str(bpos), '.', 'N', '<NON_REF>', '.', '.', f'END={bpos}', 'GT'] + ['0/0'] * n_samples) + '\n')
+                    continue
+                gts = UNPHASED[rng.binomial(2, 0.1, n_samples)]
+                fout.write('\t'.join([chrom, str(bpos), '.', 'N', 'A', '50', 'PASS', '.', 'GT'] + gts.tolist()) + '\n')
+            gts = np.where(rng.random(n_samples) < phased, PHASED[genotypes[:, i]], UNPHASED[genotypes[:, i]])
+            if rng.random() < multiallelic:
+                alt = f'{sites.alt[i]},{BASES[(np.flatnonzero(BASES == sites.alt[i])[0] + 1) % 4]}'
+                second = rng.random(n_samples) < 0.1
+                gts = np.where(second, '1/2', gts)
+            else:
+                alt = sites.alt[i]
+            gts = np.where(rng.random(n_samples) < missing, './.', gts)
+            fout.write('\t'.join([chrom, str(pos[i]), '.', ref, alt, '50', 'PASS', '.', 'GT'] + gts.tolist()) + '\n')
+    return populations
+
+
+def vcf_to_plink(vcf, prefix, swapped=0.0, seed=0):
+    """
+    Write the biallelic records of an uncompressed vcf as a SNP-major PLINK 1
+    fileset prefix.bed/.bim/.fam, like plink --vcf. The alternate allele is
+    A1 except at a swapped fraction of the records, whose A1 is the reference
+    allele as when PLINK makes the minor allele A1.
+
+    returns
+    -------
+    int - number of variants written
+    """
+    rng = np.random.default_rng(seed)
+    # 2-bit .bed value by the number of A1 alleles, missing genotypes are 0b01
+    values = np.array([0b11, 0b10, 0b00], dtype=np.uint8)
+    n_variants = 0
+    with open(vcf, 'r') as fin, open(prefix + '.bed', 'wb') as bed, open(prefix + '.bim', 'w') as bim:
+        bed.write(b'\x6c\x1b\x01')
+        for line in fin:
+            if line.startswith('##'):
+                continue
+            fields = line.rstrip('\n').split('\t')
+            if line.startswith('#CHROM'):
+                samples = fields[9:]
+                with open(prefix + '.fam', 'w') as fam:
+                    fam.writelines(f'{s} {s} 0 0 0 -9\n' for s in samples)
+                continue
+            if ',' in fields[4] or fields[4].startswith('<'):
+                continue
+            gts = [x[:3] for x in fields[9:]]
+            alt = np.array([x.count('1') for x in gts])
+            flip = rng.random() < swapped
+            a1, a2 = (fields[3], fields[4]) if flip else (fields[4], fields[3])
+            codes = values[2 - alt if flip else alt]
+            codes[[x[0] == '.' for x in gts]] = 0b01
+            packed = np.zeros(-(-len(codes) // 4) * 4, dtype=np.uint8)
+            packed[:len(codes)] = codes
+            packed = packed.reshape(-1, 4) << np.array([0, 2, 4, 6], dtype=np.uint8)
+            bed.write(np.bitwise_or.reduce(packed, axis=1).astype(np.uint8).tobytes())
+            bim.write(f'{fields[0]}\t.\t0\t{fields[1]}\t{a1}\t{a2}\n')
+            n_variants += 1
+    return n_variants
+
+
+def typed_ints(values):
+    """BCF typed vector of int8, int16 or int32 values, whichever fits."""
+    values = np.asarray(values, dtype=np.int64)
+    for t, dtype in ((1, np.int8), (2, np.int16), (3, np.int32)):
+        # the lowest values of each type are reserved for missing and vector end
+        if values.size == 0 or (values.min() > np.iinfo(dtype).min + 7 and values.max() <= np.iinfo(dtype).max):
+            break
+    return typed_descriptor(t, values.size) + values.astype(dtype).tobytes()
+
+
+def typed_descriptor(t, n):
+    if n < 15:
+        return bytes([n << 4 | t])
+    return bytes([15 << 4 | t]) + typed_ints([n])
+
+
+def typed_string(text):
+    data = text.encode('utf-8')
+    return typed_descriptor(7, len(data)) + data
+
+
+def vcf_to_bcf(vcf, path, compression='bgzip'):
+    """
+    Write an uncompressed vcf of GT only samples, like generate_vcf writes, as
+    BCF2.2 (BGZF compressed unless compression is None), like bcftools view
+    -Ob. Contig lines are added for every chromosome; INFO holds END only.
+
+    returns
+    -------
+    int - number of records written
+    """
+    with open(vcf, 'r') as fin:
+        lines = [line.rstrip('\n') for line in fin]
+    header = [line for line in lines if line.startswith('#')]
+    records = [line.split('\t') for line in lines if not line.startswith('#')]
+    chroms = list(dict.fromkeys(fields[0] for fields in records))
+    text = header[:1] + [f'##contig=<ID={c}>' for c in chroms] + [line for line in header[1:] if not line.startswith('##contig')]
+    if not any(line.startswith('##FILTER=<ID=PASS') for line in text):
+        text.insert(1, '##FILTER=<ID=PASS,Description="All filters passed">')
+    strings = {'PASS': 0}
+    for line in text:
+        match = re.match(r'##(FILTER|INFO|FORMAT)=<ID=([^,>]+)', line)
+        if match and match.group(2) not in strings:
+            strings[match.group(2)] = len(strings)
+    contigs = {c: i for i, c in enumerate(chroms)}
+    text = ('\n'.join(text) + '\n').encode('utf-8') + b'\x00'
+    fout = BgzfWriter(path) if compression == 'bgzip' else open(path, 'wb')
+    with fout:
+        fout.write(b'BCF\x02\x02' + struct.pack('<I', len(text)) + text)
+        for fields in records:
+            alleles = [fields[3]] + ([] if fields[4] == '.' else fields[4].split(','))
+            info = b''
+            n_info = 0
+            for item in ([] if fields[7] == '.' else fields[7].split(';')):
+                key, value = item.split('=')
+                info += typed_ints([strings[key]]) + typed_ints([int(value)])
+                n_info += 1
+            shared = struct.pack('<iiifII', contigs[fields[0]], int(fields[1]) - 1, len(fields[3]),
+                                 float(fields[5]) if fields[5] != '.' else struct.unpack('<f', b'\x01\x00\x80\x7f')[0],
+                                 len(alleles) << 16 | n_info, 1 << 24 | (len(fields) - 9))
+            shared += typed_string('' if fields[2] == '.' else fields[2])
+            shared += b''.join(typed_string(allele) for allele in alleles)
+            shared += typed_ints([strings[fields[6]]] if fields[6] != '.' else []) + info
+            # GT as (allele + 1) << 1 | phased, '.' alleles as 0, padded with the int8 vector end
+            gts = [re.split(r'([/|])', x) for x in fields[9:]]
+            ploidy = max((len(gt) + 1) // 2 for gt in gts)
+            values = []
+            for gt in gts:
+                alleles_gt = gt[0::2]
+                phased = [0] + [int(sep == '|') for sep in gt[1::2]]
+                value = [0x80 - 0x100] if alleles_gt == ['.'] else [(0 if a == '.' else int(a) + 1) << 1 | p for a, p in zip(alleles_gt, phased)]
+                values.append(value + [-0x7f] * (ploidy - len(value)))
+            indiv = typed_ints([strings['GT']]) + typed_descriptor(1, ploidy) + np.asarray(values, dtype=np.int8).tobytes()
+            fout.write(struct.pack('<II', len(shared), len(indiv)) + shared + indiv)
+    return len(records)
@@ -1,4 +1,6 @@
 from igm_churchill_ancestry.pipelines.variables import variables
+from igm_churchill_ancestry.utilities.plink import PLINK_EXTENSIONS, plink_header, plink_prefix
+from igm_churchill_ancestry.utilities.bcf import BCF_EXTENSIONS, bcf_header
 import gzip
 import numpy as np
 import logging
@@ -26,7 +28,10 @@ def filter_extension(path):
     """
     filter for files that only end with
     approved extension and return
-    these files.
+    these files. A .bed is only kept when
+    the .bim and .fam of its PLINK fileset
+    are listed too, other .bed files (e.g.
+    BED intervals) are skipped.
 
     args
     ----
@@ -38,8 +43,14 @@ def filter_extension(path):
           or signals that the path is a directory
 
     """
-    path = filter(lambda x: x.endswith(variables.EXTENSIONS), path)
-    return list(path)
+    listed = set(path)
+    kept = []
+    for x in filter(lambda x: x.endswith(variables.EXTENSIONS), path):
+        if x.endswith(PLINK_EXTENSIONS) and not all(plink_prefix(x) + ext in listed for ext in ('.bim', '.fam')):
+            log.warning(f"Skipping {x}: no .bim and .fam next to it, not a PLINK fileset")
+            continue
+        kept.append(x)
+    return kept
 
 
 def get_extension(path):
@@ -71,6 +82,25 @@ def get_extension(path):
     return 'dir'
 
 
+def parse_size(size):
+    """
+    Convert a human readable size into bytes.
+
+    args
+    ----
+    size - int or str such as 1048576, '512M' or '2G'
+
+    returns
+    -------
+    int - number of bytes
+    """
+    units = {'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30, 'T': 1 << 40}
+    size = str(size).strip().upper().rstrip('B')
+    if size and size[-1] in units:
+        return int(float(size[:-1]) * units[size[-1]])
+    return int(size)
+
+
 def random_file_code():
     rnd_str = ''.join(np.random.choice(list(string.ascii_uppercase) + list(string.ascii_lowercase), size=5).tolist())
     return rnd_str
@@ -134,6 +164,21 @@ def get_file_handle(path):
         return
 
 
+def open_vcf(path):
+    """
+    Open a vcf for a single streaming pass, unlike get_file_handle nothing is
+    held in memory.
+
+    returns
+    -------
+    o - file object yielding the lines of the vcf, bytes when gzipped
+    gz_file - boolean represents whether file is gzipped
+    """
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rb'), True
+    return open(path, 'r'), False
+
+
 def is_vcf_multisample(path_input, return_sample_names=False):
     """
     Runtime check for vcf type e.g. multisample or single
@@ -150,7 +195,13 @@ def is_vcf_multisample(path_input, return_sample_names=False):
     """
     if path_input.endswith(variables.EXTENSIONS):
         logging.debug("Checking vcf sample composition")
-        o, gz_file = get_file_handle(path_input)
+        if path_input.endswith(PLINK_EXTENSIONS):
+            # the samples of a PLINK fileset are in its .fam
+            o, gz_file = plink_header(path_input), False
+        elif path_input.endswith(BCF_EXTENSIONS):
+            o, gz_file = bcf_header(path_input), False
+        else:
+            o, gz_file = get_file_handle(path_input)
         for num, line in enumerate(o):
             if gz_file:
                 line = line.decode('utf-8').strip()
@@ -2,8 +2,6 @@ from igm_churchill_ancestry.utilities.utilities import genotype_dictionary
 import glob
 import json
 import warnings
-import pandas as pd
-from scipy import sparse
 
 
 def load_snp_order(attribute_dir):
@@ -31,18 +29,24 @@ def load_snp_order(attribute_dir):
         return
 
 
-def vcf_to_json(parsed_vcf, attribute_dir, locus_converter_json_path):
+def variant_index_path(attribute_dir):
+    """Path of the JSON of ancestry informative loci of a model attribute directory."""
+    if 'sgdp' in attribute_dir:
+        return attribute_dir + 'sgdp.intersect_exome.sparse_matrix.var_ids.json'
+    return glob.glob(attribute_dir + '/*.json')[0]
+
+
+def vcf_to_json(parsed_vcf, attribute_dir, locus_converter_json_path, stats=None):
     """
     Transforms genotypes from VCF into numeric representation and
     fills a JSON containing ancestry informative alleles with those
-    numeric values.
+    numeric values. An optional stats dict receives the number of
+    records that matched an ancestry informative locus ('matched') and
+    the set of loci they matched ('loci').
 
     Returns a JSON filled with the VCF data
     """
-    if 'sgdp' in attribute_dir:
-        variants_of_interest = attribute_dir + 'sgdp.intersect_exome.sparse_matrix.var_ids.json'
-    else:
-        variants_of_interest = glob.glob(attribute_dir + '/*.json')[0]
+    variants_of_interest = variant_index_path(attribute_dir)
     try:
         with open(variants_of_interest, 'r') as myfile:
             variant_container = json.load(myfile)
@@ -59,6 +63,8 @@ def vcf_to_json(parsed_vcf, attribute_dir, locus_converter_json_path):
     else:
         locus_converter = None
     gt_sum = 0
+    matched = 0
+    loci = set()
     for k in parsed_vcf:
         values = k.split("\t")
         chrom = values[0]
@@ -86,6 +92,11 @@ def vcf_to_json(parsed_vcf, attribute_dir, locus_converter_json_path):
                 print(f"Unknown genotype: {genotype}. {e}")
                 return
             variant_container[locus_id] = genotype_int
+            matched += 1
+            loci.add(locus_id)
+    if stats is not None:
+        stats['matched'] = matched
+        stats['loci'] = loci
     if gt_sum > 0:
         return variant_container
     else:
@@ -98,6 +109,8 @@ def json_to_sparse_matrix(g_container, o_snps):
     Convert the raw JSON data into a sparse row matrix
     that is patelable for XGBoost.
     """
+    from scipy import sparse
+    import pandas as pd
     try:
         df = pd.DataFrame([g_container])
     except Exception as e:
@@ -0,0 +1,224 @@
+import csv
+import numpy as np
+
+from igm_churchill_ancestry.utilities.results import AncestryResults
+
+'''
+Writers that append normalized ancestry results to csv, Apache Parquet or Arrow IPC files.
+'''
+
+
+FORMATS = {'csv': '.csv', 'parquet': '.parquet', 'arrow': '.arrow'}
+
+
+def output_filename(stem, output_format):
+    """Name of the results file for an output format."""
+    return f'{stem}{FORMATS[output_format]}'
+
+
+def results_schema(var, with_source=False):
+    """
+    Arrow schema with one row per sample: the sample name, one float32 column
+    per model label and the two top hits (label and probability) per model,
+    then optionally the input of the sample.
+    """
+    import pyarrow as pa
+    empty = AncestryResults([], var)
+    fields = [pa.field('sample', pa.string())]
+    fields += [pa.field(name, pa.float32()) for name in empty.column_names()]
+    for m_type in empty.models:
+        for rank in (1, 2):
+            fields.append(pa.field(f'{m_type}.top{rank}', pa.dictionary(pa.int8(), pa.string())))
+            fields.append(pa.field(f'{m_type}.top{rank}_prob', pa.float32()))
+    if with_source:
+        fields.append(pa.field('source', pa.dictionary(pa.int32(), pa.string())))
+    return pa.schema(fields)
+
+
+def results_table(results, schema=None, sources=None):
+    """Convert AncestryResults, and optionally the input of each sample, into a columnar pyarrow Table."""
+    import pyarrow as pa
+    if schema is None:
+        schema = results_schema(results.var, sources is not None)
+    columns = [pa.array(results.samples, pa.string())]
+    columns += [pa.array(results.probs[:, j]) for j in range(results.probs.shape[1])]
+    hits = results.top_hits()
+    for m_type in results.models:
+        labels = pa.array([results.var.ABBR[x][0] for x in results.labels(m_type)], pa.string())
+        top_i, top_val = hits[m_type]
+        # top_hits is ascending so the best hit is the last column
+        for col in (-1, -2):
+            columns.append(pa.DictionaryArray.from_arrays(top_i[:, col].astype(np.int8), labels))
+            columns.append(pa.array(np.ascontiguousarray(top_val[:, col])))
+    if sources is not None:
+        columns.append(pa.array(sources, pa.string()).dictionary_encode())
+    return pa.Table.from_arrays(columns, schema=schema)
+
+
+class ResultsWriter:
+    """
+    Appends AncestryResults to an output file. Samples are buffered as they
+    are written and flushed as one row group per row_group_size samples.
+
+    args
+    ----
+    path - output file path
+    var - variables instance
+    row_group_size - maximum number of samples per row group
+    with_source - add a 'source' column holding the input of every sample, see write
+    """
+
+    def __init__(self, path, var, row_group_size=1024, with_source=False):
+        self.path = path
+        self.var = var
+        self.row_group_size = row_group_size
+        self.with_source = with_source
+        self.n_rows = 0
+        self._pending = []
+        self._sources = []
+
+    def write(self, results, source=None):
+        """
+        Append results. With a source column, source names the input of the
+        samples: one str for all of them or one per sample.
+        """
+        self._pending.append(results)
+        if self.with_source:
+            self._sources += [source] * len(results) if source is None or isinstance(source, str) else list(source)
+        if sum(len(r) for r in self._pending) >= self.row_group_size:
+            self.flush()
+
+    def flush(self):
+        """Write the buffered samples, as row groups of up to row_group_size samples."""
+        if not self._pending:
+            return
+        pending = AncestryResults.concat(self._pending, self.var)
+        sources = self._sources
+        self._pending, self._sources = [], []
+        for start in range(0, len(pending), self.row_group_size):
+            stop = min(start + self.row_group_size, len(pending))
+            block = pending.take(np.arange(start, stop))
+            self._write_block(block, sources[start:stop] if self.with_source else None)
+            self.n_rows += len(block)
+
+    def _write_block(self, results, sources=None):
+        raise NotImplementedError
+
+    def close(self):
+        self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.close()
+
+
+class CsvResultsWriter(ResultsWriter):
+
+    def __init__(self, path, var, row_group_size=1024, with_source=False):
+        super().__init__(path, var, row_group_size, with_source)
+        self._fout = open(path, 'w', newline='')
+
+    def _write_block(self, results, sources=None):
+        results.to_csv(self._fout, header=self.n_rows == 0, sources=sources)
+
+    def close(self):
+        super().close()
+        if self.n_rows == 0:
+            AncestryResults([], self.var).to_csv(self._fout, sources=[] if self.with_source else None)
+        self._fout.close()
+
+
+class ParquetResultsWriter(ResultsWriter):
+
+    def __init__(self, path, var, row_group_size=1024, with_source=False):
+        import pyarrow.parquet as pq
+        super().__init__(path, var, row_group_size, with_source)
+        self.schema = results_schema(var, with_source)
+        self._writer = pq.ParquetWriter(path, self.schema)
+
+    def _write_block(self, results, sources=None):
+        self._writer.write_table(results_table(results, self.schema, sources))
+
+    def close(self):
+        super().close()
+        self._writer.close()
+
+
+class ArrowResultsWriter(ResultsWriter):
+
+    def __init__(self, path, var, row_group_size=1024, with_source=False):
+        import pyarrow as pa
+        super().__init__(path, var, row_group_size, with_source)
+        self.schema = results_schema(var, with_source)
+        self._sink = pa.OSFile(path, 'wb')
+        self._writer = pa.ipc.new_file(self._sink, self.schema)
+
+    def _write_block(self, results, sources=None):
+        self._writer.write_table(results_table(results, self.schema, sources))
+
+    def close(self):
+        super().close()
+        self._writer.close()
+        self._sink.close()
+
+
+WRITERS = {'csv': CsvResultsWriter, 'parquet': ParquetResultsWriter, 'arrow': ArrowResultsWriter}
+
+
+def get_writer(path, var, output_format='csv', row_group_size=1024, with_source=False):
+    """Open the results writer for output_format at path, see ResultsWriter."""
+    try:
+        writer = WRITERS[output_format]
+    except KeyError:
+        raise ValueError(f'Unknown output format: {output_format}. Choose from {list(WRITERS)}')
+    return writer(path, var, row_group_size, with_source)
+
+
+def read_table(path):
+    """
+    Memory map a parquet or arrow results file as a pyarrow Table without
+    parsing any values.
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    if path.endswith(FORMATS['arrow']):
+        return pa.ipc.open_file(pa.memory_map(path, 'r')).read_all()
+    return pq.read_table(path, memory_map=True)
+
+
+def results_models(path, var):
+    """Models present in a csv, parquet or arrow results file, in var.R_DIRS order."""
+    if path.endswith(FORMATS['csv']):
+        with open(path, 'r', newline='') as fin:
+            names = set(next(csv.reader(fin), []))
+    else:
+        names = {x.split('.')[0] for x in read_table(path).column_names}
+    return [m_type for _, _, _, m_type in var.R_DIRS if m_type in names]
+
+
+def read_sources(path):
+    """The source column of a csv, parquet or arrow results file, None if it has none."""
+    if path.endswith(FORMATS['csv']):
+        with open(path, 'r', newline='') as fin:
+            rows = csv.reader(fin)
+            header = next(rows, [])
+            if 'source' not in header:
+                return None
+            j = header.index('source')
+            return [row[j] for row in rows if row]
+    table = read_table(path)
+    if 'source' not in table.column_names:
+        return None
+    return [str(x) for x in table.column('source').to_pylist()]
+
+
+def read_results(path, var):
+    """Load a csv, parquet or arrow results file into AncestryResults."""
+    if path.endswith(FORMATS['csv']):
+        return AncestryResults.read_csv(path, var)
+    table = read_table(path)
+    empty = AncestryResults([], var)
+    probs = np.column_stack([table.column(name).to_numpy() for name in empty.column_names()])
+    return AncestryResults(table.column('sample').to_pylist(), var, probs)
@@ -1,8 +1,26 @@
 import os
 import re
+import json
+import time
 from unittest.mock import patch
 
-import igm_churchill_cnvloh.cli as cli
+import numpy as np
+import pytest
+
+import boto3
+
+try:
+    from moto import mock_aws
+except ImportError:  # moto < 5
+    from moto import mock_s3 as mock_aws
+
+import igm_churchill_ancestry.cli as cli
+from igm_churchill_ancestry.pipelines.variables import variables
+from igm_churchill_ancestry.utilities import s3
+from igm_churchill_ancestry.pipelines.resources import ResourceLoader
+from igm_churchill_ancestry.utilities.synthetic import generate_resources
+from igm_churchill_ancestry.utilities.shared_arrays import SharedArrays
+from igm_churchill_ancestry.utilities.run_report import uss_mb
 
 
 @patch('os.makedirs')
@@ -11,3 +29,196 @@ def test_setup_workspace(mockdirs):
     wrk_dir = cli.setup_workspace()
     mockdirs.assert_called_once()
     assert re.fullmatch(os.environ['TMP_DIR'] + r'/[^/]+', wrk_dir)
+
+
+@pytest.fixture(scope='module')
+def resource_dir(tmp_path_factory):
+    root = str(tmp_path_factory.mktemp('cli') / 'resources')
+    generate_resources(root, n_aims=30, umap=False)
+    return root
+
+
+@pytest.fixture(scope='module')
+def loader(resource_dir):
+    return ResourceLoader(variables(resource_dir)).wait()
+
+
+def record_worker(outdir, f, delay=0, **task):
+    """run_file stand-in recording which process ran f and what it inherited."""
+    time.sleep(delay)
+    if f == 'bad.vcf':
+        raise ValueError(f'cannot read {f}')
+    loader = cli._WORKER['loader']
+    os.makedirs(outdir)
+    with open(os.path.join(outdir, 'worker.json'), 'w') as fout:
+        json.dump({'f': f, 'pid': os.getpid(), 'loader': id(loader),
+                   'models': {m_type: id(loader.model(m_type).model) for m_type in loader.models}}, fout)
+
+
+@pytest.mark.parametrize('workers', [1, 3])
+def test_run_files_order_and_failures(loader, tmp_path, monkeypatch, workers):
+    monkeypatch.setattr(cli, 'run_file', record_worker)
+    # later files finish first
+    tasks = [dict(f=f, delay=0.3 - 0.1 * i) for i, f in enumerate(['a.vcf', 'bad.vcf', 'c.vcf'])]
+    released = []
+    results = cli.run_files(tasks, str(tmp_path), workers, (loader.var,) + (None,) * 9 + (loader,),
+                            on_done=lambda i, outdir, error: released.append(i))
+    assert released == [0, 1, 2]
+    assert [os.path.basename(outdir) for outdir, error in results] == ['00000', '00001', '00002']
+    assert [error is None for outdir, error in results] == [True, False, True]
+    assert 'cannot read bad.vcf' in results[1][1]
+    for outdir, f in [(results[0][0], 'a.vcf'), (results[2][0], 'c.vcf')]:
+        with open(os.path.join(outdir, 'worker.json'), 'r') as fin:
+            assert json.load(fin)['f'] == f
+
+
+def test_workers_inherit_loader(loader, tmp_path, monkeypatch):
+    monkeypatch.setattr(cli, 'run_file', record_worker)
+    tasks = [dict(f=f'{i}.vcf', delay=0.2) for i in range(4)]
+    results = cli.run_files(tasks, str(tmp_path), 2, (loader.var,) + (None,) * 9 + (loader,))
+    models = {m_type: id(loader.model(m_type).model) for m_type in loader.models}
+    pids = set()
+    for outdir, error in results:
+        assert error is None
+        with open(os.path.join(outdir, 'worker.json'), 'r') as fin:
+            worker = json.load(fin)
+        pids.add(worker['pid'])
+        # the objects loaded by this process, not copies loaded again by the worker
+        assert worker['loader'] == id(loader)
+        assert worker['models'] == models
+    assert os.getpid() not in pids
+
+
+def test_init_worker_loader(loader):
+    cli.init_worker(loader.var, loader=loader)
+    assert cli._WORKER['loader'] is loader
+    cli.close_worker()
+    cli.init_worker(loader.var)
+    try:
+        assert cli._WORKER['loader'] is not loader
+        assert sorted(cli._WORKER['loader'].models) == sorted(loader.models)
+    finally:
+        cli.close_worker()
+
+
+def record_memory(outdir, f, **task):
+    """run_file stand-in recording the unshared memory of a worker with every model loaded."""
+    loader = cli._WORKER['loader'].wait()
+    os.makedirs(outdir)
+    with open(os.path.join(outdir, 'worker.json'), 'w') as fout:
+        json.dump({'uss_mb': uss_mb(),
+                   'svm': [loader.model(m_type).model.support_vectors_.data.__array_interface__['data'][0]
+                           for m_type in loader.models if loader.model(m_type).model_type == 'svm']}, fout)
+
+
+def test_workers_share_model_arrays(tmp_path, monkeypatch):
+    monkeypatch.setattr(cli, 'run_file', record_memory)
+    var, sites = generate_resources(str(tmp_path / 'resources'), n_aims=2000, umap=False)
+    loader = ResourceLoader(var)
+    shared = SharedArrays(min_bytes=1 << 10)
+    assert loader.share(shared) > 0
+    try:
+        workers = {}
+        for name, initargs in [('inherited', (var,) + (None,) * 9 + (loader,)), ('own', (var,))]:
+            results = cli.run_files([dict(f=f'{i}.vcf') for i in range(2)], str(tmp_path / name), 2, initargs)
+            workers[name] = []
+            for outdir, error in results:
+                assert error is None
+                with open(os.path.join(outdir, 'worker.json'), 'r') as fin:
+                    workers[name].append(json.load(fin))
+        blocks = [(np.frombuffer(shm.buf, dtype=np.uint8).__array_interface__['data'][0], shm.size) for shm in shared.blocks]
+    finally:
+        shared.unlink()
+
+    def in_shared_memory(address):
+        return any(start <= address < start + size for start, size in blocks)
+
+    # the support vectors of forked workers are the parent's shared memory, those of workers loading their own are not
+    assert all(in_shared_memory(a) for w in workers['inherited'] for a in w['svm'])
+    assert not any(in_shared_memory(a) for w in workers['own'] for a in w['svm'])
+    assert max(w['uss_mb'] for w in workers['inherited']) * 2 < min(w['uss_mb'] for w in workers['own'])
+
+
+class ResumeRecorder:
+    """run_file and file_checksum stand-ins recording the inputs each run scores and hashes."""
+
+    def __init__(self, monkeypatch, failing=()):
+        self.ran, self.hashed, self.failing = [], [], set(failing)
+        file_checksum = cli.file_checksum
+
+        def checksum(path):
+            self.hashed.append(os.path.basename(path))
+            return file_checksum(path)
+
+        monkeypatch.setattr(cli, 'run_file', self.run_file)
+        monkeypatch.setattr(cli, 'file_checksum', checksum)
+
+    def run_file(self, outdir, f, **task):
+        self.ran.append(os.path.basename(f))
+        if os.path.basename(f) in self.failing:
+            raise ValueError(f'cannot read {f}')
+        os.makedirs(outdir)
+        with open(os.path.join(outdir, os.path.basename(f) + '.csv'), 'w') as fout:
+            fout.write(f)
+
+
+def run_resumable(monkeypatch, tmp_path, path, resource_dir, failing=(), resume=False):
+    recorder = ResumeRecorder(monkeypatch, failing)
+    monkeypatch.setenv('TMP_DIR', str(tmp_path / 'work'))
+    os.makedirs(tmp_path / 'work', exist_ok=True)
+    argv = ['--path', path, '--resource', resource_dir, '--output-dir', str(tmp_path / 'out'),
+            '--genome-ver', '38', '--mode', 'WES', 'WES', 'WES'] + (['--resume'] if resume else [])
+    if failing:
+        with pytest.raises(RuntimeError):
+            cli.run_ancestry(argv)
+    else:
+        cli.run_ancestry(argv)
+    return recorder
+
+
+def test_resume_reruns_incomplete_inputs(resource_dir, tmp_path, monkeypatch):
+    indir = tmp_path / 'in'
+    indir.mkdir()
+    for name in ('a.vcf', 'b.vcf', 'c.vcf'):
+        (indir / name).write_text(name)
+    # BED intervals next to the vcfs are not PLINK filesets
+    (indir / 'targets.bed').write_text('1\t100\t200\n')
+    first = run_resumable(monkeypatch, tmp_path, str(indir), resource_dir, failing=['b.vcf'])
+    assert first.ran == ['a.vcf', 'b.vcf', 'c.vcf']
+    assert sorted(os.listdir(tmp_path / 'out' / 'output')) == ['a.vcf.csv', 'c.vcf.csv']
+    # complete and unchanged inputs are skipped by their stamp, without being hashed
+    second = run_resumable(monkeypatch, tmp_path, str(indir), resource_dir, resume=True)
+    assert second.ran == second.hashed == ['b.vcf']
+    # a changed input runs again
+    (indir / 'a.vcf').write_text('changed')
+    os.utime(indir / 'a.vcf', ns=(0, 0))
+    third = run_resumable(monkeypatch, tmp_path, str(indir), resource_dir, resume=True)
+    assert third.ran == third.hashed == ['a.vcf']
+    with open(tmp_path / 'out' / 'output' / 'a.vcf.csv', 'r') as fin:
+        assert fin.read().endswith('a.vcf')
+
+
+def test_resume_downloads_incomplete_inputs(resource_dir, tmp_path, monkeypatch):
+    monkeypatch.setenv('AWS_ACCESS_KEY_ID', 'testing')
+    monkeypatch.setenv('AWS_SECRET_ACCESS_KEY', 'testing')
+    monkeypatch.setenv('AWS_DEFAULT_REGION', 'us-east-1')
+    s3._client.cache_clear()
+    downloaded = []
+    download_s3_directory = cli.download_s3_directory
+
+    def recording_download(s3_dir, local_dir, exclude=()):
+        download_s3_directory(s3_dir, local_dir, exclude)
+        downloaded.append(sorted(os.listdir(local_dir)))
+
+    monkeypatch.setattr(cli, 'download_s3_directory', recording_download)
+    with mock_aws():
+        client = boto3.client('s3')
+        client.create_bucket(Bucket='data')
+        for name in ('a.vcf', 'b.bed', 'b.bim', 'b.fam', 'c.vcf'):
+            client.put_object(Bucket='data', Key=f'cohort/{name}', Body=name.encode('utf-8'))
+        first = run_resumable(monkeypatch, tmp_path, 's3://data/cohort/', resource_dir, failing=['a.vcf'])
+        assert first.ran == ['a.vcf', 'b.bed', 'c.vcf']
+        second = run_resumable(monkeypatch, tmp_path, 's3://data/cohort/', resource_dir, resume=True)
+    s3._client.cache_clear()
+    assert downloaded == [['a.vcf', 'b.bed', 'b.bim', 'b.fam', 'c.vcf'], ['a.vcf']]
+    assert second.ran == second.hashed == ['a.vcf']
@@ -0,0 +1,26 @@
+import re
+import sys
+import subprocess
+
+# dependencies that only the code paths using them may import
+HEAVY = ['umap', 'numba', 'pynndescent', 'bokeh', 'matplotlib', 'xgboost', 'pandas',
+         'sklearn', 'scipy', 'boto3', 'botocore', 'awscli', 'pyarrow']
+
+# cumulative import time of the cli, in seconds, with ample headroom for slow machines
+BUDGET = 1.0
+
+
+def import_cli():
+    code = 'import sys, igm_churchill_ancestry.cli; print(" ".join(sorted(sys.modules)))'
+    return subprocess.run([sys.executable, '-X', 'importtime', '-c', code], capture_output=True, text=True, check=True)
+
+
+def test_cli_does_not_import_heavy_dependencies():
+    loaded = set(import_cli().stdout.split())
+    assert sorted(x for x in HEAVY if x in loaded) == []
+
+
+def test_cli_import_time_budget():
+    # -X importtime reports '<self us> | <cumulative us> | <module>' per module
+    times = re.findall(r'\|\s*(\d+) \|\s*igm_churchill_ancestry\.cli$', import_cli().stderr, re.M)
+    assert int(times[0]) / 1e6 < BUDGET
@@ -0,0 +1,17 @@
+import copy
+
+from igm_churchill_ancestry.pipelines.benchmark import run_benchmarks, compare, format_report
+
+
+def test_run_and_compare(tmp_path):
+    report = run_benchmarks(str(tmp_path), samples=(3, 1), compressions=(None, 'gz'), n_aims=20)
+    assert list(report['cases']) == ['1xWES-plain', '1xWES-gz', '3xWES-plain', '3xWES-gz']
+    case = report['cases']['3xWES-gz']
+    assert case['stages']['predict']['count'] == 10
+    assert case['stages']['parse']['count'] == 3
+    assert 'predict' in format_report(report)
+    assert compare(report, report) == []
+    slower = copy.deepcopy(report)
+    slower['cases']['3xWES-gz']['stages']['encode']['wall_s'] = report['cases']['3xWES-gz']['stages']['encode']['wall_s'] + 1
+    assert compare(report, slower) == [('3xWES-gz', 'encode', report['cases']['3xWES-gz']['stages']['encode']['wall_s'],
+                                        slower['cases']['3xWES-gz']['stages']['encode']['wall_s'])]
@@ -0,0 +1,92 @@
+import pandas as pd
+import pytest
+
+from igm_churchill_ancestry.pipelines import chunked, ancestry_prediction
+from igm_churchill_ancestry.pipelines.chunked import sample_block_size, run_chunked_pipeline, write_aim_lines, ENCODED_BYTES_PER_AIM, PREDICT_BYTES_PER_AIM, LINE_BYTES_PER_SAMPLE, RESERVED_BYTES
+from igm_churchill_ancestry.pipelines.ancestry_prediction import run_ancestry_pipeline
+from igm_churchill_ancestry.pipelines.resources import ResourceSet
+from igm_churchill_ancestry.utilities.store import ResultsStore
+from igm_churchill_ancestry.utilities.synthetic import generate_resources, generate_vcf
+from igm_churchill_ancestry.utilities.writers import read_results
+
+
+@pytest.fixture(scope='module')
+def synthetic(tmp_path_factory):
+    root = tmp_path_factory.mktemp('chunked')
+    var, sites = generate_resources(str(root / 'resources'), n_aims=30, umap=False)
+    vcf = str(root / 'cohort.vcf.gz')
+    generate_vcf(vcf, sites, n_samples=10, genome_ver='37', compression='bgzip')
+    return var, vcf, ResourceSet(var)
+
+
+def per_sample(resources):
+    n_snps = [res.n_snps for res in resources.models.values()]
+    return ENCODED_BYTES_PER_AIM * sum(n_snps) + PREDICT_BYTES_PER_AIM * max(n_snps)
+
+
+def test_sample_block_size(synthetic):
+    var, vcf, resources = synthetic
+    one = per_sample(resources)
+    assert sample_block_size(resources, 10, 1000 + RESERVED_BYTES + 10 * LINE_BYTES_PER_SAMPLE + 3 * one, rss=1000) == 3
+    assert sample_block_size(resources, 10, 1 << 40, rss=1000) == 10
+    with pytest.raises(MemoryError):
+        sample_block_size(resources, 10, RESERVED_BYTES + one, rss=1000)
+
+
+def test_chunked_matches_pipeline(synthetic, tmp_path, monkeypatch):
+    var, vcf, resources = synthetic
+    monkeypatch.setattr(chunked, 'rss_mb', lambda: 0)
+    budget = RESERVED_BYTES + 10 * LINE_BYTES_PER_SAMPLE + 4 * per_sample(resources)
+    (tmp_path / 'chunked').mkdir()
+    (tmp_path / 'whole').mkdir()
+    n_blocks = run_chunked_pipeline(vcf, 'all', var, resources, str(tmp_path / 'chunked'), '37', 'WES', 'out.csv', budget, plots=False)
+    assert n_blocks == 3
+    run_ancestry_pipeline(vcf, True, None, 'all', var, str(tmp_path / 'whole'), '37', 'WES', 'out.csv', plots=False)
+    expected = pd.read_csv(tmp_path / 'whole' / 'out.csv')
+    actual = pd.read_csv(tmp_path / 'chunked' / 'out.csv')
+    assert len(actual) == 10
+    pd.testing.assert_frame_equal(actual, expected, atol=1e-6)
+
+
+def test_vcf_read_once(synthetic, tmp_path, monkeypatch):
+    var, vcf, resources = synthetic
+    opened = []
+    open_vcf = chunked.open_vcf
+    monkeypatch.setattr(chunked, 'open_vcf', lambda path: opened.append(path) or open_vcf(path))
+    monkeypatch.setattr(chunked, 'rss_mb', lambda: 0)
+    budget = RESERVED_BYTES + 10 * LINE_BYTES_PER_SAMPLE + 4 * per_sample(resources)
+    assert run_chunked_pipeline(vcf, 'all', var, resources, str(tmp_path), '37', 'WES', 'out.csv', budget, plots=False) == 3
+    # the header, the records at AIMs copied once, then the copy once per block
+    assert opened[:2] == [vcf, vcf] and len(opened) == 5 and vcf not in opened[2:]
+    aims = resources.aim_loci('37', 'WES')
+    n_lines = write_aim_lines(vcf, aims, str(tmp_path / 'aims.vcf'))
+    loci = [line.split('\t') for line in open(tmp_path / 'aims.vcf')]
+    assert n_lines == len(loci) > 0 and all(f'{x[0]}_{x[1]}_{x[3]}_{x[4]}' in aims for x in loci)
+
+
+def test_chunked_named_samples(synthetic, tmp_path):
+    var, vcf, resources = synthetic
+    run_chunked_pipeline(vcf, ['SAMPLE00007', 'SAMPLE00002'], var, resources, str(tmp_path), '37', 'WES', 'out.csv', 1 << 40, plots=False)
+    assert pd.read_csv(tmp_path / 'out.csv').iloc[:, 0].tolist() == ['SAMPLE00007', 'SAMPLE00002']
+
+
+def test_row_group_per_block(synthetic, tmp_path, monkeypatch):
+    pq = pytest.importorskip('pyarrow.parquet')
+    var, vcf, resources = synthetic
+    monkeypatch.setattr(chunked, 'rss_mb', lambda: 0)
+    budget = RESERVED_BYTES + 10 * LINE_BYTES_PER_SAMPLE + 4 * per_sample(resources)
+    run_chunked_pipeline(vcf, 'all', var, resources, str(tmp_path), '37', 'WES', 'chunked.parquet', budget,
+                         output_format='parquet', plots=False)
+    assert [pq.ParquetFile(tmp_path / 'chunked.parquet').metadata.row_group(i).num_rows for i in range(3)] == [4, 4, 2]
+    # a stored sample is written with the scored block that follows it, in file order
+    monkeypatch.setattr(ancestry_prediction, 'WRITE_BLOCK', 4)
+    store = ResultsStore(str(tmp_path / 'results.db'), var)
+    run_ancestry_pipeline(vcf, True, None, '2', var, str(tmp_path), '37', 'WES', 'first.csv', store=store, plots=False)
+    run_ancestry_pipeline(vcf, True, None, 'all', var, str(tmp_path), '37', 'WES', 'whole.parquet', 'parquet',
+                          store=store, plots=False)
+    store.close()
+    metadata = pq.ParquetFile(tmp_path / 'whole.parquet').metadata
+    assert [metadata.row_group(i).num_rows for i in range(metadata.num_row_groups)] == [5, 4, 1]
+    whole, blocks = read_results(str(tmp_path / 'whole.parquet'), var), read_results(str(tmp_path / 'chunked.parquet'), var)
+    assert whole.samples == blocks.samples == [f'SAMPLE{i:05d}' for i in range(10)]
+    assert abs(whole.probs - blocks.probs).max() < 1e-6
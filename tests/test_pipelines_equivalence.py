@@ -0,0 +1,47 @@
+import numpy as np
+
+from igm_churchill_ancestry.pipelines import equivalence
+from igm_churchill_ancestry.pipelines.variables import variables
+from igm_churchill_ancestry.pipelines.equivalence import CASES, ENGINES, register_engine, diff_outputs, run_equivalence
+
+
+def test_engines_match_reference(tmp_path):
+    report = run_equivalence(str(tmp_path), n_samples=4, n_aims=30)
+    assert list(report) == list(CASES)
+    for case, engines in report.items():
+        assert set(engines) == set(ENGINES)
+        for name, diffs in engines.items():
+            assert diffs == [], (case, name)
+
+
+def test_reference_encodes_genotypes(tmp_path):
+    run_equivalence(str(tmp_path), engines=['pipeline'], cases=['liftover'], n_samples=4, n_aims=30)
+    var = variables(str(tmp_path / 'resources'))
+    names, s_matrices, probs = equivalence.reference_engine(var, str(tmp_path / 'liftover.vcf'), '37', 'WES')
+    assert names == [f'SAMPLE{i:05d}' for i in range(4)]
+    # b37 input reaches the hg38 models through the converters
+    assert all(s_matrices[m_type].nnz > 0 for m_type in s_matrices)
+    assert np.allclose(probs['gnomAD_continental'].sum(axis=1), 1)
+
+
+def test_differences_are_reported(tmp_path, monkeypatch):
+    monkeypatch.setattr(equivalence, 'ENGINES', dict(ENGINES))
+
+    @register_engine('broken')
+    def broken(var, vcf, genome_ver, mode):
+        names, s_matrices, probs = ENGINES['pipeline'](var, vcf, genome_ver, mode)
+        s_matrices['gnomAD_eur'] = s_matrices['gnomAD_eur'].tolil()
+        s_matrices['gnomAD_eur'][0, 0] = 3
+        probs['SGDP_continental'] = probs['SGDP_continental'] + 1e-3
+        return names, s_matrices, probs
+
+    report = run_equivalence(str(tmp_path), engines=['broken'], cases=['unphased'], n_samples=2, n_aims=30)
+    diffs = report['unphased']['broken']
+    assert len(diffs) == 2
+    assert diffs[0].startswith('gnomAD_eur: 1 matrix entries differ, first at sample 0 column 0')
+    assert diffs[1].startswith('SGDP_continental: probabilities differ by up to 0.001')
+
+
+def test_diff_outputs_samples_and_models():
+    expected = (['a'], {'m': np.eye(1)}, {'m': np.ones((1, 2))})
+    assert diff_outputs(expected, (['b'], {}, {})) == ["samples ['b'] != ['a']", 'm: missing']
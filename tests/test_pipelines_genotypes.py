@@ -0,0 +1,87 @@
+import json
+
+import pandas as pd
+import pytest
+
+from igm_churchill_ancestry.pipelines.ancestry_prediction import run_ancestry_pipeline
+from igm_churchill_ancestry.pipelines.genotypes import run_genotype_pipeline
+from igm_churchill_ancestry.pipelines.resources import ResourceSet
+from igm_churchill_ancestry.utilities.parsing import parse_genotype_json
+from igm_churchill_ancestry.utilities.store import ResultsStore
+from igm_churchill_ancestry.utilities.synthetic import generate_resources, generate_vcf
+
+
+@pytest.fixture(scope='module')
+def synthetic(tmp_path_factory):
+    root = tmp_path_factory.mktemp('genotypes')
+    var, sites = generate_resources(str(root / 'resources'), n_aims=30, umap=False)
+    return root, var, sites, ResourceSet(var)
+
+
+def vcf_genotypes(vcf):
+    """{sample: {locus id: genotype}} of every record of a vcf, the last record of a locus winning like the vcf path."""
+    with open(vcf, 'r') as fin:
+        lines = [line.rstrip('\n').split('\t') for line in fin if not line.startswith('##')]
+    samples = lines[0][9:]
+    genotypes = {sample: {} for sample in samples}
+    for values in lines[1:]:
+        locus_id = '_'.join([values[0], values[1], values[3], values[4]])
+        for sample, value in zip(samples, values[9:]):
+            genotypes[sample][locus_id] = value[:3]
+    return genotypes
+
+
+@pytest.mark.parametrize('genome_ver', ['38', '37'])
+def test_ndjson_matches_vcf(synthetic, tmp_path, genome_ver):
+    root, var, sites, resources = synthetic
+    vcf = str(tmp_path / 'cohort.vcf')
+    generate_vcf(vcf, sites, n_samples=7, genome_ver=genome_ver, missing=0.2, multiallelic=0.3)
+    ndjson = tmp_path / 'cohort.ndjson'
+    with open(ndjson, 'w') as fout:
+        for sample, genotypes in vcf_genotypes(vcf).items():
+            fout.write(json.dumps({'sample': sample, 'genotypes': genotypes}) + '\n')
+    (tmp_path / 'vcf').mkdir()
+    (tmp_path / 'json').mkdir()
+    run_ancestry_pipeline(vcf, True, None, 'all', var, str(tmp_path / 'vcf'), genome_ver, 'WES', 'out.csv', plots=False)
+    # batches smaller than the cohort
+    n_samples = run_genotype_pipeline(parse_genotype_json([str(ndjson)]), var, resources, str(tmp_path / 'json'),
+                                      genome_ver, 'WES', 'out.csv', batch_size=3)
+    assert n_samples == 7
+    expected = pd.read_csv(tmp_path / 'vcf' / 'out.csv')
+    actual = pd.read_csv(tmp_path / 'json' / 'out.csv')
+    pd.testing.assert_frame_equal(actual, expected, atol=1e-6)
+
+
+def test_genotype_store(synthetic, tmp_path):
+    root, var, sites, resources = synthetic
+    store = ResultsStore(str(tmp_path / 'results.db'), var)
+    locus_id = f'{sites.chrom[0]}_{sites.pos38[0]}_{sites.ref[0]}_{sites.alt[0]}'
+    records = [('S1', {}), ('S2', {locus_id: '1/1'}), ('S3', {locus_id: '2'})]
+    for name in ('first', 'second'):
+        (tmp_path / name).mkdir()
+        run_genotype_pipeline(records, var, resources, str(tmp_path / name), '38', 'WES', 'out.csv', store=store)
+    store.close()
+    first = pd.read_csv(tmp_path / 'first' / 'out.csv')
+    # '2' is the numeric genotype of '1/1'
+    assert first.iloc[1, 1:].tolist() == first.iloc[2, 1:].tolist()
+    pd.testing.assert_frame_equal(pd.read_csv(tmp_path / 'second' / 'out.csv'), pd.read_csv(tmp_path / 'first' / 'out.csv'))
+
+
+def test_parse_genotype_json(tmp_path):
+    single = tmp_path / 'proband.json'
+    single.write_text(json.dumps({'1_100_A_G': '0/1', '2_200_C_T': 2}))
+    cohort = tmp_path / 'cohort.json'
+    cohort.write_text(json.dumps({'mother': {'1_100_A_G': 0}, 'father': {'1_100_A_G': '1|1'}}))
+    values = ['1_100_A_G:0/1', '2_200_C_T:1', str(single), str(cohort), '{"child": {"1_100_A_G": 1}}']
+    assert list(parse_genotype_json(values, name='inline')) == [
+        ('proband', {'1_100_A_G': '0/1', '2_200_C_T': 2}),
+        ('mother', {'1_100_A_G': 0}), ('father', {'1_100_A_G': '1|1'}),
+        ('child', {'1_100_A_G': 1}),
+        ('inline', {'1_100_A_G': '0/1', '2_200_C_T': '1'}),
+    ]
+    bad = tmp_path / 'bad.ndjson'
+    bad.write_text('{"sample": "x"}\n')
+    with pytest.raises(ValueError):
+        list(parse_genotype_json([str(bad)]))
+    with pytest.raises(ValueError):
+        list(parse_genotype_json(['not-a-genotype']))
@@ -0,0 +1,130 @@
+import os
+import json
+import pickle
+import shutil
+
+import numpy as np
+import pytest
+import xgboost as xgb
+from scipy import sparse
+from sklearn.svm import SVC
+
+from igm_churchill_ancestry import AncestryPredictor
+from igm_churchill_ancestry.pipelines.variables import variables
+from igm_churchill_ancestry.pipelines.ancestry_prediction import encode_sample, predict_model
+from igm_churchill_ancestry.utilities.parsing import parse_multisample_vcf
+from igm_churchill_ancestry.utilities.utilities import get_file_handle
+
+LOCI = [f'1_{1000 + 10 * i}_A_G' for i in range(20)]
+GENOTYPES = ['0/0', '0/1', '1/1', './.', '0|1', '1|0']
+
+
+def make_resources(root, n_samples=3):
+    """
+    Write a tiny resource folder with every model trained on random genotypes
+    of LOCI, an hg38 -> b37 converter that renames the first locus and a
+    multi-sample vcf.
+    """
+    root = str(root)
+    var = variables(root)
+    rng = np.random.default_rng(0)
+    for att_dir, ml_dir, n_classes, m_type in var.R_DIRS:
+        os.makedirs(att_dir, exist_ok=True)
+        os.makedirs(ml_dir, exist_ok=True)
+        name = 'sgdp.intersect_exome.sparse_matrix.var_ids.json' if 'sgdp' in att_dir else 'aims.json'
+        with open(os.path.join(att_dir, name), 'w') as fout:
+            json.dump({x: 0 for x in LOCI}, fout)
+        with open(os.path.join(att_dir, 'snps.txt'), 'w') as fout:
+            fout.write('\n'.join(LOCI) + '\n')
+        X = rng.integers(0, 3, (n_classes * 4, len(LOCI)))
+        y = np.repeat(np.arange(n_classes), 4)
+        if 'gnomAD' in m_type:
+            bst = xgb.train({'objective': 'multi:softprob', 'num_class': n_classes}, xgb.DMatrix(X, label=y), 2)
+            bst.save_model(os.path.join(ml_dir, 'model.bin'))
+        else:
+            with open(os.path.join(ml_dir, 'model.p'), 'wb') as fout:
+                pickle.dump(SVC(probability=True, random_state=0).fit(sparse.csr_matrix(X.astype(float)), y), fout)
+    for path in [var.HG38_JSON_CONVERTER, var.WES_b37_JSON_CONVERTER, var.SGDP_b37_JSON_CONVERTER]:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as fout:
+            json.dump({'1_5_A_G': LOCI[0]}, fout)
+    vcf = os.path.join(root, 'cohort.vcf')
+    samples = [f'S{i}' for i in range(n_samples)]
+    with open(vcf, 'w') as fout:
+        fout.write('##fileformat=VCFv4.2\n')
+        fout.write('\t'.join(['#CHROM', 'POS', 'ID', 'REF', 'ALT', 'QUAL', 'FILTER', 'INFO', 'FORMAT'] + samples) + '\n')
+        for locus in ['1_5_A_G'] + LOCI[1:]:
+            chrom, pos, ref, alt = locus.split('_')
+            gts = rng.choice(GENOTYPES, n_samples).tolist()
+            fout.write('\t'.join([chrom, pos, '.', ref, alt, '.', 'PASS', '.', 'GT'] + gts) + '\n')
+    return var, vcf
+
+
+@pytest.fixture(scope='module')
+def resources(tmp_path_factory):
+    root = tmp_path_factory.mktemp('resources')
+    var, vcf = make_resources(root)
+    return var, vcf, AncestryPredictor(str(root), genome_ver='38', mode='WES')
+
+
+def reference(var, vcf, genome_ver, mode):
+    """Encode every sample of vcf with the file based pipeline."""
+    o, gz_file = get_file_handle(vcf)
+    n_samples = len(o[1].split('\t')) - 9
+    return [encode_sample(parse_multisample_vcf(o, gz_file, 9 + i), var, genome_ver, mode) for i in range(n_samples)]
+
+
+@pytest.mark.parametrize('genome_ver', ['37', '38'])
+def test_vcf_encoding_matches_pipeline(resources, genome_ver):
+    var, vcf, predictor = resources
+    names, s_matrices = predictor.encode(vcf, genome_ver=genome_ver)
+    assert names == ['S0', 'S1', 'S2']
+    for i, expected in enumerate(reference(var, vcf, genome_ver, 'WES')):
+        for m_type, row in expected.items():
+            assert (s_matrices[m_type][i] != row).nnz == 0
+
+
+def test_predict_matches_pipeline(resources):
+    var, vcf, predictor = resources
+    results = predictor.predict(vcf, samples=['S2', 'S0'])
+    assert results.samples == ['S2', 'S0']
+    expected = reference(var, vcf, '38', 'WES')
+    for _, ml_dir, n_classes, m_type in var.R_DIRS:
+        s_matrix = sparse.vstack([expected[2][m_type], expected[0][m_type]], format='csr')
+        assert np.allclose(results[m_type], predict_model(s_matrix, ml_dir, n_classes, m_type))
+
+
+def test_genotype_payload_and_matrix_agree(resources):
+    var, vcf, predictor = resources
+    payload = {'a': {LOCI[1]: '0/1', LOCI[2]: 2, 'X_1_A_G': '1/1'}, 'b': {LOCI[3]: '1|1'}}
+    matrix = np.array([[1, 2, 0, 2], [0, 0, 2, 0]])
+    by_payload = predictor.predict(payload)
+    by_matrix = predictor.predict(matrix, samples=['a', 'b'], loci=LOCI[1:4] + ['X_1_A_G'])
+    assert by_payload.samples == by_matrix.samples == ['a', 'b']
+    assert np.array_equal(by_payload.probs, by_matrix.probs)
+    encoded = predictor.encode(payload)[1]
+    assert np.array_equal(predictor.predict(encoded, samples=['a', 'b']).probs, by_payload.probs)
+
+
+def test_predict_validates_inputs(resources):
+    var, vcf, predictor = resources
+    with pytest.raises(ValueError):
+        predictor.predict(vcf, genome_ver='36')
+    with pytest.raises(ValueError):
+        predictor.predict(np.zeros((2, 3)), samples=['a', 'b'])
+    with pytest.raises(ValueError):
+        predictor.predict(np.zeros((2, 1)), samples=['a'], loci=LOCI[:1])
+
+
+def test_selected_models_need_only_their_resources(resources, tmp_path):
+    var, vcf, predictor = resources
+    sub_var, sub_vcf = make_resources(tmp_path)
+    for _, ml_dir, _, m_type in sub_var.R_DIRS:
+        if m_type.startswith('SGDP'):
+            shutil.rmtree(ml_dir)
+    sub = AncestryPredictor(str(tmp_path), models=['1kGP_eur'])
+    assert sorted(sub.models) == ['1kGP_continental', '1kGP_eur']
+    results, full = sub.predict(sub_vcf), predictor.predict(vcf)
+    for m_type in sub.models:
+        assert np.allclose(results[m_type], full[m_type])
+    assert np.allclose(results.normalized()['1kGP_eur'], full.normalized()['1kGP_eur'])
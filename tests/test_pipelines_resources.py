@@ -0,0 +1,140 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from igm_churchill_ancestry.pipelines import ancestry_prediction
+from igm_churchill_ancestry.pipelines import resources as resources_module
+from igm_churchill_ancestry.pipelines.ancestry_prediction import run_ancestry_pipeline
+from igm_churchill_ancestry.pipelines.resources import ResourceLoader, ResourceSet
+from igm_churchill_ancestry.utilities.parsing import parse_genotypes
+from igm_churchill_ancestry.utilities.store import ResultsStore
+from igm_churchill_ancestry.utilities.synthetic import generate_resources, generate_vcf
+from igm_churchill_ancestry.utilities.utilities import get_file_handle
+
+
+@pytest.fixture(scope='module')
+def synthetic(tmp_path_factory):
+    root = tmp_path_factory.mktemp('resources')
+    var, sites = generate_resources(str(root / 'resources'), n_aims=30, umap=False)
+    vcf = str(root / 'cohort.vcf')
+    generate_vcf(vcf, sites, n_samples=5, genome_ver='37', missing=0.2)
+    return var, vcf
+
+
+def test_loader_readiness(synthetic):
+    var, vcf = synthetic
+    loader = ResourceLoader(var)
+    models = [m_type for att_dir, ml_dir, n_classes, m_type in var.R_DIRS]
+    assert loader.models == models
+    loaded = dict(loader.as_completed())
+    assert sorted(loaded) == sorted(models)
+    assert all(loader.ready(m_type) for m_type in models)
+    assert loader.model(models[0]) is loaded[models[0]]
+    assert loader.umap_fits(models[0]) is None
+    assert list(loader.resource_set().models) == models
+
+
+def test_encode_matches_encode_lines(synthetic):
+    var, vcf = synthetic
+    loader = ResourceLoader(var)
+    o, gz_file = get_file_handle(vcf)
+    columns = list(range(9, 14))
+    loci, codes = parse_genotypes(o, columns)
+    assert codes.shape == (len(loci), 5)
+    expected = ResourceSet(var).encode_lines(o, columns, '37', 'WES')
+    for m_type, res in loader.as_completed():
+        actual = res.encode(loci, codes, loader.converter('37', 'WES', res.t))
+        assert (actual != expected[m_type]).nnz == 0
+
+
+def test_encode_unknown_genotype(synthetic):
+    var, vcf = synthetic
+    res = ResourceLoader(var).model(var.R_DIRS[0][3])
+    o, gz_file = get_file_handle(vcf)
+    loci, codes = parse_genotypes(o, [9])
+    codes[:] = -1
+    with pytest.raises(ValueError):
+        res.encode(loci, codes, None)
+
+
+@pytest.mark.parametrize('with_store', [False, True])
+def test_pipeline_with_loader(synthetic, tmp_path, with_store):
+    var, vcf = synthetic
+    for name in ('plain', 'loader'):
+        (tmp_path / name).mkdir()
+        store = ResultsStore(str(tmp_path / f'{name}.db'), var) if with_store else None
+        run_ancestry_pipeline(vcf, True, None, 'all', var, str(tmp_path / name), '37', 'WES', 'out.csv', store=store,
+                              plots=False, resources=ResourceLoader(var) if name == 'loader' else None)
+        if store is not None:
+            hashes = sorted(store.conn.execute('SELECT sample, genotype_hash FROM results').fetchall())
+            store.close()
+            if name == 'plain':
+                expected_hashes = hashes
+            else:
+                assert hashes == expected_hashes
+    expected = pd.read_csv(tmp_path / 'plain' / 'out.csv')
+    actual = pd.read_csv(tmp_path / 'loader' / 'out.csv')
+    pd.testing.assert_frame_equal(actual, expected, atol=1e-6)
+    assert np.isfinite(actual.select_dtypes('number').to_numpy()).all()
+
+
+class RecordingStream:
+    def __init__(self, events):
+        self.events = events
+
+    def emit(self, record):
+        self.events.append(('emit', record['sample']))
+
+
+@pytest.mark.parametrize('with_loader', [False, True])
+def test_stream_emits_per_block(synthetic, tmp_path, monkeypatch, with_loader):
+    var, vcf = synthetic
+    events = []
+    predict_model = ancestry_prediction.predict_model
+
+    def recording_predict(s_matrix, *args, **kwargs):
+        events.append(('predict', s_matrix.shape[0]))
+        return predict_model(s_matrix, *args, **kwargs)
+
+    monkeypatch.setattr(ancestry_prediction, 'STREAM_BLOCK', 2)
+    monkeypatch.setattr(ancestry_prediction, 'predict_model', recording_predict)
+    monkeypatch.setattr(resources_module, 'predict_model', recording_predict)
+    store = ResultsStore(str(tmp_path / 'results.db'), var)
+    # the second sample is stored by a first run
+    run_ancestry_pipeline(vcf, True, None, '2', var, str(tmp_path), '37', 'WES', 'first.csv', store=store, plots=False)
+    events.clear()
+    run_ancestry_pipeline(vcf, True, None, 'all', var, str(tmp_path), '37', 'WES', 'out.csv', store=store, plots=False,
+                          stream=RecordingStream(events), resources=ResourceLoader(var) if with_loader else None)
+    store.close()
+    n_models = len(var.R_DIRS)
+    names = pd.read_csv(tmp_path / 'out.csv').iloc[:, 0].tolist()
+    # the stored sample first, then each block of 2 once every model scored it and before the next block is scored
+    expected = [('emit', names[1])]
+    for block in ([0, 2], [3, 4]):
+        expected += [('predict', len(block))] * n_models + [('emit', names[i]) for i in block]
+    assert events == expected
+
+
+def test_stream_with_empty_store(synthetic, tmp_path):
+    var, vcf = synthetic
+    events = []
+    store = ResultsStore(str(tmp_path / 'results.db'), var)
+    run_ancestry_pipeline(vcf, True, None, 'all', var, str(tmp_path), '37', 'WES', 'out.csv', store=store, plots=False,
+                          stream=RecordingStream(events), resources=ResourceLoader(var))
+    store.close()
+    assert [name for _, name in events] == pd.read_csv(tmp_path / 'out.csv').iloc[:, 0].tolist()
+
+
+def test_store_inserts_input_once(synthetic, tmp_path, monkeypatch):
+    var, vcf = synthetic
+    monkeypatch.setattr(ancestry_prediction, 'STREAM_BLOCK', 2)
+    store = ResultsStore(str(tmp_path / 'results.db'), var)
+    inserted = []
+    insert = store.insert
+    monkeypatch.setattr(store, 'insert', lambda samples, *args: inserted.append(len(samples)) or insert(samples, *args))
+    run_ancestry_pipeline(vcf, True, None, 'all', var, str(tmp_path), '37', 'WES', 'out.csv', store=store, plots=False,
+                          stream=RecordingStream([]), resources=ResourceLoader(var))
+    # scored in blocks of 2, stored in one transaction
+    assert inserted == [5]
+    assert len(store.lookup(*zip(*store.conn.execute('SELECT sample, genotype_hash FROM results')))) == 5
+    store.close()
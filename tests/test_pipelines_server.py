@@ -0,0 +1,169 @@
+import os
+import json
+import queue
+import threading
+import http.client
+
+import numpy as np
+import pytest
+from scipy import sparse
+
+from igm_churchill_ancestry.pipelines.server import (PredictionBatcher, results_json, encode_request, resolve_vcf_path,
+                                                     make_server, ForbiddenPath)
+from igm_churchill_ancestry.utilities.results import AncestryResults
+from tests.test_utilities_results import make_results
+
+
+class RowSumPredictor:
+    """Scores each sample with the sum of its encoded row in every column."""
+
+    def __init__(self, var):
+        self.var = var
+        self.models = ['gnomAD_continental']
+        self.batches = []
+        self.release = threading.Event()
+        self.release.set()
+
+    def score(self, samples, s_matrices):
+        self.release.wait()
+        self.batches.append(list(samples))
+        results = AncestryResults(samples, self.var)
+        totals = np.asarray(s_matrices['gnomAD_continental'].sum(axis=1)).ravel()
+        results.probs[:] = totals[:, None]
+        return results
+
+
+def encoded(values):
+    return {m_type: sparse.csr_matrix(np.asarray(values)[:, None]) for m_type in ('gnomAD_continental',)}
+
+
+def test_batcher_scores_requests_together():
+    var, _ = make_results()
+    predictor = RowSumPredictor(var)
+    batcher = PredictionBatcher(predictor, batch_size=8, batch_wait=0.5)
+    futures = [batcher.submit(['a', 'b'], encoded([1, 2])), batcher.submit(['c'], encoded([3]))]
+    first, second = [f.result(timeout=10) for f in futures]
+    batcher.close()
+    assert predictor.batches == [['a', 'b', 'c']]
+    assert first.samples == ['a', 'b'] and second.samples == ['c']
+    assert first.probs[:, 0].tolist() == [1, 2]
+    assert second.probs[:, 0].tolist() == [3]
+
+
+def test_batcher_queue_is_bounded():
+    var, _ = make_results()
+    predictor = RowSumPredictor(var)
+    predictor.release.clear()
+    batcher = PredictionBatcher(predictor, batch_size=1, batch_wait=0, queue_size=1)
+    running = batcher.submit(['a'], encoded([1]))
+    # wait for the batcher to take the first request off the queue
+    while batcher.queue.qsize():
+        pass
+    batcher.submit(['b'], encoded([2]))
+    with pytest.raises(queue.Full):
+        batcher.submit(['c'], encoded([3]))
+    predictor.release.set()
+    assert running.result(timeout=10).samples == ['a']
+    batcher.close()
+
+
+def test_results_json_normalizes():
+    var, results = make_results(2)
+    body = results_json(results)
+    assert body['samples'] == results.samples
+    assert body['models']['gnomAD_continental']['labels'] == ['afr', 'amr', 'asj', 'eas', 'eur', 'sas']
+    assert np.allclose(body['models']['gnomAD_eur']['probabilities'], results.normalized()['gnomAD_eur'])
+    raw = results_json(results, normalize=False)
+    assert np.allclose(raw['models']['gnomAD_eur']['probabilities'], results['gnomAD_eur'])
+
+
+def test_encode_request_validates():
+    with pytest.raises(ValueError):
+        encode_request(None, {'genome_ver': '38', 'mode': 'WES', 'genotypes': ['0/1']})
+    with pytest.raises(ValueError):
+        encode_request(None, {'genome_ver': '38', 'mode': 'WES'})
+
+
+def test_vcf_paths_confined_to_root(tmp_path):
+    root = tmp_path / 'vcfs'
+    (root / 'sub').mkdir(parents=True)
+    (root / 'sub' / 'a.vcf').write_text('')
+    (tmp_path / 'secret.vcf').write_text('')
+    os.symlink(tmp_path / 'secret.vcf', root / 'link.vcf')
+    assert resolve_vcf_path('sub/a.vcf', str(root)) == str(root / 'sub' / 'a.vcf')
+    assert resolve_vcf_path(str(root / 'sub' / 'a.vcf'), str(root)) == str(root / 'sub' / 'a.vcf')
+    for path in ('../secret.vcf', str(tmp_path / 'secret.vcf'), 'link.vcf', '/etc/passwd'):
+        with pytest.raises(ForbiddenPath):
+            resolve_vcf_path(path, str(root))
+    with pytest.raises(ForbiddenPath):
+        resolve_vcf_path('sub/a.vcf', None)
+
+
+class EncodingPredictor(RowSumPredictor):
+    """RowSumPredictor that encodes a vcf path as a single sample named after it."""
+
+    def __init__(self, var):
+        super().__init__(var)
+        self.encoding = threading.Event()
+        self.encoding.set()
+
+    def encode(self, source, samples='all', genome_ver=None, mode=None):
+        self.encoding.wait()
+        return [os.path.basename(source)], encoded([1])
+
+
+def post(server, payload):
+    conn = http.client.HTTPConnection('127.0.0.1', server.server_address[1], timeout=30)
+    conn.request('POST', '/predict', json.dumps(payload))
+    response = conn.getresponse()
+    body = json.loads(response.read())
+    conn.close()
+    return response.status, body
+
+
+@pytest.fixture
+def serve(tmp_path):
+    servers = []
+
+    def start(predictor, **kwargs):
+        batcher = PredictionBatcher(predictor, batch_size=8, batch_wait=0)
+        server = make_server(batcher, port=0, **kwargs)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append((server, batcher))
+        return server
+
+    yield start
+    for server, batcher in servers:
+        server.shutdown()
+        server.server_close()
+        batcher.close()
+
+
+def test_server_refuses_paths_outside_root(serve, tmp_path):
+    var, _ = make_results()
+    (tmp_path / 'a.vcf').write_text('')
+    server = serve(EncodingPredictor(var), vcf_root=str(tmp_path))
+    status, body = post(server, {'vcf': 'a.vcf'})
+    assert status == 200 and body['samples'] == ['a.vcf']
+    assert post(server, {'vcf': '/etc/passwd'})[0] == 403
+    assert post(server, {'vcf': '../a.vcf'})[0] == 403
+    unrooted = serve(EncodingPredictor(var))
+    assert post(unrooted, {'vcf': str(tmp_path / 'a.vcf')})[0] == 403
+
+
+def test_server_bounds_encoding(serve, tmp_path):
+    var, _ = make_results()
+    (tmp_path / 'a.vcf').write_text('')
+    predictor = EncodingPredictor(var)
+    predictor.encoding.clear()
+    server = serve(predictor, vcf_root=str(tmp_path), max_encoding=1, timeout_s=0.5)
+    first = []
+    thread = threading.Thread(target=lambda: first.append(post(server, {'vcf': 'a.vcf'})))
+    thread.start()
+    # wait for the first request to hold the only encoding slot
+    while server.encoding._value:
+        pass
+    assert post(server, {'vcf': 'a.vcf'})[0] == 503
+    predictor.encoding.set()
+    thread.join(timeout=30)
+    assert first[0][0] == 200
@@ -0,0 +1,23 @@
+import pytest
+
+from igm_churchill_ancestry.pipelines.variables import variables
+
+
+def test_select_models_adds_parents():
+    var = variables('/rsrc/').select_models(['gnomAD_eur', '1kGP_continental'])
+    assert [x[3] for x in var.R_DIRS] == ['gnomAD_continental', 'gnomAD_eur', '1kGP_continental']
+    assert var.MATRIX_ATT_DIRS == [x[0] for x in var.R_DIRS]
+    assert var.MODEL_DIRS == [x[1] for x in var.R_DIRS]
+
+
+def test_select_models_rejects_unknown():
+    with pytest.raises(ValueError, match='gnomAD_afr'):
+        variables('/rsrc/').select_models(['gnomAD_afr'])
+
+
+def test_resource_dirs():
+    var = variables('/rsrc/')
+    assert len(var.resource_dirs()) == 2 * len(var.R_DIRS) + 2
+    dirs = var.select_models(['SGDP_continental']).resource_dirs()
+    assert dirs == ['genome_ver_converters/b37tohg38', 'sgdp/continental/machine_learning_models',
+                    'sgdp/continental/matrix_attributes']
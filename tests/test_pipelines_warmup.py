@@ -0,0 +1,16 @@
+from igm_churchill_ancestry.pipelines.warmup import run_stages, savings, format_savings, synthetic_sample
+from tests.test_pipelines_predictor import make_resources, LOCI
+
+
+def test_savings_pairs_stages():
+    rows = savings({'import_umap': 10.0, 'transform_x': 4.5, 'cold_only': 1.0}, {'import_umap': 2.0, 'transform_x': 0.5})
+    assert rows == [('import_umap', 10.0, 2.0, 8.0), ('transform_x', 4.5, 0.5, 4.0)]
+    table = format_savings(rows).splitlines()
+    assert table[-1].split() == ['total', '14.500', '2.500', '12.000']
+
+
+def test_run_stages_skips_models_without_umap(tmp_path):
+    var, _ = make_resources(tmp_path)
+    assert synthetic_sample(var.R_DIRS[0][0]).shape == (1, len(LOCI))
+    timings = run_stages(var, compile_bytecode=False)
+    assert list(timings) == ['import_umap']
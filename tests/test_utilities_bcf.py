@@ -0,0 +1,97 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from igm_churchill_ancestry.pipelines import chunked
+from igm_churchill_ancestry.pipelines.ancestry_prediction import run_ancestry_pipeline
+from igm_churchill_ancestry.pipelines.chunked import run_chunked_pipeline, RESERVED_BYTES, LINE_BYTES_PER_SAMPLE
+from igm_churchill_ancestry.pipelines.resources import ResourceLoader, ResourceSet
+from igm_churchill_ancestry.utilities.bcf import bcf_header, parse_bcf, header_dictionaries
+from igm_churchill_ancestry.utilities.parsing import parse_genotypes
+from igm_churchill_ancestry.utilities.synthetic import generate_resources, generate_vcf, vcf_to_bcf
+from igm_churchill_ancestry.utilities.utilities import get_file_handle, is_vcf_multisample
+
+
+@pytest.fixture(scope='module')
+def synthetic(tmp_path_factory):
+    root = tmp_path_factory.mktemp('bcf')
+    var, sites = generate_resources(str(root / 'resources'), n_aims=30, umap=False)
+    vcf = str(root / 'cohort.vcf')
+    generate_vcf(vcf, sites, n_samples=6, genome_ver='38', missing=0.2, multiallelic=0.3, gvcf=True)
+    vcf_to_bcf(vcf, str(root / 'cohort.bcf'))
+    return root, var, sites, vcf
+
+
+@pytest.mark.parametrize('compression', ['bgzip', None])
+def test_parse_matches_vcf(synthetic, tmp_path, compression):
+    root, var, sites, vcf = synthetic
+    bcf = str(tmp_path / 'cohort.bcf')
+    vcf_to_bcf(vcf, bcf, compression)
+    o, gz_file = get_file_handle(vcf)
+    columns = [14, 9, 11]
+    expected_loci, expected = parse_genotypes(o, columns)
+    loci, codes = parse_bcf(bcf, columns)
+    assert loci == expected_loci
+    np.testing.assert_array_equal(codes, expected)
+
+
+def test_aims_only(synthetic):
+    root, var, sites, vcf = synthetic
+    o, gz_file = get_file_handle(vcf)
+    columns = list(range(9, 15))
+    vcf_loci, vcf_codes = parse_genotypes(o, columns)
+    aims = set(sites.locus_ids('38'))
+    loci, codes = parse_bcf(str(root / 'cohort.bcf'), columns, aims)
+    assert loci == [x for x in vcf_loci if x in aims]
+    np.testing.assert_array_equal(codes, vcf_codes[[vcf_loci.index(x) for x in loci]])
+
+
+def test_genotype_edge_cases(tmp_path):
+    vcf = tmp_path / 'edge.vcf'
+    ref = 'ACGTACGTACGTACGTA'
+    vcf.write_text('##fileformat=VCFv4.2\n'
+                   '##FORMAT=<ID=GT,Number=1,Type=String,Description="Genotype">\n'
+                   '#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\tA\tB\tC\tD\tE\n'
+                   f'1\t100\trs1\t{ref}\tA\t.\t.\t.\tGT\t1\t.\t./1\t1|2\t0/0/1\n'
+                   '2\t200\t.\tG\t.\t50\tPASS\t.\tGT\t0\t0|0\t./.\t.|.\t1/1\n')
+    vcf_to_bcf(str(vcf), str(tmp_path / 'edge.bcf'))
+    o, gz_file = get_file_handle(str(vcf))
+    expected_loci, expected = parse_genotypes(o, list(range(9, 14)))
+    loci, codes = parse_bcf(str(tmp_path / 'edge.bcf'), list(range(9, 14)))
+    assert loci == expected_loci == [f'1_100_{ref}_A', '2_200_G_.']
+    np.testing.assert_array_equal(codes, expected)
+
+
+def test_header(synthetic):
+    root, var, sites, vcf = synthetic
+    header = bcf_header(str(root / 'cohort.bcf'))
+    assert header[-1].startswith('#CHROM')
+    contigs, strings = header_dictionaries(header)
+    assert strings['PASS'] == 0 and 'GT' in strings
+    assert is_vcf_multisample(str(root / 'cohort.bcf'), True) == (True, [f'SAMPLE{i:05d}' for i in range(6)])
+    with pytest.raises(ValueError):
+        parse_bcf(vcf, [9])
+
+
+def test_pipeline_matches_vcf(synthetic, tmp_path):
+    root, var, sites, vcf = synthetic
+    for name, path in (('vcf', vcf), ('bcf', str(root / 'cohort.bcf'))):
+        (tmp_path / name).mkdir()
+        run_ancestry_pipeline(path, True, None, ['SAMPLE00003', '1', 'SAMPLE00005'], var, str(tmp_path / name), '38',
+                              'WES', 'out.csv', plots=False, resources=ResourceLoader(var))
+    pd.testing.assert_frame_equal(pd.read_csv(tmp_path / 'bcf' / 'out.csv'), pd.read_csv(tmp_path / 'vcf' / 'out.csv'),
+                                  atol=1e-6)
+
+
+def test_chunked_matches_vcf(synthetic, tmp_path, monkeypatch):
+    root, var, sites, vcf = synthetic
+    resources = ResourceSet(var)
+    monkeypatch.setattr(chunked, 'rss_mb', lambda: 0)
+    n_snps = [res.n_snps for res in resources.models.values()]
+    budget = RESERVED_BYTES + 6 * LINE_BYTES_PER_SAMPLE + 4 * (6 * sum(n_snps) + 16 * max(n_snps))
+    for name, path in (('vcf', vcf), ('bcf', str(root / 'cohort.bcf'))):
+        (tmp_path / name).mkdir()
+        assert run_chunked_pipeline(path, 'all', var, resources, str(tmp_path / name), '38', 'WES', 'out.csv', budget,
+                                    plots=False) == 2
+    pd.testing.assert_frame_equal(pd.read_csv(tmp_path / 'bcf' / 'out.csv'), pd.read_csv(tmp_path / 'vcf' / 'out.csv'),
+                                  atol=1e-6)
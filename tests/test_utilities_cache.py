@@ -0,0 +1,29 @@
+import os
+import time
+
+import numpy as np
+from scipy import sparse
+
+from igm_churchill_ancestry.utilities.cache import PredictionCache, row_hashes
+
+
+def test_row_hashes_identical_rows():
+    s_matrix = sparse.csr_matrix(np.array([[0, 1, 2], [0, 2, 2], [0, 1, 2]]))
+    hashes = row_hashes(s_matrix)
+    assert hashes[0] == hashes[2]
+    assert hashes[0] != hashes[1]
+
+
+def test_cache_hit_and_lru_eviction(tmp_path):
+    cache = PredictionCache(str(tmp_path), max_bytes=400)
+    value = np.arange(6, dtype=np.float32)
+    cache.put('a', value)
+    time.sleep(0.01)
+    cache.put('b', value)
+    time.sleep(0.01)
+    assert np.array_equal(cache.get('a'), value)
+    cache.put('c', value)
+    assert cache.get('b') is None
+    assert cache.get('a') is not None
+    assert cache.hits == 2 and cache.misses == 1
+    assert sum(os.path.getsize(tmp_path / f) for f in os.listdir(tmp_path)) <= 400
@@ -0,0 +1,23 @@
+import os
+
+from igm_churchill_ancestry.utilities.checkpoint import MANIFEST, Checkpoint, publish_outputs
+
+
+def test_checkpoint_round_trip(tmp_path):
+    output_dir = str(tmp_path / 'out')
+    work_dir = tmp_path / 'work'
+    staging = work_dir / 'staging'
+    os.makedirs(staging)
+    os.makedirs(work_dir / 'output')
+    (staging / 'a.csv').write_text('a')
+
+    checkpoint = Checkpoint(output_dir, str(work_dir))
+    outputs = publish_outputs(str(staging), str(work_dir / 'output'), os.path.join(output_dir, 'output'))
+    checkpoint.mark_complete('a.vcf', 'digest', outputs)
+    assert os.path.isfile(os.path.join(output_dir, 'output', 'a.csv'))
+    assert os.path.isfile(os.path.join(output_dir, MANIFEST))
+
+    resumed = Checkpoint(output_dir, str(tmp_path / 'other')).load()
+    assert resumed.is_complete('a.vcf', 'digest')
+    assert not resumed.is_complete('a.vcf', 'changed')
+    assert not resumed.is_complete('b.vcf', 'digest')
@@ -0,0 +1,65 @@
+import numpy as np
+import pytest
+
+from igm_churchill_ancestry.utilities.manifest import (find_parts, merge_results, parse_shard, part_name, read_manifest,
+                                                       shard_rows)
+from igm_churchill_ancestry.utilities.writers import get_writer, read_results, read_sources
+from tests.test_utilities_results import make_results
+
+
+def test_read_manifest(tmp_path):
+    path = tmp_path / 'manifest.tsv'
+    path.write_text('path\tmode\tgenome_ver\tsamples\na.vcf\tWES\t38\t1,2\n# comment\nb.vcf\tWGS\t37\n')
+    rows = read_manifest(str(path))
+    assert rows == [{'path': 'a.vcf', 'mode': 'WES', 'genome_ver': '38', 'samples': '1,2'},
+                    {'path': 'b.vcf', 'mode': 'WGS', 'genome_ver': '37', 'samples': 'all'}]
+
+
+def test_shards_cover_manifest_in_order():
+    rows = list(range(10))
+    covered = [idx for i in range(3) for idx, _ in shard_rows(rows, *parse_shard(f'{i}/3'))]
+    assert covered == rows
+    with pytest.raises(ValueError):
+        parse_shard('3/3')
+
+
+def test_find_parts_requires_every_shard(tmp_path):
+    for i in (1, 0):
+        (tmp_path / part_name(i, 3)).write_text('')
+    with pytest.raises(ValueError):
+        find_parts([str(tmp_path)])
+    (tmp_path / part_name(2, 3)).write_text('')
+    assert [p.split('/')[-1] for p in find_parts([str(tmp_path)])] == [part_name(i, 3) for i in range(3)]
+    # the same set given twice
+    with pytest.raises(ValueError, match='more than once'):
+        find_parts([str(tmp_path), str(tmp_path)])
+    with pytest.raises(ValueError, match='more than once'):
+        find_parts([str(tmp_path), str(tmp_path / part_name(1, 3))])
+    # a stale part of an earlier run with a different number of shards
+    (tmp_path / part_name(0, 2)).write_text('')
+    with pytest.raises(ValueError, match='sets of'):
+        find_parts([str(tmp_path)])
+
+
+@pytest.mark.parametrize('output_format', ['csv', 'parquet'])
+def test_merge_keeps_duplicate_samples_apart(tmp_path, output_format):
+    var, results = make_results(2)
+    tables = []
+    for name, rows in (('a', [0, 1]), ('b', [1, 0])):
+        tables.append(str(tmp_path / f'{name}.csv'))
+        with get_writer(tables[-1], var) as writer:
+            writer.write(results.take(rows))
+    # two inputs with the same sample names, as in the part-file of a shard
+    part = merge_results(tables, str(tmp_path / part_name(0, 2, output_format)), var, output_format,
+                         ['s3://bucket/a.vcf', 's3://bucket/b.vcf'])
+    assert read_sources(part) == ['s3://bucket/a.vcf'] * 2 + ['s3://bucket/b.vcf'] * 2
+    other = str(tmp_path / 'c.csv')
+    with get_writer(other, var) as writer:
+        writer.write(results.take([0]))
+    # merging part-files keeps the inputs they name, files without a source column are named after the file
+    merged = merge_results([part, other], str(tmp_path / f'merged.{output_format}'), var, output_format)
+    assert read_sources(merged) == ['s3://bucket/a.vcf'] * 2 + ['s3://bucket/b.vcf'] * 2 + ['c.csv']
+    loaded = read_results(merged, var)
+    assert loaded.samples == ['s0', 's1', 's1', 's0', 's0']
+    assert np.allclose(loaded.probs, results.take([0, 1, 1, 0, 0]).probs, atol=1e-6)
+    assert read_sources(other) is None
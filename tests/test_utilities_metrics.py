@@ -0,0 +1,71 @@
+import os
+
+from igm_churchill_ancestry.utilities import metrics
+from igm_churchill_ancestry.utilities.metrics import inc, counters, start_metrics, save_counters, load_counters, render, write_metrics
+from igm_churchill_ancestry.utilities.synthetic import generate_resources, generate_vcf
+from igm_churchill_ancestry.utilities.utilities import get_file_handle
+from igm_churchill_ancestry.utilities.parsing import parse_multisample_vcf
+from igm_churchill_ancestry.pipelines.ancestry_prediction import encode_sample
+from igm_churchill_ancestry.pipelines.resources import ResourceSet
+
+
+def reset(monkeypatch):
+    monkeypatch.setattr(metrics, '_COUNTERS', {})
+    monkeypatch.setattr(metrics, '_SINK', {})
+
+
+def test_write_metrics(tmp_path, monkeypatch):
+    reset(monkeypatch)
+    start_metrics(str(tmp_path / 'm'))
+    inc('snvstory_samples_processed', 3)
+    inc('snvstory_cache_requests', 3, cache='prediction', result='hit')
+    inc('snvstory_cache_requests', cache='prediction', result='miss')
+    inc('snvstory_aims_found', 5, model='gnomAD_eur')
+    inc('snvstory_aims_expected', 10, model='gnomAD_eur')
+    # the counter file of another worker process
+    (tmp_path / 'm' / 'host-1.json').write_text('[["snvstory_samples_processed", {}, 2]]')
+    path = write_metrics(str(tmp_path / 'textfile' / 'snvstory.prom'), str(tmp_path / 'm'),
+                         stages={'predict': {'wall_s': 1.5, 'count': 4}}, started=0, inputs={'completed': 2, 'failed': 0})
+    text = open(path).read()
+    assert 'snvstory_samples_processed_total 5\n' in text
+    assert '# TYPE snvstory_samples_processed counter\n' in text
+    assert 'snvstory_cache_hit_ratio{cache="prediction"} 0.75\n' in text
+    assert 'snvstory_aim_coverage_ratio{model="gnomAD_eur"} 0.5\n' in text
+    assert 'snvstory_stage_seconds_total{stage="predict"} 1.5\n' in text
+    assert 'snvstory_run_inputs_total{status="failed"} 0\n' in text
+    assert text.endswith('# EOF\n')
+    assert os.listdir(tmp_path / 'textfile') == ['snvstory.prom']
+
+
+def test_forked_worker_starts_empty(tmp_path, monkeypatch):
+    reset(monkeypatch)
+    inc('snvstory_samples_processed')
+    start_metrics(str(tmp_path))
+    assert len(counters()) == 1
+    # as inherited by a forked worker
+    metrics._SINK['pid'] = -1
+    start_metrics(str(tmp_path))
+    assert counters() == {}
+    save_counters()
+    assert load_counters(str(tmp_path)) == {}
+
+
+def test_render_escapes_labels():
+    text = render({('snvstory_run_inputs', (('status', 'a"b\\'),)): 1})
+    assert 'snvstory_run_inputs_total{status="a\\"b\\\\"} 1\n' in text
+
+
+def test_encoders_count_alike(tmp_path, monkeypatch):
+    var, sites = generate_resources(str(tmp_path / 'resources'), n_aims=30, umap=False)
+    vcf = str(tmp_path / 'cohort.vcf')
+    generate_vcf(vcf, sites, n_samples=3, genome_ver='37')
+    reset(monkeypatch)
+    o, gz_file = get_file_handle(vcf)
+    for column in (9, 10, 11):
+        encode_sample(parse_multisample_vcf(o, gz_file, column), var, '37', 'WES')
+    expected = counters()
+    resources = ResourceSet(var)
+    reset(monkeypatch)
+    resources.encode_lines(o, [9, 10, 11], '37', 'WES')
+    assert counters() == expected
+    assert expected[('snvstory_aims_expected', (('model', 'gnomAD_eur'),))] == 90
@@ -0,0 +1,95 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from igm_churchill_ancestry.pipelines import chunked
+from igm_churchill_ancestry.pipelines.ancestry_prediction import run_ancestry_pipeline
+from igm_churchill_ancestry.pipelines.chunked import run_chunked_pipeline, RESERVED_BYTES, LINE_BYTES_PER_SAMPLE
+from igm_churchill_ancestry.pipelines.resources import ResourceLoader, ResourceSet
+from igm_churchill_ancestry.utilities.parsing import parse_genotypes
+from igm_churchill_ancestry.utilities.plink import PlinkFileset, parse_plink, plink_header
+from igm_churchill_ancestry.utilities.synthetic import generate_resources, generate_vcf, vcf_to_plink
+from igm_churchill_ancestry.utilities.utilities import filter_extension, get_file_handle, is_vcf_multisample
+
+
+@pytest.fixture(scope='module')
+def synthetic(tmp_path_factory):
+    root = tmp_path_factory.mktemp('plink')
+    var, sites = generate_resources(str(root / 'resources'), n_aims=30, umap=False)
+    # 7 samples leave a partly filled last byte in every variant
+    vcf = str(root / 'cohort.vcf')
+    generate_vcf(vcf, sites, n_samples=7, genome_ver='37', missing=0.2, multiallelic=0)
+    vcf_to_plink(vcf, str(root / 'cohort'))
+    vcf_to_plink(vcf, str(root / 'swapped'), swapped=0.5)
+    return root, var, sites, vcf
+
+
+def test_decode_matches_vcf(synthetic):
+    root, var, sites, vcf = synthetic
+    o, gz_file = get_file_handle(vcf)
+    columns = [9, 15, 11]
+    expected_loci, expected = parse_genotypes(o, columns)
+    loci, codes = parse_plink(str(root / 'cohort.bed'), columns)
+    assert loci == expected_loci
+    assert codes.dtype == np.int8
+    np.testing.assert_array_equal(codes, expected)
+
+
+def test_aims_in_either_allele_order(synthetic):
+    root, var, sites, vcf = synthetic
+    o, gz_file = get_file_handle(vcf)
+    columns = list(range(9, 16))
+    vcf_loci, vcf_codes = parse_genotypes(o, columns)
+    aims = set(sites.locus_ids('37'))
+    loci, codes = parse_plink(str(root / 'swapped.bed'), columns, aims)
+    # only the AIM records are decoded, under their vcf locus ids even when PLINK swapped the alleles
+    assert loci == [x for x in vcf_loci if x in aims]
+    rows = [vcf_loci.index(x) for x in loci]
+    np.testing.assert_array_equal(codes, vcf_codes[rows])
+    fileset = PlinkFileset(str(root / 'swapped.bed'))
+    assert fileset.select(aims)[2].any()
+
+
+def test_header_and_samples(synthetic):
+    root, var, sites, vcf = synthetic
+    assert plink_header(str(root / 'cohort.bed'))[0].rstrip('\n').split('\t')[9:] == [f'SAMPLE{i:05d}' for i in range(7)]
+    assert is_vcf_multisample(str(root / 'cohort.bed'), True) == (True, [f'SAMPLE{i:05d}' for i in range(7)])
+
+
+def test_directory_skips_bed_intervals():
+    listing = ['cohort.bed', 'cohort.bim', 'cohort.fam', 'targets.bed', 'partial.bed', 'partial.bim', 'a.vcf.gz']
+    assert filter_extension(listing) == ['cohort.bed', 'a.vcf.gz']
+
+def test_truncated_bed(synthetic, tmp_path):
+    root, var, sites, vcf = synthetic
+    for ext in ('.bim', '.fam'):
+        (tmp_path / f'short{ext}').write_bytes((root / f'cohort{ext}').read_bytes())
+    (tmp_path / 'short.bed').write_bytes((root / 'cohort.bed').read_bytes()[:-1])
+    with pytest.raises(ValueError):
+        PlinkFileset(str(tmp_path / 'short.bed'))
+
+
+@pytest.mark.parametrize('sample_position', ['all', ['SAMPLE00005', '2']])
+def test_pipeline_matches_vcf(synthetic, tmp_path, sample_position):
+    root, var, sites, vcf = synthetic
+    for name, path in (('vcf', vcf), ('plink', str(root / 'swapped.bed'))):
+        (tmp_path / name).mkdir()
+        run_ancestry_pipeline(path, True, None, sample_position, var, str(tmp_path / name), '37', 'WES', 'out.csv',
+                              plots=False, resources=ResourceLoader(var))
+    expected = pd.read_csv(tmp_path / 'vcf' / 'out.csv')
+    actual = pd.read_csv(tmp_path / 'plink' / 'out.csv')
+    pd.testing.assert_frame_equal(actual, expected, atol=1e-6)
+
+
+def test_chunked_matches_vcf(synthetic, tmp_path, monkeypatch):
+    root, var, sites, vcf = synthetic
+    resources = ResourceSet(var)
+    monkeypatch.setattr(chunked, 'rss_mb', lambda: 0)
+    n_snps = [res.n_snps for res in resources.models.values()]
+    budget = RESERVED_BYTES + 7 * LINE_BYTES_PER_SAMPLE + 3 * (6 * sum(n_snps) + 16 * max(n_snps))
+    for name, path in (('vcf', vcf), ('plink', str(root / 'swapped.bed'))):
+        (tmp_path / name).mkdir()
+        assert run_chunked_pipeline(path, 'all', var, resources, str(tmp_path / name), '37', 'WES', 'out.csv', budget,
+                                    plots=False) == 3
+    pd.testing.assert_frame_equal(pd.read_csv(tmp_path / 'plink' / 'out.csv'), pd.read_csv(tmp_path / 'vcf' / 'out.csv'),
+                                  atol=1e-6)
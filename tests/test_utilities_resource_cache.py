@@ -0,0 +1,66 @@
+import os
+
+import boto3
+import pytest
+
+try:
+    from moto import mock_aws
+except ImportError:  # moto < 5
+    from moto import mock_s3 as mock_aws
+
+from igm_churchill_ancestry.utilities import resource_cache, s3
+from igm_churchill_ancestry.utilities.resource_cache import ResourceCache, STAMP
+
+
+@pytest.fixture
+def bucket(monkeypatch):
+    monkeypatch.setenv('AWS_ACCESS_KEY_ID', 'testing')
+    monkeypatch.setenv('AWS_SECRET_ACCESS_KEY', 'testing')
+    monkeypatch.setenv('AWS_DEFAULT_REGION', 'us-east-1')
+    monkeypatch.setattr(resource_cache, '_HELD', {})
+    s3._client.cache_clear()
+    with mock_aws():
+        client = boto3.client('s3')
+        client.create_bucket(Bucket='rsrc')
+        client.put_object(Bucket='rsrc', Key='v1/continental/model.bin', Body=b'x' * 100)
+        client.put_object(Bucket='rsrc', Key='v1/continental/snps.txt', Body=b'1_1000_A_G\n')
+        client.put_object(Bucket='rsrc', Key='v10/other.txt', Body=b'not part of v1')
+        yield client
+
+
+def test_fetch_downloads_once_and_verifies(bucket, tmp_path):
+    cache = ResourceCache(str(tmp_path / 'cache'))
+    path = cache.fetch('s3://rsrc/v1')
+    with open(os.path.join(path, 'continental', 'model.bin'), 'rb') as fin:
+        assert fin.read() == b'x' * 100
+    assert not os.path.exists(os.path.join(path, 'other.txt'))
+    assert os.path.exists(os.path.join(path, STAMP))
+    # a warm fetch finds the verified stamp and downloads nothing
+    bucket.delete_object(Bucket='rsrc', Key='v10/other.txt')
+    resource_cache._HELD.clear()
+    os.remove(os.path.join(path, 'continental', 'snps.txt'))
+    assert cache.fetch('s3://rsrc/v1/') == path
+    assert not os.path.exists(os.path.join(path, 'continental', 'snps.txt'))
+
+
+def test_changed_objects_get_a_new_entry(bucket, tmp_path):
+    cache = ResourceCache(str(tmp_path / 'cache'))
+    first = cache.fetch('s3://rsrc/v1')
+    bucket.put_object(Bucket='rsrc', Key='v1/continental/model.bin', Body=b'y' * 100)
+    second = cache.fetch('s3://rsrc/v1')
+    assert second != first
+    with open(os.path.join(second, 'continental', 'model.bin'), 'rb') as fin:
+        assert fin.read() == b'y' * 100
+
+
+def test_evict_skips_entries_in_use(bucket, tmp_path):
+    cache = ResourceCache(str(tmp_path / 'cache'), max_bytes=150)
+    first = cache.fetch('s3://rsrc/v1')
+    bucket.put_object(Bucket='rsrc', Key='v1/continental/model.bin', Body=b'y' * 100)
+    second = cache.fetch('s3://rsrc/v1')
+    # both entries are held by this process
+    assert os.path.exists(first) and os.path.exists(second)
+    resource_cache._HELD.pop(os.path.basename(first)).close()
+    cache.evict()
+    assert not os.path.exists(first)
+    assert os.path.exists(second)
@@ -0,0 +1,39 @@
+import numpy as np
+
+from igm_churchill_ancestry.pipelines.variables import variables
+from igm_churchill_ancestry.utilities.results import AncestryResults
+
+
+def make_results(n_samples=3):
+    var = variables('.')
+    rng = np.random.default_rng(0)
+    results = AncestryResults([f's{i}' for i in range(n_samples)], var)
+    for _, _, n_classes, m_type in var.R_DIRS:
+        p = rng.random((n_samples, n_classes))
+        results[m_type] = p / p.sum(axis=1, keepdims=True)
+    return var, results
+
+
+def test_model_views_share_one_array():
+    var, results = make_results()
+    assert results.probs.dtype == np.float32
+    assert results.probs.shape == (3, sum(n for _, _, n, _ in var.R_DIRS))
+    results['gnomAD_eur'][0, 0] = 0.5
+    assert results.sample(0)['gnomAD_eur'][0] == np.float32(0.5)
+
+
+def test_normalized_scales_by_parent():
+    var, results = make_results()
+    normed = results.normalized()
+    expected = results['gnomAD_eur'] * results['gnomAD_continental'][:, [4]]
+    assert np.allclose(normed['gnomAD_eur'], expected)
+    assert np.array_equal(normed['gnomAD_continental'], results['gnomAD_continental'])
+
+
+def test_csv_round_trip(tmp_path):
+    var, results = make_results()
+    path = str(tmp_path / 'results.csv')
+    results.to_csv(path)
+    loaded = AncestryResults.read_csv(path, var)
+    assert loaded.samples == results.samples
+    assert np.array_equal(loaded.probs, results.probs)
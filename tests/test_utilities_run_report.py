@@ -0,0 +1,70 @@
+import os
+import json
+import time
+import pstats
+
+import pytest
+
+from igm_churchill_ancestry.utilities import run_report
+from igm_churchill_ancestry.utilities.run_report import RunReport, read_spans, span, summarize, write_report
+
+
+def busy(seconds):
+    end = time.process_time() + seconds
+    while time.process_time() < end:
+        pass
+
+
+def test_spans_inherit_tags_and_record_errors(tmp_path):
+    report = RunReport(str(tmp_path / 'spans.ndjson'))
+    with report.span('sample', sample='s0'):
+        with report.span('predict', model='gnomAD_continental'):
+            pass
+    with pytest.raises(ValueError):
+        with report.span('parse', sample='s1'):
+            raise ValueError('malformed')
+    spans = read_spans(report.path)
+    assert [x['stage'] for x in spans] == ['predict', 'sample', 'parse']
+    assert spans[0]['sample'] == 's0' and spans[0]['model'] == 'gnomAD_continental'
+    assert 'model' not in spans[1]
+    assert spans[2]['error'] == 'ValueError'
+    assert all(x['peak_rss_mb'] > 0 for x in spans)
+
+
+def test_span_is_a_no_op_without_a_report(tmp_path, monkeypatch):
+    monkeypatch.setattr(run_report, '_ACTIVE', {})
+    with span('parse'):
+        pass
+    run_report.start_report(str(tmp_path / 'spans.ndjson'))
+    with span('parse'):
+        pass
+    assert len(read_spans(str(tmp_path / 'spans.ndjson'))) == 1
+
+
+def test_profiles_hold_their_own_stage(tmp_path):
+    report = RunReport(str(tmp_path / 'spans.ndjson'), str(tmp_path / 'profiles'))
+    with report.span('outer'):
+        with report.span('inner'):
+            busy(0.05)
+    names = sorted(os.listdir(tmp_path / 'profiles'))
+    assert [x.split('-', 2)[2] for x in names] == ['outer.pstats', 'inner.pstats']
+    funcs = {x[2] for x in pstats.Stats(str(tmp_path / 'profiles' / names[1])).stats}
+    assert 'busy' in funcs
+    funcs = {x[2] for x in pstats.Stats(str(tmp_path / 'profiles' / names[0])).stats}
+    assert 'busy' not in funcs
+
+
+def test_write_report(tmp_path):
+    report = RunReport(str(tmp_path / 'spans.ndjson'))
+    for model in ('a', 'b'):
+        with report.span('predict', model=model):
+            busy(0.01)
+    with report.span('plot'):
+        pass
+    out = write_report(report.path, str(tmp_path / 'report.json'), time.time() - 1, inputs=1)
+    with open(out) as fin:
+        written = json.load(fin)
+    assert written['inputs'] == 1 and written['wall_s'] >= 1
+    assert list(written['stages']) == ['predict', 'plot']
+    assert written['stages']['predict']['count'] == 2
+    assert written['stages'] == summarize(written['spans'])
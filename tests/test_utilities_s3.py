@@ -0,0 +1,79 @@
+import os
+
+import boto3
+import pytest
+
+try:
+    from moto import mock_aws
+except ImportError:  # moto < 5
+    from moto import mock_s3 as mock_aws
+
+from igm_churchill_ancestry.utilities import s3
+
+
+@pytest.fixture
+def bucket(monkeypatch):
+    monkeypatch.setenv('AWS_ACCESS_KEY_ID', 'testing')
+    monkeypatch.setenv('AWS_SECRET_ACCESS_KEY', 'testing')
+    monkeypatch.setenv('AWS_DEFAULT_REGION', 'us-east-1')
+    monkeypatch.setattr(s3, '_TRANSFER', dict(s3._TRANSFER))
+    s3._client.cache_clear()
+    with mock_aws():
+        client = boto3.client('s3')
+        client.create_bucket(Bucket='data')
+        yield client
+
+
+def write(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as fout:
+        fout.write(data)
+
+
+def test_client_is_shared(bucket):
+    assert s3.get_client() is s3.get_client()
+
+
+def test_directory_round_trip(bucket, tmp_path):
+    src = tmp_path / 'src'
+    for name in ['a.txt', 'models/b.bin', 'models/deep/c.json']:
+        write(str(src / name), name.encode('utf-8'))
+    s3.upload_s3_directory(str(src), 's3://data/rsrc/')
+    keys = sorted(x['Key'] for x in s3.list_s3_objects('s3://data/rsrc/'))
+    assert keys == ['rsrc/a.txt', 'rsrc/models/b.bin', 'rsrc/models/deep/c.json']
+    bucket.put_object(Bucket='data', Key='rsrc2/other.txt', Body=b'other prefix')
+    dst = tmp_path / 'dst'
+    s3.download_s3_directory('s3://data/rsrc', str(dst))
+    for name in ['a.txt', 'models/b.bin', 'models/deep/c.json']:
+        assert (dst / name).read_bytes() == name.encode('utf-8')
+    assert not (dst / 'other.txt').exists()
+
+
+def test_multipart_file_transfer(bucket, tmp_path):
+    s3.configure_transfers(chunk_size='5M', concurrency=4)
+    data = os.urandom(11 << 20)
+    write(str(tmp_path / 'big.bin'), data)
+    s3.upload_s3_file(str(tmp_path / 'big.bin'), 's3://data/big.bin')
+    assert s3.list_s3_objects('s3://data/big.bin')[0]['ETag'].endswith('-3')
+    s3.download_s3_file('s3://data/big.bin', str(tmp_path / 'copy.bin'))
+    assert (tmp_path / 'copy.bin').read_bytes() == data
+
+
+def test_failed_transfers_are_reported(bucket, tmp_path):
+    with pytest.raises(RuntimeError):
+        s3.transfer_files(s3.download_s3_file, [('s3://data/missing.txt', str(tmp_path / 'missing.txt'))])
+
+
+def test_files_and_parts_fit_the_pool(bucket, tmp_path, monkeypatch):
+    s3.configure_transfers(concurrency=8)
+    assert s3.file_concurrency(1) == (1, 8)
+    assert s3.file_concurrency(3) == (3, 2)
+    assert s3.file_concurrency(100) == (8, 1)
+    calls = []
+    monkeypatch.setattr(s3, 'download_s3_file', lambda src, dst, concurrency=None: calls.append(concurrency))
+    s3.download_s3_directory('s3://data/none/', str(tmp_path))
+    for i in range(4):
+        bucket.put_object(Bucket='data', Key=f'four/{i}.txt', Body=b'x')
+    s3.download_s3_directory('s3://data/four/', str(tmp_path))
+    assert calls == [2] * 4
+    assert 4 * 2 <= s3.get_client().meta.config.max_pool_connections
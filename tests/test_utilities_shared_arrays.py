@@ -0,0 +1,88 @@
+import gc
+import mmap
+import collections
+import multiprocessing
+from multiprocessing import shared_memory
+
+import numpy as np
+import pytest
+from scipy import sparse
+
+from igm_churchill_ancestry.utilities.shared_arrays import SEARCHED_PACKAGES, SharedArrays
+
+Tree = collections.namedtuple('Tree', ['hyperplanes', 'offsets'])
+
+
+class Model:
+    pass
+
+
+def make_model():
+    model = Model()
+    model.weights = np.arange(4096, dtype=np.float64)
+    model.alias = model.weights
+    model.small = np.arange(4, dtype=np.int8)
+    model.trees = [Tree(np.ones((64, 32)), np.zeros(64))]
+    model.matrix = sparse.random(256, 256, density=0.2, format='csr', random_state=0)
+    model.params = {'bias': np.full(1024, 0.5), 'name': 'synthetic'}
+    return model
+
+
+def test_share_moves_large_arrays():
+    model = make_model()
+    expected = {'weights': model.weights.copy(), 'matrix': model.matrix.toarray(), 'tree': model.trees[0].hyperplanes.copy()}
+    small = model.small
+    shared = SharedArrays(min_bytes=1 << 10, packages=SEARCHED_PACKAGES + (__name__.split('.')[0],))
+    assert shared.share(model) is model
+    try:
+        assert len(shared.blocks) == 6
+        assert shared.nbytes == sum(a.nbytes for a in [model.weights, model.trees[0].hyperplanes, model.matrix.data, model.matrix.indices, model.matrix.indptr, model.params['bias']])
+        assert model.alias is model.weights
+        assert model.small is small
+        assert isinstance(model.trees[0], Tree)
+        assert np.array_equal(model.weights, expected['weights'])
+        assert np.array_equal(model.matrix.toarray(), expected['matrix'])
+        assert np.array_equal(model.trees[0].hyperplanes, expected['tree'])
+        assert model.params['name'] == 'synthetic'
+        for a in [model.weights, model.trees[0].hyperplanes, model.matrix.data, model.params['bias']]:
+            assert isinstance(a.base, mmap.mmap)
+        # smaller than min_bytes
+        assert not isinstance(model.trees[0].offsets.base, mmap.mmap)
+    finally:
+        shared.unlink()
+
+
+def test_forked_processes_map_the_same_pages():
+    model = make_model()
+    shared = SharedArrays(min_bytes=1 << 10, packages=SEARCHED_PACKAGES + (__name__.split('.')[0],))
+    shared.share(model)
+    try:
+        def write():
+            model.weights[0] = 42.0
+            # a no-op in the forked process, which does not own the blocks
+            shared.unlink()
+        process = multiprocessing.get_context('fork').Process(target=write)
+        process.start()
+        process.join()
+        assert process.exitcode == 0
+        # written by the child, seen by the parent: not a copy-on-write copy
+        assert model.weights[0] == 42.0
+        names = [shm.name for shm in shared.blocks]
+        assert names
+    finally:
+        shared.unlink()
+    for name in names:
+        with pytest.raises(FileNotFoundError):
+            shared_memory.SharedMemory(name=name)
+
+
+def test_shared_arrays_readable_after_unlink():
+    model = {'weights': np.ones(1 << 18)}
+    shared = SharedArrays()
+    shared.share(model)
+    assert isinstance(model['weights'].base, mmap.mmap)
+    shared.unlink()
+    gc.collect()
+    assert model['weights'].sum() == 1 << 18
+    # a second unlink does not warn about blocks already removed
+    shared.unlink()
@@ -0,0 +1,24 @@
+import numpy as np
+from scipy import sparse
+
+from igm_churchill_ancestry.utilities.store import ResultsStore, genotype_hash
+from tests.test_utilities_results import make_results
+
+
+def test_genotype_hash_tracks_genotypes():
+    a = {'gnomAD_continental': sparse.csr_matrix(np.array([0, 1, 2]))}
+    b = {'gnomAD_continental': sparse.csr_matrix(np.array([0, 1, 2]))}
+    c = {'gnomAD_continental': sparse.csr_matrix(np.array([0, 2, 2]))}
+    assert genotype_hash(a) == genotype_hash(b)
+    assert genotype_hash(a) != genotype_hash(c)
+
+
+def test_store_lookup_and_insert(tmp_path):
+    var, results = make_results(3)
+    store = ResultsStore(str(tmp_path / 'results.db'), var)
+    hashes = ['h0', 'h1', 'h2']
+    store.insert(results.samples[:2], hashes[:2], results.probs[:2])
+    found = store.lookup(results.samples, ['h0', 'changed', 'h2'])
+    assert list(found) == [0]
+    assert np.array_equal(found[0], results.probs[0])
+    store.close()
@@ -0,0 +1,71 @@
+import os
+import json
+
+import boto3
+import pytest
+
+try:
+    from moto import mock_aws
+except ImportError:  # moto < 5
+    from moto import mock_s3 as mock_aws
+
+from igm_churchill_ancestry.utilities import s3
+from igm_churchill_ancestry.utilities.checkpoint import publish_outputs, record_published
+from igm_churchill_ancestry.utilities.stream import ResultStream, ArtifactPublisher, sample_records
+from tests.test_utilities_results import make_results
+
+
+def test_sample_records():
+    var, results = make_results(2)
+    records = sample_records(results, 'a.vcf')
+    assert [r['sample'] for r in records] == ['s0', 's1']
+    assert records[1]['source'] == 'a.vcf'
+    probs = records[1]['models']['gnomAD_continental']
+    assert list(probs) == [var.ABBR[x][0] for x in results.labels('gnomAD_continental')]
+    assert list(probs.values()) == pytest.approx(results['gnomAD_continental'][1].tolist())
+
+
+def test_file_stream_appends_lines(tmp_path):
+    path = str(tmp_path / 'out' / 'results.ndjson')
+    for sample_name in ('a', 'b'):
+        stream = ResultStream(path)
+        stream.emit({'sample': sample_name})
+        stream.close()
+    with open(path) as fin:
+        assert [json.loads(x)['sample'] for x in fin] == ['a', 'b']
+
+
+def test_s3_stream_uploads_in_background(monkeypatch):
+    monkeypatch.setenv('AWS_ACCESS_KEY_ID', 'testing')
+    monkeypatch.setenv('AWS_SECRET_ACCESS_KEY', 'testing')
+    monkeypatch.setenv('AWS_DEFAULT_REGION', 'us-east-1')
+    s3._client.cache_clear()
+    with mock_aws():
+        client = boto3.client('s3')
+        client.create_bucket(Bucket='results')
+        stream = ResultStream('s3://results/run1/')
+        for i in range(5):
+            stream.emit({'sample': f's{i}'})
+        stream.flush()
+        samples = []
+        for obj in sorted(s3.list_s3_objects('s3://results/run1/'), key=lambda x: x['Key']):
+            body = client.get_object(Bucket='results', Key=obj['Key'])['Body'].read().decode()
+            samples += [json.loads(x)['sample'] for x in body.splitlines()]
+        assert samples == [f's{i}' for i in range(5)]
+
+
+def test_published_artifacts_are_not_published_again(tmp_path):
+    staging, out_dir, output_dir = tmp_path / 'staging', tmp_path / 'work', tmp_path / 'out'
+    os.makedirs(staging)
+    os.makedirs(out_dir)
+    (staging / 's0.pdf').write_text('plot')
+    (staging / 'table.csv').write_text('table')
+    publisher = ArtifactPublisher(str(output_dir))
+    publisher.submit_new(str(staging), exclude=('table.csv',))
+    record_published(str(staging), publisher.wait())
+    publisher.close()
+    assert os.listdir(output_dir) == ['s0.pdf']
+    (output_dir / 's0.pdf').write_text('published early')
+    assert publish_outputs(str(staging), str(out_dir), str(output_dir)) == ['s0.pdf', 'table.csv']
+    assert (output_dir / 's0.pdf').read_text() == 'published early'
+    assert (output_dir / 'table.csv').read_text() == 'table'
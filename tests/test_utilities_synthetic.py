@@ -0,0 +1,47 @@
+import gzip
+
+import numpy as np
+import pytest
+
+from igm_churchill_ancestry import AncestryPredictor
+from igm_churchill_ancestry.utilities.synthetic import generate_resources, generate_vcf
+from igm_churchill_ancestry.utilities.utilities import check_resources, get_file_handle
+
+
+@pytest.fixture(scope='module')
+def synthetic(tmp_path_factory):
+    root = tmp_path_factory.mktemp('synthetic')
+    var, sites = generate_resources(str(root / 'resources'), n_aims=30, n_train=5, umap=False)
+    return root, var, sites
+
+
+@pytest.mark.parametrize('compression', [None, 'gz', 'bgzip'])
+def test_generate_vcf(synthetic, compression):
+    root, var, sites = synthetic
+    path = str(root / f'{compression}.vcf{".gz" if compression else ""}')
+    generate_vcf(path, sites, n_samples=4, mode='WES', compression=compression, gvcf=True)
+    o, gz_file = get_file_handle(path)
+    lines = [x.decode('utf-8') if gz_file else x for x in o]
+    header = [x for x in lines if x.startswith('#CHROM')][0].rstrip('\n').split('\t')
+    assert header[9:] == [f'SAMPLE{i:05d}' for i in range(4)]
+    records = [x.split('\t') for x in lines if not x.startswith('#')]
+    assert len(records) == sites.n_sites * 11
+    assert any(x[4] == '<NON_REF>' for x in records)
+    if compression == 'bgzip':
+        with open(path, 'rb') as fin:
+            # BGZF blocks carry the BC extra subfield
+            assert fin.read(16)[12:14] == b'BC'
+
+
+def test_builds_encode_alike(synthetic):
+    root, var, sites = synthetic
+    check_resources(var)
+    predictor = AncestryPredictor(var.RSRC_ROOT)
+    encoded = {}
+    for genome_ver in ('37', '38'):
+        path = str(root / f'b{genome_ver}.vcf')
+        generate_vcf(path, sites, n_samples=3, genome_ver=genome_ver, multiallelic=0, seed=1)
+        encoded[genome_ver] = predictor.encode(path, genome_ver=genome_ver)[1]
+    for m_type in predictor.models:
+        assert encoded['37'][m_type].nnz > 0
+        assert np.array_equal(encoded['37'][m_type].toarray(), encoded['38'][m_type].toarray())
@@ -0,0 +1,39 @@
+import numpy as np
+import pyarrow.parquet as pq
+
+from igm_churchill_ancestry.utilities.writers import get_writer, read_results, read_table, results_models
+from tests.test_utilities_results import make_results
+
+
+def test_parquet_row_groups(tmp_path):
+    var, results = make_results(5)
+    path = str(tmp_path / 'results.parquet')
+    with get_writer(path, var, 'parquet', row_group_size=2) as writer:
+        for i in range(len(results)):
+            writer.write(results.take([i]))
+    assert pq.ParquetFile(path).num_row_groups == 3
+    loaded = read_results(path, var)
+    assert loaded.samples == results.samples
+    assert np.array_equal(loaded.probs, results.probs)
+
+
+def test_arrow_columns(tmp_path):
+    var, results = make_results(2)
+    path = str(tmp_path / 'results.arrow')
+    with get_writer(path, var, 'arrow') as writer:
+        writer.write(results)
+    table = read_table(path)
+    assert table.num_rows == 2
+    assert str(table.schema.field('gnomAD_continental.eur').type) == 'float'
+    top = np.argmax(results['gnomAD_continental'], axis=1)
+    labels = [var.ABBR[x][0] for x in results.labels('gnomAD_continental')]
+    assert table.column('gnomAD_continental.top1').to_pylist() == [labels[i] for i in top]
+
+
+def test_results_models(tmp_path):
+    var, results = make_results(2)
+    for output_format in ('csv', 'parquet'):
+        path = str(tmp_path / f'results.{output_format}')
+        with get_writer(path, var, output_format) as writer:
+            writer.write(results)
+        assert results_models(path, var) == results.models